@@ -1,6 +1,8 @@
 import json
+import os
 import time
 import dash
+import flask
 from dash import dcc, html, Input, Output, dash_table, State
 from dash.exceptions import PreventUpdate
 from dash.dash_table.Format import Format, Scheme
@@ -10,51 +12,38 @@ import pandas as pd
 import numpy as np
 import geopandas as gpd
 import h3
-from shapely.geometry import Polygon
 import dash_leaflet as dl
 
+from h3_utils import get_h3_geojson, get_h3_polygons, int_to_h3
+from data import required_columns, parent_columns, build_municipality_index, enforce_schema
+from cache import LRUCache
+from result_store import make_result_store
+from geocoding import Geocoder, GeocodingCache, NominatimBackend, OfflineMunicipalityBackend
+
 INITIAL_MUNICIPALITY = 'Belém'
 MIN_HEX_SIZE_AT_STATE_LEVEL = 6
 
 # Load and preprocess the data
 para_muni = gpd.read_file("data/para_muni.geojson")
 
-# Read only required columns to save memory
-required_columns = [
-    "name_muni",
-    "pop_3_months_3_years_adj", # INF_CRE
-    "pop_4_5_years_adj", # INF_PRE
-    "pop_6_10_years_adj", # FUND_AI
-    "pop_11_14_years_adj", # FUND_AF
-    "pop_15_17_years_adj", # MED
-    "QT_MAT_INF_CRE", "QT_MAT_INF_PRE", "QT_MAT_FUND_AI", "QT_MAT_FUND_AF", "QT_MAT_MED",
-    "QT_MAT_INF_CRE_INT", "QT_MAT_INF_PRE_INT", "QT_MAT_FUND_AI_INT", "QT_MAT_FUND_AF_INT", "QT_MAT_MED_INT",
-    "QT_MAT_INF_CRE_PROP", "QT_MAT_INF_PRE_PROP", "QT_MAT_FUND_AI_PROP", "QT_MAT_FUND_AF_PROP", "QT_MAT_MED_PROP",
-    "QT_MAT_BAS_N",
-    "QT_SALAS_UTILIZADAS",
-    ## NEW PRIVATE SCHOOL VARIABLES ##
-    "PRIVATE_QT_MAT_INF_CRE", "PRIVATE_QT_MAT_INF_PRE", "PRIVATE_QT_MAT_FUND_AF", "PRIVATE_QT_MAT_FUND_AI", "PRIVATE_QT_MAT_MED",
-    ## NEW PRIVATE SCHOOL VARIABLES ##
-    "hex", 
-    # "geometry"
-]
-
-def get_h3_geometry(hex_ids):
-    for hex_id in hex_ids:
-        yield Polygon(h3.h3_to_geo_boundary(hex_id, geo_json=True))
-
 start_time = time.time()
-hex_gdf = pd.read_parquet("data/25022025_dashboard_hexs_light.parquet", columns=required_columns)
+hex_gdf = pd.read_parquet("data/25022025_dashboard_hexs_light.parquet", columns=required_columns + parent_columns)
+# float32 counts, categorical municipality and uint64 H3 ids (see data.schema)
+hex_gdf = enforce_schema(hex_gdf)
 print("Time to load the data:", time.time() - start_time)
 
+# Rows of each municipality (the light parquet is sorted by municipality, see data.py)
+municipality_index = build_municipality_index(hex_gdf)
+
 # Replace "pop_3_months_3_years" with  "pop_INF_CRE"
-hex_gdf = hex_gdf.rename(columns={
+POPULATION_COLUMNS = {
     "pop_3_months_3_years_adj": "pop_INF_CRE",
     "pop_4_5_years_adj": "pop_INF_PRE",
     "pop_6_10_years_adj": "pop_FUND_AI",
     "pop_11_14_years_adj": "pop_FUND_AF",
     "pop_15_17_years_adj": "pop_MED",
-})
+}
+hex_gdf = hex_gdf.rename(columns=POPULATION_COLUMNS)
 
 education_levels = ["INF_CRE", "INF_PRE", "FUND_AI", "FUND_AF", "MED"]
 education_levels_labels = {
@@ -132,124 +121,138 @@ slider_marks = {
 }
 
 
-def calculate_table_data(name_muni=None):
+def get_municipality_hexagons(name_muni):
+    """
+    Get the hexagons of a municipality as a contiguous slice of hex_gdf, without
+    scanning the whole table. Unknown municipalities return an empty DataFrame.
+    """
+    start, stop = municipality_index.get(name_muni, (0, 0))
+    return hex_gdf.iloc[start:stop]
+
+
+# Rows of the planning table computed by calculate_table_data
+TABLE_ROWS = [
+    "População Estimada",
+    "Porcentagem da População fora da Escola (%)",
+    "Porcentagem de Alunos em Escolas Privadas (%)",
+    "Número Total de Alunos em Escolas Publicas",
+    # "Número Total de Alunos Matriculados Escola Publica (CENSO)",
+    # "Número Total de Alunos Matriculados",
+    "Porcentagem de Alunos em Tempo Integral (%)",
+    "Porcentagem de Alunos em Período Noturno (%)",
+    "Número Total de Vagas Necessárias",
+    "Número Total de Vagas por Sala",
+    "Número de Salas Necessárias",
+    "Número de Salas Existentes",
+    "Número de Novas Salas Necessárias",
+]
 
-    if name_muni and "name_muni" in hex_gdf.columns:
-        print("Selected municipality:", name_muni)
-        filtered_hexs = hex_gdf[hex_gdf["name_muni"] == name_muni]
-    else:
-        print("No municipality selected")
-        filtered_hexs = hex_gdf.copy()
-    
-    print("1. Filtered hexs shape", filtered_hexs.shape)
-        
-    # Calculate defaults for the table
-    main_table = []
+# Per level sums needed by the planning table, in the order of the level block
+TABLE_METRICS = ["pop", "mat", "private", "mat_int", "mat_noc", "salas"]
 
-    ### NEW VARIABLES WITH ESTIMATED POP & STUDENTS IN PRIVATE SCHOOL ### 
+# Number of chairs per classroom
+# Source: https://normativasconselhos.mec.gov.br/normativa/pdf/CEE-PA_RESOLUC387C383O20001.201020REGULAMENTAC387C383O20EDUC.20BAS.20atualizada20em2001.06.2015_0.pdf
+# Creche/Daycare (0 to 1 years) - 8 students per classroom (NOT CONSIDERED)
+# Creche/Daycare (1 to 3 years) - 15 students per classroom
+# Pré-Escola/Pre-Kindergarten (4 to 5 years) - 25 students per classroom
+# Anos Iniciais do Ensino Fundamental/Elementary School (6 to 10 years) - 35 students per classroom
+# Anos Finais do Ensino Fundamental/Middle School (11 to 14 years) - 40 students per classroom
+# Ensino Médio/High School (15 to 17 years) - 40 students per classroom
+NUM_CHAIRS = np.array([15, 25, 35, 40, 40], dtype=np.float64)
 
-    # A - population on each level 
-    pop_per_level = filtered_hexs[[f'pop_{level}' for level in education_levels]].sum().round(0).values.tolist()
-    main_table.append(pop_per_level)
+# Levels without students in nocturnal time
+DAYTIME_LEVELS = ["INF_CRE", "INF_PRE", "FUND_AI"]
 
-    # A1 - % population outside of school
-    pop_not_in_school_per_level = []
-    for level in education_levels:
-        pop_not_in_school = 1 - (filtered_hexs[f"QT_MAT_{level}"].sum() / filtered_hexs[f'pop_{level}'].sum())
-        pop_not_in_school *= 100
-        pop_not_in_school_per_level.append(pop_not_in_school)
-    main_table.append(pop_not_in_school_per_level)
-    
-    # A2 - % students in private schoools
-    students_in_private_per_level = []
-    for level in education_levels:
-        # students_private_schools = 1 - (filtered_hexs[f"PRIVATE_QT_MAT_{level}"].sum() / filtered_hexs[f"QT_MAT_{level}"].sum())
-        students_private_schools = filtered_hexs[f"PRIVATE_QT_MAT_{level}"].sum() / filtered_hexs[f"pop_{level}"].sum()
-        students_private_schools *= 100
-        students_in_private_per_level.append(students_private_schools)
-    main_table.append(students_in_private_per_level)
-
-    # B - Total # of students in the public system (CALCULATED)
-    students_in_public_per_level = []
-    for i, level in enumerate(education_levels):
-        students_in_public_edu = pop_per_level[i] * (1 - (pop_not_in_school_per_level[i]/100) - (students_in_private_per_level[i]/100))
-        students_in_public_per_level.append(students_in_public_edu)
-    main_table.append(students_in_public_per_level)
-
-    # # C - Total # of students in the public system (CENSO)
-    # students_public = []
-    # for i, level in enumerate(education_levels):
-    #     students_public_value = filtered_hexs[f"QT_MAT_{level}"].sum() - filtered_hexs[f"PRIVATE_QT_MAT_{level}"].sum()
-    #     students_public.append(students_public_value)
-    # main_table.append(students_public)
-
-    ### NEW VARIABLES WITH ESTIMATED POP & STUDENTS IN PRIVATE SCHOOL ### 
-
-    # total number of students on each level
-    # main_table.append(filtered_hexs[[f'QT_MAT_{level}' for level in education_levels]].sum().values.tolist())
-
-    # percentage of students in integral time (Tempo Integral)
-    main_table.append([100 * (filtered_hexs[f"QT_MAT_{level}_INT"].sum() / filtered_hexs[f"QT_MAT_{level}"].sum()) for level in education_levels])
-    # percentage of students in nocturnal time (Tempo Noturno)
-    main_table.append([
-        100 * ((filtered_hexs["QT_MAT_BAS_N"] * filtered_hexs[f"QT_MAT_{level}_PROP"]).sum() / filtered_hexs[f"QT_MAT_{level}"].sum())
-        if level not in ["INF_CRE", "INF_PRE", "FUND_AI"] else 0 
-        for level in education_levels 
-    ])
-    # total number of places available
-    total_places = []
-
-    # Row indexes
-    TOTAL_STUDENTS  = 3
-    PCT_STUDENTS_INT = 4
-    PCT_STUDENTS_NOC = 5
-    for i, level in enumerate(education_levels):
-        # total number of students * (1 + percentage of students in integral time) * (1 - percentage of students in nocturnal time)
-        num_cadeiras = main_table[TOTAL_STUDENTS][i] * (1 + main_table[PCT_STUDENTS_INT][i] / 100) * (1 - main_table[PCT_STUDENTS_NOC][i] / 100)
-        total_places.append(num_cadeiras)
-    main_table.append(total_places)
-
-    main_table = pd.DataFrame(
-        data=main_table, 
-        columns=education_levels, 
-        index=[
-            "População Estimada",
-            "Porcentagem da População fora da Escola (%)",
-            "Porcentagem de Alunos em Escolas Privadas (%)",
-            "Número Total de Alunos em Escolas Publicas",
-            # "Número Total de Alunos Matriculados Escola Publica (CENSO)",
-            # "Número Total de Alunos Matriculados",
-            "Porcentagem de Alunos em Tempo Integral (%)", 
-            "Porcentagem de Alunos em Período Noturno (%)", 
-            "Número Total de Vagas Necessárias",
-        ]
-    ) 
 
-    # Calculate the number of classrooms needed based on the user defined number of chairs per classroom
+def build_level_block(df):
+    """
+    Stack the per level values summed by the planning table in a single
+    (metrics, levels, hexagons) float32 block, see TABLE_METRICS. Missing values
+    are set to 0, as pandas .sum() skips them.
 
-    # Number of chairs per classroom 
-    # Source: https://normativasconselhos.mec.gov.br/normativa/pdf/CEE-PA_RESOLUC387C383O20001.201020REGULAMENTAC387C383O20EDUC.20BAS.20atualizada20em2001.06.2015_0.pdf
-    # Creche/Daycare (0 to 1 years) - 8 students per classroom (NOT CONSIDERED)
-    # Creche/Daycare (1 to 3 years) - 15 students per classroom
-    # Pré-Escola/Pre-Kindergarten (4 to 5 years) - 25 students per classroom
-    # Anos Iniciais do Ensino Fundamental/Elementary School (6 to 10 years) - 35 students per classroom
-    # Anos Finais do Ensino Fundamental/Middle School (11 to 14 years) - 40 students per classroom
-    # Ensino Médio/High School (15 to 17 years) - 40 students per classroom
+    The hexagons are the last (contiguous) axis, so the rows of a municipality are
+    a zero-copy slice of the block. The block is float32 like the hexagons (half the
+    memory read by each reduction), the sums accumulate in float64.
+    """
+    def level_columns(pattern):
+        return df[[pattern.format(level) for level in education_levels]].to_numpy(dtype=np.float32).T
+
+    prop = level_columns("QT_MAT_{}_PROP")
+    block = np.stack([
+        level_columns("pop_{}"),
+        level_columns("QT_MAT_{}"),
+        level_columns("PRIVATE_QT_MAT_{}"),
+        level_columns("QT_MAT_{}_INT"),
+        df["QT_MAT_BAS_N"].to_numpy(dtype=np.float32) * prop,
+        df["QT_SALAS_UTILIZADAS"].to_numpy(dtype=np.float32) * prop,
+    ])
+    block[np.isnan(block)] = 0
+    return np.ascontiguousarray(block)
 
-    num_chairs = [15, 25, 35, 40, 40]
-    main_table.loc["Número Total de Vagas por Sala"] = num_chairs
 
-    # Number of classrooms needed in total
-    main_table.loc["Número de Salas Necessárias"] = np.ceil(main_table.loc["Número Total de Vagas Necessárias"] / num_chairs)
+level_block = build_level_block(hex_gdf)
 
-    # Actual number of classrooms
-    main_table.loc["Número de Salas Existentes"] = [np.ceil((filtered_hexs["QT_SALAS_UTILIZADAS"] * filtered_hexs[f"QT_MAT_{level}_PROP"]).sum()) for level in education_levels]
 
-    # Number of classrooms needed in each level
-    main_table.loc["Número de Novas Salas Necessárias"] = np.ceil(
-        np.maximum(main_table.loc["Número de Salas Necessárias"] - main_table.loc["Número de Salas Existentes"], 0)
-    )
+def table_from_sums(sums):
+    """
+    Derive the rows of the planning table from the per level sums.
+
+    Parameters
+    ----------
+    sums : numpy.ndarray
+        (metrics, levels, groups) array with the sums of the level block of each
+        group of hexagons (e.g. municipality)
+
+    Returns
+    -------
+    numpy.ndarray
+        (rows, levels, groups) array with the values of TABLE_ROWS
+    """
+    pop, mat, private, mat_int, mat_noc, salas = sums
+    daytime = np.isin(education_levels, DAYTIME_LEVELS)[:, np.newaxis]
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # A - population on each level
+        pop_rounded = np.round(pop, 0)
+        # A1 - % population outside of school
+        pct_not_in_school = (1 - mat / pop) * 100
+        # A2 - % students in private schoools
+        pct_private = private / pop * 100
+        # B - Total # of students in the public system (CALCULATED)
+        students_public = pop_rounded * (1 - pct_not_in_school / 100 - pct_private / 100)
+        # percentage of students in integral time (Tempo Integral)
+        pct_int = 100 * (mat_int / mat)
+        # percentage of students in nocturnal time (Tempo Noturno)
+        pct_noc = np.where(daytime, 0, 100 * (mat_noc / mat))
+
+    # total number of students * (1 + percentage of students in integral time) * (1 - percentage of students in nocturnal time)
+    total_places = students_public * (1 + pct_int / 100) * (1 - pct_noc / 100)
+    num_chairs = np.broadcast_to(NUM_CHAIRS[:, np.newaxis], pop.shape)
+    # Number of classrooms needed in total, the actual number and the new ones needed in each level
+    salas_needed = np.ceil(total_places / num_chairs)
+    salas_existing = np.ceil(salas)
+    salas_new = np.ceil(np.maximum(salas_needed - salas_existing, 0))
+
+    return np.stack([
+        pop_rounded,
+        pct_not_in_school,
+        pct_private,
+        students_public,
+        pct_int,
+        pct_noc,
+        total_places,
+        num_chairs,
+        salas_needed,
+        salas_existing,
+        salas_new,
+    ])
 
+
+def format_table(values):
+    """
+    (rows, levels) array of TABLE_ROWS values to the DataFrame shown in the app.
+    """
+    main_table = pd.DataFrame(data=values, columns=education_levels, index=TABLE_ROWS)
     main_table.reset_index(inplace=True)
 
     # Fix column names with education_levels_short_labels
@@ -258,19 +261,51 @@ def calculate_table_data(name_muni=None):
     return main_table.round(2)
 
 
-def calculate_extra_salas(name_muni, selected_variables, rows, hex_res):
+def calculate_table_data(name_muni=None):
 
-    # Visualize the results for the selected municipality
     if name_muni and "name_muni" in hex_gdf.columns:
-        muni_hexagons = hex_gdf[hex_gdf["name_muni"] == name_muni]
+        print("Selected municipality:", name_muni)
+        start, stop = municipality_index.get(name_muni, (0, 0))
     else:
-        muni_hexagons = hex_gdf.copy()
-        print("muni_hexagons", muni_hexagons.shape)
-        # muni_hexagons = gpd.GeoDataFrame(hex_gdf.drop(columns=["geometry"]).values, geometry=hex_gdf.geometry, crs="EPSG:4326")
+        print("No municipality selected")
+        start, stop = 0, len(hex_gdf)
 
-    # Calculate the number of classrooms needed based on the user defined variables
+    print("1. Filtered hexs shape", (stop - start, hex_gdf.shape[1]))
+
+    # One reduction over the hexagons of the municipality for all the metrics and levels
+    sums = level_block[:, :, start:stop].sum(axis=2, dtype=np.float64)
+
+    return format_table(table_from_sums(sums[:, :, np.newaxis])[:, :, 0])
+
+
+def calculate_all_table_data():
+    """
+    Planning table of every municipality in a single pass over the level block.
+
+    Returns
+    -------
+    dict
+        Table of each municipality (as returned by calculate_table_data)
+    """
+    names = list(municipality_index)
+    starts = [municipality_index[name][0] for name in names]
+    if not names:
+        return {}
+
+    # Municipalities are contiguous slices of the block, so their sums are one reduceat
+    sums = np.add.reduceat(level_block, starts, axis=2, dtype=np.float64)
+    values = table_from_sums(sums)
+
+    return {name: format_table(values[:, :, i]) for i, name in enumerate(names)}
+
+
+def parse_table_rows(rows):
+    """
+    DataTable rows of the planning table to a DataFrame indexed by the row labels,
+    with the education levels as (float) columns.
+    """
     main_table = pd.DataFrame(rows)
-    
+
     # Set old columns names
     if len(main_table.columns) == 6:
         main_table.columns = ["index"] + education_levels
@@ -279,11 +314,51 @@ def calculate_extra_salas(name_muni, selected_variables, rows, hex_res):
 
     main_table.set_index(main_table.columns[0], inplace=True)
     main_table.loc[:, education_levels] = main_table[education_levels].astype(float).values
+    return main_table
+
+
+# Rows of the planning table used by calculate_extra_salas, editing the other rows
+# does not change the map
+MAP_TABLE_ROWS = [
+    "Número Total de Alunos em Escolas Publicas",
+    "Porcentagem de Alunos em Tempo Integral (%)",
+    "Porcentagem de Alunos em Período Noturno (%)",
+    "Número Total de Vagas por Sala",
+]
+
+
+def extra_salas_cache_key(name_muni, selected_variables, rows, hex_res):
+    """
+    Cache key of the calculate_extra_salas results: the municipality, the values of
+    the table rows it uses (rounded, so equal tables give equal keys), the sorted
+    education levels and the hexagon resolution.
+    """
+    table_params = parse_table_rows(rows).loc[MAP_TABLE_ROWS, education_levels]
+    table_params = tuple(np.round(table_params.to_numpy(dtype=np.float64), 6).ravel().tolist())
+    if isinstance(selected_variables, str):
+        selected_variables = [selected_variables]
+    levels = tuple(sorted(selected_variables or []))
+    return ("extra_salas", name_muni or None, table_params, levels, int(hex_res))
+
+
+def calculate_extra_salas(name_muni, selected_variables, rows, hex_res):
+
+    # Visualize the results for the selected municipality
+    if name_muni and "name_muni" in hex_gdf.columns:
+        # Copy the slice since the new columns are added below
+        muni_hexagons = get_municipality_hexagons(name_muni).copy()
+    else:
+        muni_hexagons = hex_gdf.copy()
+        print("muni_hexagons", muni_hexagons.shape)
+        # muni_hexagons = gpd.GeoDataFrame(hex_gdf.drop(columns=["geometry"]).values, geometry=hex_gdf.geometry, crs="EPSG:4326")
+
+    # Calculate the number of classrooms needed based on the user defined variables
+    main_table = parse_table_rows(rows)
 
     print("Recalculating the number of classrooms needed based on the user defined variables on the table ... ", end="")
     for level in education_levels:
-        # Calculate the proportion of students in each hexagon
-        prop_mat = muni_hexagons[f"QT_MAT_{level}"] / muni_hexagons[f"QT_MAT_{level}"].sum() 
+        # Calculate the proportion of students in each hexagon (float32 counts, float64 total)
+        prop_mat = muni_hexagons[f"QT_MAT_{level}"] / np.nansum(muni_hexagons[f"QT_MAT_{level}"].to_numpy(), dtype=np.float64)
         # Calculate the total number of students in each hexagon
         total_qt_alumnos = prop_mat * main_table.loc["Número Total de Alunos em Escolas Publicas", level] 
         # Calculate the total number of chairs needed in each hexagon
@@ -320,8 +395,8 @@ def calculate_extra_salas(name_muni, selected_variables, rows, hex_res):
 
     # Change the hexagon resolution based on the user input (hex_res)
 
-    # Check the current resolution of the hexagons
-    current_hex_res = h3.h3_get_resolution(muni_hexagons.hex.iloc[0])
+    # Check the current resolution of the hexagons (uint64 ids, see data.schema)
+    current_hex_res = h3.h3_get_resolution(int_to_h3(muni_hexagons.hex.iloc[:1])[0])
     
     print(f"Current hexagon resolution: {current_hex_res}")
 
@@ -337,10 +412,10 @@ def calculate_extra_salas(name_muni, selected_variables, rows, hex_res):
         agg = {f"QT_SALAS_NECESARIAS_EXTRA_{level}": "sum" for level in education_levels} | {"SalasNecessariasAcum": "sum"}
 
         coarse_hex_col = "hex_{}".format(hex_res)
-        muni_hexagons[coarse_hex_col] = muni_hexagons["hex"].apply(
-            lambda x: h3.h3_to_parent(x, hex_res)
-        )
-        dfc = muni_hexagons.groupby([coarse_hex_col]).agg(agg).reset_index()
+        # Integer groupby on the precomputed parent ids (see data.py)
+        dfc = muni_hexagons.groupby(f"hex_id_{hex_res}").agg(agg)
+        dfc.insert(0, coarse_hex_col, int_to_h3(dfc.index.values))
+        dfc = dfc.reset_index(drop=True)
         
         print("Done")
 
@@ -350,12 +425,117 @@ def calculate_extra_salas(name_muni, selected_variables, rows, hex_res):
     print("COLUMNS IN HEXAGON DATAFRAME", muni_hexagons.columns)
 
     if 'hex' in muni_hexagons.columns:
-        # Replace 'hex' to f"hex_{hex_res}"
-        muni_hexagons.rename(columns={"hex": f"hex_{hex_res}"}, inplace=True)
+        # Replace 'hex' to f"hex_{hex_res}", with the ids as strings for the map
+        muni_hexagons[f"hex_{hex_res}"] = int_to_h3(muni_hexagons.pop("hex"))
 
         return muni_hexagons
 
-initial_table_data = calculate_table_data(INITIAL_MUNICIPALITY)
+# Memoized planning tables and hexagon results, shared by all the sessions (the
+# cached DataFrames must not be modified in place)
+RESULTS_CACHE_MAX_BYTES = 512 * 1024**2
+results_cache = LRUCache(RESULTS_CACHE_MAX_BYTES, name="results")
+
+
+def get_table_data(name_muni=None):
+    """
+    Memoized calculate_table_data.
+    """
+    return results_cache.get_or_compute(("table", name_muni or None), calculate_table_data, name_muni)
+
+# Hexagon results of the map, read back by the report using the token kept in the
+# browser (set RESULT_STORE_URL to "disk:<directory>" or a redis:// url to share it
+# between workers)
+result_store = make_result_store(os.environ.get("RESULT_STORE_URL", "memory"))
+
+
+# Reverse geocoding of the report hexagons: "nominatim" (with the offline backend
+# as fallback) or "offline" (municipality polygons only, no network requests)
+GEOCODER_BACKEND = os.environ.get("GEOCODER_BACKEND", "nominatim")
+NOMINATIM_EMAIL = "claudio@autodash.org"
+offline_geocoding_backend = OfflineMunicipalityBackend("data/para_muni.geojson")
+geocoder = Geocoder(
+    NominatimBackend(NOMINATIM_EMAIL) if GEOCODER_BACKEND == "nominatim" else offline_geocoding_backend,
+    cache=GeocodingCache(os.environ.get("GEOCODER_CACHE_PATH", "data/geocoding_cache.sqlite")),
+    fallback=offline_geocoding_backend,
+)
+
+
+def get_extra_salas(name_muni, selected_variables, rows, hex_res):
+    """
+    Memoized calculate_extra_salas, see extra_salas_cache_key.
+
+    Returns
+    -------
+    selected_hexagons : pandas.DataFrame
+        Hexagons that need new classrooms
+    result_token : str
+        Token of the hexagons in result_store
+    """
+    key = extra_salas_cache_key(name_muni, selected_variables, rows, hex_res)
+    selected_hexagons = results_cache.get_or_compute(key, calculate_extra_salas, name_muni, selected_variables, rows, hex_res)
+    return selected_hexagons, result_store.put(selected_hexagons, key=key)
+
+
+def create_map_figure(selected_hexagons, hex_size, value_range, selected_municipality):
+    """
+    Choropleth map of the hexagons with a number of new classrooms needed within
+    `value_range`.
+
+    Returns
+    -------
+    filtered_map_figure : plotly.graph_objects.Figure
+        Map figure
+    selected_hexagons_filtered : pandas.DataFrame
+        Hexagons shown in the map
+    """
+    max_value = selected_hexagons["SalasNecessariasAcum"].max()
+
+    # Filter the DataFrame based on the range slider values
+    if value_range is not None:
+        print(f"Filtering the DataFrame based on the range slider values: {value_range}")
+        selected_hexagons_filtered = selected_hexagons[selected_hexagons["SalasNecessariasAcum"].between(*value_range)]
+        print("selected_hexagons_filtered SHAPE", selected_hexagons_filtered.shape)
+    else:
+        selected_hexagons_filtered = selected_hexagons
+
+    # Create the H3 geometry (GeoJSON built directly from the hexagon ids)
+    start_time = time.time()
+    h3_geojson, h3_center = get_h3_geojson(
+        selected_hexagons_filtered[f"hex_{hex_size}"],
+        selected_hexagons_filtered.index,
+    )
+    print("Time to create H3 geometry:", time.time() - start_time)
+
+    # Create the map figure
+    print("##### hex_size:", hex_size)
+    print("##### selected_hexagons.columns:", selected_hexagons.columns)
+    # Hover title (assign returns a new frame, selected_hexagons is cached)
+    selected_hexagons_filtered = selected_hexagons_filtered.assign(hover_name="Novas Salas Necessárias")
+    filtered_map_figure = px.choropleth_map(
+        selected_hexagons_filtered,
+        geojson=h3_geojson,
+        locations=selected_hexagons_filtered.index,
+        color="SalasNecessariasAcum",
+        color_continuous_scale="RdYlGn_r",
+        range_color=[0, max_value],
+        opacity=0.5,
+        hover_name="hover_name",
+        hover_data={f"QT_SALAS_NECESARIAS_EXTRA_{level}": True for level in education_levels} | {"SalasNecessariasAcum": False, f"hex_{hex_size}": False},
+        map_style="carto-positron",
+        labels={f"QT_SALAS_NECESARIAS_EXTRA_{level}": education_levels_labels[level] for level in education_levels} | {"SalasNecessariasAcum": "Novas Salas Necessárias"},
+        zoom=10 if selected_municipality else 6,
+        center=h3_center,
+    )
+    # Set makerlinewidth to 0 to remove the white border around the hexagons
+    filtered_map_figure.update_traces(marker=dict(line_width=0))
+
+    # Remove margins
+    filtered_map_figure.update_layout(margin=dict(l=0, r=0, t=0, b=0))
+
+    return filtered_map_figure, selected_hexagons_filtered
+
+
+initial_table_data = get_table_data(INITIAL_MUNICIPALITY)
 
 user_defined_rows = [1,2,4,5,7,9]
 calculated_rows = [0,3,6,8,10]
@@ -376,6 +556,14 @@ app = dash.Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP], suppress_
 
 server = app.server
 
+
+@server.route("/cache-stats")
+def cache_stats():
+    """
+    Hit/miss/eviction counters of the results cache.
+    """
+    return flask.jsonify(results_cache.stats())
+
 # Layout
 
 app_header = dbc.Row(
@@ -661,6 +849,8 @@ app_control_panel = [
                         ), width=6),
                         dbc.Col(dcc.Graph(id="filtered-map-graph"), width=6),
                         html.Div(id="hexagons-in-selected-range"),
+                        # Token of the map results in result_store, read by the report
+                        dcc.Store(id="map-result-token"),
                     ]),
 
                     html.Hr(),
@@ -755,7 +945,7 @@ def calculate_table(selected_municipality):
     print("selected_municipality", selected_municipality)
     print("--------------------------------")
 
-    table_data = calculate_table_data(selected_municipality)
+    table_data = get_table_data(selected_municipality)
     tooltips = calculate_tooltips(table_data)
     
     return table_data.to_dict("records"), tooltips
@@ -813,7 +1003,7 @@ def update_columns(timestamp, rows):
     prevent_initial_call=True,
 )
 def reset_table(n_clicks, selected_municipality):
-    return calculate_table_data(selected_municipality).to_dict("records")
+    return get_table_data(selected_municipality).to_dict("records")
 
 
 # Constraint hexagon res to be 5 if no municipality is selected
@@ -985,6 +1175,7 @@ def constraint_hexagon_res(selected_municipality, hex_res):
         Output("value-range-slider", "max"),
         Output("value-range-slider", "marks"),
         Output("hexagons-in-selected-range", "children"),
+        Output("map-result-token", "data"),
     ],
     [
         State("municipality-dropdown", "value"),
@@ -1012,12 +1203,14 @@ def update_filtered_map(
     # Process the data 
     print("update_map > before calculate_extra_salas > computed_table_data", computed_table_data)
     print("update_map > before calculate_extra_salas > hex_gdf.shape", hex_gdf.shape)
-    selected_hexagons = calculate_extra_salas(
+    # Moving the range slider only filters the cached results below
+    selected_hexagons, result_token = get_extra_salas(
         selected_municipality, 
         selected_education_levels, 
         computed_table_data, 
         hex_size
     )
+    print("Results cache:", results_cache.stats())
     print("update_map > calculate_extra_salas done > selected_hexagons.shape", selected_hexagons.shape)
     print("type(selected_hexagons)", type(selected_hexagons))
 
@@ -1094,57 +1287,16 @@ def update_filtered_map(
 
     print("Process map ...", end="")
 
-    # Filter the DataFrame based on the range slider values
-    if value_range is not None:
-        print(f"Filtering the DataFrame based on the range slider values: {value_range}")
-        selected_hexagons_filtered = selected_hexagons[selected_hexagons["SalasNecessariasAcum"].between(*value_range)]
-        print("selected_hexagons_filtered SHAPE", selected_hexagons_filtered.shape)
-    else:
-        selected_hexagons_filtered = selected_hexagons
-
-    # Create the H3 geometry
-    start_time = time.time()
-    h3_geom = gpd.GeoSeries(
-        data=get_h3_geometry(selected_hexagons_filtered[f"hex_{hex_size}"]), 
-        index=selected_hexagons_filtered.index,
-        crs="EPSG:4326"
+    filtered_map_figure, selected_hexagons_filtered = create_map_figure(
+        selected_hexagons, hex_size, value_range, selected_municipality
     )
-    print("Time to create H3 geometry:", time.time() - start_time)
-
-    # Create the map figure
-    print("##### hex_size:", hex_size)
-    print("##### selected_hexagons.columns:", selected_hexagons.columns)
-    selected_hexagons_filtered["hover_name"] = "Novas Salas Necessárias" # Hover title
-    filtered_map_figure = px.choropleth_map(
-        selected_hexagons_filtered,
-        geojson=h3_geom.__geo_interface__,
-        locations=selected_hexagons_filtered.index,
-        color="SalasNecessariasAcum",
-        color_continuous_scale="RdYlGn_r",
-        range_color=[0, max_value],
-        opacity=0.5,
-        hover_name="hover_name",
-        hover_data={f"QT_SALAS_NECESARIAS_EXTRA_{level}": True for level in education_levels} | {"SalasNecessariasAcum": False, f"hex_{hex_size}": False},
-        map_style="carto-positron",
-        labels={f"QT_SALAS_NECESARIAS_EXTRA_{level}": education_levels_labels[level] for level in education_levels} | {"SalasNecessariasAcum": "Novas Salas Necessárias"},
-        zoom=10 if selected_municipality else 6,
-        center={
-            "lat": h3_geom.centroid.y.mean(),
-            "lon": h3_geom.centroid.x.mean(),
-        }
-    )
-    # Set makerlinewidth to 0 to remove the white border around the hexagons
-    filtered_map_figure.update_traces(marker=dict(line_width=0))
-
-    # Remove margins
-    filtered_map_figure.update_layout(margin=dict(l=0, r=0, t=0, b=0))
 
     print("Done Process map")
 
     # Show number of hexagons in the selected range
     hexagons_in_selected_range = dcc.Markdown(f"#### {len(selected_hexagons_filtered)} Hexágonos selecionados precisam de entre {value_range[0]} e {value_range[1]} novas salas")
 
-    return filtered_map_figure, histogram_figure, int(min_value), int(max_value), marks, hexagons_in_selected_range
+    return filtered_map_figure, histogram_figure, int(min_value), int(max_value), marks, hexagons_in_selected_range, result_token
 
 # callback for showing a spinner within dbc.Button()
 app.clientside_callback(
@@ -1171,7 +1323,7 @@ app.clientside_callback(
         State('computed-table', 'data'),
         State('computed-table', 'tooltip_data'),
         # State("map-data-store", "data"), 
-        State("filtered-map-graph", "figure"),
+        State("map-result-token", "data"),
         State("value-range-slider", "value"),
         # State("map-graph", "figure"),
         State("municipality-dropdown", "value"),
@@ -1185,7 +1337,7 @@ def create_report(
         selected_education_levels, 
         computed_table_data, 
         table_tooltips, 
-        figure_data, 
+        result_token, 
         value_range, 
         # map_figure, 
         selected_municipality, 
@@ -1197,35 +1349,22 @@ def create_report(
     if selected_municipality is None and hex_size > MIN_HEX_SIZE_AT_STATE_LEVEL:
         raise PreventUpdate
 
-    if figure_data is None:
-        raise PreventUpdate    
+    # Hexagons of the map, stored server-side by update_filtered_map
+    selected_hexagons = result_store.get(result_token)
+    if selected_hexagons is None:
+        raise PreventUpdate
     
     if isinstance(selected_education_levels, str):
         selected_education_levels = [selected_education_levels]
 
-    # Load the DataFrame from the figure data
-    cleaned_features = [{
-        "type": "Feature",
-        "geometry": feature['geometry'],
-        "properties": {}
-    } for feature in figure_data['data'][0]['geojson']['features']]
-    filtered_df = gpd.GeoDataFrame.from_features(cleaned_features)
-
-    # # Parse the index
-    # raw_index = figure_data['data'][0]['locations']
-    # if isinstance(raw_index, list):
-    #     index = pd.Index(raw_index)
-    # elif isinstance(raw_index, dict):
-    #     index = pd.Index(raw_index['_inputArray'].values())
-    # else:
-    #     print("ERROR: raw_index type not recognized")
-    #     index = pd.Index(range(len(filtered_df)))
-    # print("filtered_df", filtered_df)
-    # print("index", index)
-    # filtered_df.index = index
+    figure_data, selected_hexagons_filtered = create_map_figure(
+        selected_hexagons, hex_size, value_range, selected_municipality
+    )
 
+    # Rebuild the hexagon geometries from their ids
     columns = [*[f"QT_SALAS_NECESARIAS_EXTRA_{level}"  for level in education_levels], "SalasNecessariasAcum", f"hex_{hex_size}"]
-    filtered_df[columns] = figure_data['data'][0]['customdata']
+    filtered_df = gpd.GeoDataFrame(geometry=get_h3_polygons(selected_hexagons_filtered[f"hex_{hex_size}"]))
+    filtered_df[columns] = selected_hexagons_filtered[columns].to_numpy()
 
     # INPUT TABLE
     input_table = dash_table.DataTable(
@@ -1280,27 +1419,10 @@ def create_report(
         # # salas necessária (Fundamental)
         # # salas necessária (Ensino Médio)
 
-        # Use h3 library to get a pair of lat, lon coordinates using the hexagon index
-        hexagon_latlon_coords = df[f"hex_{hex_size}"].apply(lambda x: h3.h3_to_geo(x))
-        # Use requests library to query the Nominatim API to get the address based on the lat, lon coordinates
-        import requests
-        
-        def nominatim_reverse_geocode(coordinate):
-            url = "https://nominatim.openstreetmap.org/reverse"
-            params = {
-                "format": "json",
-                "lat": coordinate[0],
-                "lon": coordinate[1],
-                # Pass the user agent to avoid the 429 error
-                "email": "claudio@autodash.org"
-            }
-            response = requests.get(url, params=params)
-            # Sleep for 1 second to avoid the rate limit
-            time.sleep(0.1)
-            return response.json()
-
-        # Get the address for each hexagon
-        hexagon_addresses = hexagon_latlon_coords.apply(nominatim_reverse_geocode)
+        # Get the address of each hexagon (at its center), see geocoding.py
+        start_time = time.time()
+        hexagon_addresses = pd.Series(geocoder.reverse_h3(df[f"hex_{hex_size}"]), index=df.index)
+        print("Time to geocode the hexagons:", time.time() - start_time)
         # print("HEXAGON ADDREESS EXAMPLE", hexagon_addresses.iloc[0])
         # "road": "Travessa S 1",
         # "suburb": "Campina de Icoaraci",
@@ -1337,8 +1459,8 @@ def create_report(
                 return "Não encontrados"
 
         # Extract the address from the JSON response
-        hexagon_short_address = hexagon_addresses.apply(lambda x: build_short_address(x["address"]))
-        hexagon_city_state = hexagon_addresses.apply(lambda x: build_city_state(x["address"]))
+        hexagon_short_address = hexagon_addresses.apply(build_short_address)
+        hexagon_city_state = hexagon_addresses.apply(build_city_state)
 
         # Add the address column to the DataFrame
         df["short_address"] = hexagon_short_address
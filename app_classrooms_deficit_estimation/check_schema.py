@@ -0,0 +1,171 @@
+"""
+Full data regression check of the compact dtypes of the hexagons (see
+data.schema, and test_schema.py for the same check on a synthetic table): the
+planning tables (calculate_table_data) and the per-hexagon classrooms
+(calculate_extra_salas) computed by the app from the compact table must match the
+ones computed from the float64 table it was converted from, within a relative
+tolerance.
+
+The values rounded up to whole classrooms (or rounded to whole people) may differ
+by one where the float64 value is an integer within the tolerance, since float32
+can round it to either side.
+
+Usage (optional, needs the float64 table data/25022025_dashboard_hexs.parquet, after
+data.py writes the compact table):
+    python check_schema.py [rtol]
+"""
+
+import sys
+
+import numpy as np
+import pandas as pd
+
+import app
+from data import add_parent_columns, build_municipality_index, h3_to_int, required_columns
+
+REFERENCE_PATH = "data/25022025_dashboard_hexs.parquet"
+
+# Outputs rounded to integers, see table_from_sums and calculate_extra_salas
+ROUNDED_TABLE_ROWS = [
+    "População Estimada",
+    "Número de Salas Necessárias",
+    "Número de Salas Existentes",
+    "Número de Novas Salas Necessárias",
+]
+EXTRA_COLUMNS = [f"QT_SALAS_NECESARIAS_EXTRA_{level}" for level in app.education_levels]
+
+
+def prepare_reference(hex_df):
+    """
+    The float64 hexagons the compact table was converted from (as read from the
+    Parquet file), with only the H3 ids converted to uint64 (as
+    calculate_extra_salas expects), in the row order and with the column names of
+    the app.
+    """
+    hex_df = add_parent_columns(hex_df[required_columns].copy())
+    hex_df["hex"] = h3_to_int(hex_df["hex"])
+    hex_df = hex_df.sort_values("name_muni", kind="stable").reset_index(drop=True)
+    return hex_df.rename(columns=app.POPULATION_COLUMNS)
+
+
+def use_hexagons(hex_df):
+    """
+    Point the app to another table of hexagons.
+    """
+    app.hex_gdf = hex_df
+    app.municipality_index = build_municipality_index(hex_df)
+    app.level_block = app.build_level_block(hex_df)
+
+
+def near_integer(values, rtol):
+    return np.abs(values - np.round(values)) <= rtol * np.maximum(np.abs(values), 1)
+
+
+def compare(actual, expected, rtol, rounded=None, unrounded=None):
+    """
+    Mask of the values of `actual` that match `expected` within `rtol`. The
+    `rounded` ones may also differ by one where `unrounded` (the float64 value
+    before rounding) is an integer within `rtol`.
+    """
+    actual = np.asarray(actual, dtype=np.float64)
+    expected = np.asarray(expected, dtype=np.float64)
+    ok = np.isclose(actual, expected, rtol=rtol, atol=1e-6, equal_nan=True)
+    if rounded is not None:
+        flip = rounded & (np.abs(actual - expected) <= 1) & near_integer(unrounded, rtol)
+        ok |= flip
+    return ok
+
+
+def check_outputs(reference_df, hex_df, municipalities=None, rtol=1e-5):
+    """
+    Compare the planning table and the per-hexagon classrooms of each municipality
+    (all of them by default, and the whole state) computed from `hex_df` against
+    the ones from `reference_df`. Both tables are computed from the reference
+    planning table, so the hexagons differ only by the dtypes. Raises an
+    AssertionError with the outputs that do not match.
+
+    Returns
+    -------
+    pandas.DataFrame
+        Number of hexagons compared and the maximum relative difference of the
+        continuous outputs of each municipality
+    """
+    if municipalities is None:
+        municipalities = list(build_municipality_index(reference_df)) + [None]
+
+    failed = []
+    summary = {}
+    for name_muni in municipalities:
+        outputs = []
+        for df in (reference_df, hex_df):
+            use_hexagons(df)
+            table = app.calculate_table_data(name_muni)
+            if not outputs:
+                rows = table.to_dict("records")
+            outputs.append((table, app.calculate_extra_salas(name_muni, EXTRA_COLUMNS, rows, 8)))
+        (expected_table, expected), (actual_table, actual) = outputs
+
+        # Planning table, the rounded rows may flip at integers
+        levels = [app.education_levels_short_labels[level] for level in app.education_levels]
+        is_rounded = expected_table.iloc[:, 0].isin(ROUNDED_TABLE_ROWS).to_numpy()[:, np.newaxis]
+        ok = compare(
+            actual_table[levels],
+            expected_table[levels],
+            rtol=1e-3,  # rounded to 2 decimals
+            rounded=np.broadcast_to(is_rounded, expected_table[levels].shape),
+            unrounded=expected_table[levels].to_numpy(dtype=np.float64),
+        )
+        if not ok.all():
+            failed.append(f"{name_muni}: table rows {list(expected_table.iloc[~ok.all(axis=1), 0])}")
+
+        # Per hexagon, the ones with classrooms needed on either side
+        merged = expected.merge(
+            actual, on="hex_8", how="outer", suffixes=("", "_compact"), indicator=True
+        )
+        both = (merged["_merge"] == "both").to_numpy()
+        max_rel = 0.0
+        for level in app.education_levels:
+            total = f"QT_SALAS_NECESARIAS_TOTAL_{level}"
+            existing = f"QT_SALAS_ACTUALES_{level}"
+            extra = f"QT_SALAS_NECESARIAS_EXTRA_{level}"
+            for column in [total, existing]:
+                ok = compare(merged[f"{column}_compact"], merged[column], rtol)
+                if not ok[both].all():
+                    failed.append(f"{name_muni}: {column} of {(~ok[both]).sum()} hexagons")
+                expected_values = merged.loc[both, column].abs().to_numpy(dtype=np.float64)
+                differences = np.abs(
+                    merged.loc[both, f"{column}_compact"] - merged.loc[both, column]
+                ).to_numpy(dtype=np.float64)
+                nonzero = expected_values > 0
+                max_rel = max(
+                    max_rel, np.nanmax(differences[nonzero] / expected_values[nonzero], initial=0.0)
+                )
+
+            # The hexagons only on one side flip between 0 and 1 classrooms
+            unrounded = (merged[total] - merged[existing]).fillna(
+                merged[f"{total}_compact"] - merged[f"{existing}_compact"]
+            )
+            ok = compare(
+                merged[f"{extra}_compact"].fillna(0),
+                merged[extra].fillna(0),
+                rtol,
+                rounded=np.ones(len(merged), dtype=bool),
+                unrounded=unrounded.to_numpy(dtype=np.float64),
+            )
+            if not ok.all():
+                failed.append(f"{name_muni}: {extra} of {(~ok).sum()} hexagons")
+
+        summary[name_muni or "Total"] = {"hexagons": len(merged), "max_rel_diff": max_rel}
+
+    assert not failed, f"Outputs differ more than rtol={rtol}: {failed}"
+    return pd.DataFrame(summary).T
+
+
+if __name__ == "__main__":
+    rtol = float(sys.argv[1]) if len(sys.argv) > 1 else 1e-5
+    compact_df = app.hex_gdf
+    reference_df = prepare_reference(pd.read_parquet(REFERENCE_PATH, columns=required_columns))
+    summary = check_outputs(reference_df, compact_df, rtol=rtol)
+    use_hexagons(compact_df)
+    print("Outputs match the float64 table:")
+    print(summary.to_string())
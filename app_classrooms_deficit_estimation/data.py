@@ -1,4 +1,9 @@
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from h3_utils import h3_to_int, h3_to_parent_int
 
 # Read only required columns to save memory
 required_columns = [
@@ -16,9 +21,163 @@ required_columns = [
     ## NEW PRIVATE SCHOOL VARIABLES ##
     "PRIVATE_QT_MAT_INF_CRE", "PRIVATE_QT_MAT_INF_PRE", "PRIVATE_QT_MAT_FUND_AF", "PRIVATE_QT_MAT_FUND_AI", "PRIVATE_QT_MAT_MED",
     ## NEW PRIVATE SCHOOL VARIABLES ##
-    "hex", 
+    "hex",
     # "geometry" # Do not include geometry to save memory (from ~200MB to ~15MB)
 ]
 
-hex_df = pd.read_parquet("data/25022025_dashboard_hexs.parquet", columns=required_columns)
-hex_df.to_parquet("data/25022025_dashboard_hexs_light.parquet")
+# Resolutions of the hexagon size slider, the data is stored at the finest one
+hex_resolutions = [5, 6, 7, 8]
+# uint64 H3 id of the parent hexagon at each resolution (hex_id_8 is the hexagon itself)
+parent_columns = [f"hex_id_{res}" for res in hex_resolutions]
+
+
+# Compact dtypes of the dashboard hexagons: float32 counts and proportions (exact
+# integers up to 2**24, far above the counts of a hexagon), the municipality as a
+# category and the H3 ids as uint64. The sums of the app accumulate in float64.
+schema = {
+    **{column: "float32" for column in required_columns if column not in ("name_muni", "hex")},
+    "name_muni": "category",
+    "hex": "uint64",
+    **{column: "uint64" for column in parent_columns},
+}
+
+
+def enforce_schema(hex_df):
+    """
+    Convert the columns of `schema` present in `hex_df` to their compact dtypes
+    (the H3 ids from their hexadecimal string form), validate them and report the
+    bytes per row. Columns already in their dtype are not copied.
+
+    Returns
+    -------
+    pandas.DataFrame
+        New DataFrame with the compact dtypes
+    """
+    bytes_before = bytes_per_row(hex_df)
+    converted = {}
+    for column, dtype in schema.items():
+        if column not in hex_df.columns or hex_df[column].dtype == dtype:
+            continue
+        if dtype == "uint64" and not pd.api.types.is_integer_dtype(hex_df[column]):
+            converted[column] = h3_to_int(hex_df[column])
+        else:
+            converted[column] = hex_df[column].astype(dtype)
+    hex_df = hex_df.assign(**converted)
+
+    validate_schema(hex_df)
+    print(f"Hexagons: {bytes_before:.0f} -> {bytes_per_row(hex_df):.0f} bytes per row")
+    return hex_df
+
+
+def validate_schema(hex_df, columns=None):
+    """
+    Check that the hexagons have the `columns` (by default the ones the app loads)
+    with the dtypes of `schema`, and raise a ValueError listing the ones that do not.
+    """
+    columns = required_columns + parent_columns if columns is None else columns
+    missing = [column for column in columns if column not in hex_df.columns]
+    wrong = [
+        f"{column} ({hex_df[column].dtype}, expected {schema[column]})"
+        for column in columns
+        if column in hex_df.columns and column in schema and hex_df[column].dtype != schema[column]
+    ]
+    if missing or wrong:
+        raise ValueError(
+            f"The hexagons do not match the schema. Missing columns: {missing}. "
+            f"Wrong dtypes: {wrong}"
+        )
+
+
+def bytes_per_row(hex_df):
+    """
+    In-memory bytes per hexagon, counting the strings (deep).
+    """
+    return hex_df.memory_usage(index=False, deep=True).sum() / max(len(hex_df), 1)
+
+
+def check_totals(reference_df, hex_df, rtol=1e-5):
+    """
+    Regression check of the compact dtypes: the float64 totals of every numeric
+    column of `schema` (overall and by municipality) of `hex_df` must match the
+    ones of `reference_df` (e.g. the float64 table it was converted from) within a
+    relative tolerance. Raises an AssertionError with the columns that do not. The
+    outputs of the app are compared hexagon by hexagon by test_schema.py (on a
+    synthetic table) and check_schema.py (on the full data).
+    """
+    columns = [
+        column for column, dtype in schema.items()
+        if dtype == "float32" and column in reference_df.columns and column in hex_df.columns
+    ]
+
+    def totals(df):
+        values = df[columns].to_numpy(dtype=np.float64)
+        groups = pd.Series(df["name_muni"].astype(str).to_numpy())
+        by_muni = pd.DataFrame(values, columns=columns).groupby(groups).sum()
+        return pd.concat([by_muni, by_muni.sum().to_frame("Total").T])
+
+    expected = totals(reference_df)
+    actual = totals(hex_df).reindex(expected.index)
+    close = np.isclose(actual.to_numpy(), expected.to_numpy(), rtol=rtol, atol=1e-6)
+    failed = [column for column, ok in zip(columns, close.all(axis=0)) if not ok]
+    assert not failed, f"Totals of {failed} differ more than rtol={rtol}"
+    return actual.loc["Total"]
+
+
+def add_parent_columns(hex_df):
+    """
+    Precompute the uint64 H3 id of the parent of each hexagon at every slider
+    resolution, so the app aggregates with an integer groupby instead of calling
+    h3.h3_to_parent for each hexagon on every callback.
+    """
+    hex_ids = h3_to_int(hex_df["hex"])
+    for res, column in zip(hex_resolutions, parent_columns):
+        hex_df[column] = h3_to_parent_int(hex_ids, res)
+    return hex_df
+
+
+def write_by_municipality(hex_df, path):
+    """
+    Write the hexagons sorted by municipality, with one parquet row group per
+    municipality. Each municipality is then a contiguous slice of the table in
+    memory (see `build_municipality_index`), and readers filtering on `name_muni`
+    only read its row group (see `read_municipality`).
+    """
+    hex_df = hex_df.sort_values("name_muni", kind="stable").reset_index(drop=True)
+    table = pa.Table.from_pandas(hex_df, preserve_index=False)
+    index = build_municipality_index(hex_df)
+    with pq.ParquetWriter(path, table.schema) as writer:
+        for start, stop in index.values():
+            writer.write_table(table.slice(start, stop - start), row_group_size=stop - start)
+
+
+def build_municipality_index(hex_df):
+    """
+    Map each municipality to the (start, stop) positions of its rows in a DataFrame
+    sorted by `name_muni` (as written by `write_by_municipality`).
+    """
+    names = hex_df["name_muni"].to_numpy()
+    if len(names) == 0:
+        return {}
+    if not (names[1:] >= names[:-1]).all():
+        raise ValueError("The hexagons must be sorted by name_muni, see write_by_municipality")
+    starts = np.flatnonzero(np.r_[True, names[1:] != names[:-1]])
+    stops = np.r_[starts[1:], len(names)]
+    return {names[start]: (start, stop) for start, stop in zip(starts, stops)}
+
+
+def read_municipality(path, name_muni, columns=None):
+    """
+    Load the hexagons of a single municipality. Thanks to the row group per
+    municipality, pyarrow skips the row groups of the other municipalities using
+    their min/max statistics.
+    """
+    return pd.read_parquet(path, columns=columns, filters=[("name_muni", "==", name_muni)])
+
+
+if __name__ == "__main__":
+    reference_df = pd.read_parquet("data/25022025_dashboard_hexs.parquet", columns=required_columns)
+    hex_df = enforce_schema(add_parent_columns(reference_df.copy()))
+    totals = check_totals(reference_df, hex_df)
+    print("Totals match the float64 table:")
+    print(totals.to_string())
+    write_by_municipality(hex_df, "data/25022025_dashboard_hexs_light.parquet")
@@ -0,0 +1,284 @@
+import json
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import geopandas as gpd
+import h3
+import numpy as np
+import requests
+import shapely
+
+
+class RateLimiter:
+    """
+    Allow at most `rate` calls per second, shared by all the threads.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class NominatimBackend:
+    """
+    Reverse geocoding with the Nominatim API.
+
+    The public server allows 1 request per second (see the usage policy at
+    https://operations.osmfoundation.org/policies/nominatim/), a self-hosted server
+    can use a higher `requests_per_second` and `max_workers`.
+
+    Parameters
+    ----------
+    email : str
+        Contact email sent with the requests
+    url : str, optional
+        Reverse geocoding endpoint. Default is the public Nominatim server.
+    requests_per_second : float, optional
+        Maximum request rate. Default is 1.
+    max_workers : int, optional
+        Number of concurrent requests. Default is 2.
+    timeout : float, optional
+        Timeout of each request in seconds. Default is 10.
+    """
+
+    name = "nominatim"
+
+    def __init__(
+        self,
+        email,
+        url="https://nominatim.openstreetmap.org/reverse",
+        requests_per_second=1.0,
+        max_workers=2,
+        timeout=10,
+    ):
+        self.email = email
+        self.url = url
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.rate_limiter = RateLimiter(requests_per_second)
+        self.session = requests.Session()
+
+    def reverse(self, lat, lon):
+        self.rate_limiter.wait()
+        params = {
+            "format": "json",
+            "lat": lat,
+            "lon": lon,
+            # Pass the user agent to avoid the 429 error
+            "email": self.email,
+        }
+        response = self.session.get(self.url, params=params, timeout=self.timeout)
+        response.raise_for_status()
+        # Points without address (e.g. in a river) return {"error": ...}
+        return response.json().get("address", {})
+
+    def reverse_many(self, coords):
+        """
+        Addresses of a (N, 2) array of lat, lon coordinates, None for the ones whose
+        request failed (the others are kept).
+        """
+        def reverse_or_none(coord):
+            try:
+                return self.reverse(*coord)
+            except requests.RequestException as e:
+                print(f"Geocoding failed at {tuple(coord)}:", e)
+                return None
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(reverse_or_none, coords))
+
+
+class OfflineMunicipalityBackend:
+    """
+    Offline reverse geocoding with the municipality polygons (e.g.
+    data/para_muni.geojson). It only knows the municipality and state of each
+    point, so the addresses have "city" and "state" but no "road" or "suburb".
+
+    Parameters
+    ----------
+    path : str, optional
+        GeoJSON file with `name_muni` and `name_state` columns. Default is
+        data/para_muni.geojson.
+    """
+
+    name = "offline_municipality"
+
+    def __init__(self, path="data/para_muni.geojson"):
+        municipalities = gpd.read_file(path)
+        self.geometries = municipalities.geometry.values
+        self.cities = municipalities["name_muni"].to_numpy()
+        self.states = municipalities["name_state"].to_numpy()
+        self.tree = shapely.STRtree(self.geometries)
+
+    def reverse(self, lat, lon):
+        return self.reverse_many([(lat, lon)])[0]
+
+    def reverse_many(self, coords):
+        """
+        Addresses of a (N, 2) array of lat, lon coordinates, with one query to the
+        spatial index for all the points.
+        """
+        coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+        points = shapely.points(coords[:, 1], coords[:, 0])
+        point_idx, muni_idx = self.tree.query(points, predicate="intersects")
+
+        addresses = [{} for _ in range(len(points))]
+        # A point on the border of two municipalities keeps the first one
+        for i, j in zip(point_idx.tolist()[::-1], muni_idx.tolist()[::-1]):
+            addresses[i] = {"city": self.cities[j], "state": self.states[j]}
+        return addresses
+
+
+class GeocodingCache:
+    """
+    Persistent SQLite cache of the addresses of H3 cells, by backend.
+
+    Parameters
+    ----------
+    path : str
+        Path of the SQLite database file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS addresses (
+                backend TEXT NOT NULL,
+                hex_id TEXT NOT NULL,
+                address TEXT NOT NULL,
+                PRIMARY KEY (backend, hex_id)
+            ) WITHOUT ROWID
+            """
+        )
+        self._conn.commit()
+
+    def lookup(self, backend, hex_ids):
+        """
+        Cached addresses of a list of H3 cells, as a dict {hex_id: address}.
+        """
+        hex_ids = list(hex_ids)
+        found = {}
+        with self._lock:
+            # Query in chunks to stay below the SQLite limit of parameters
+            for start in range(0, len(hex_ids), 500):
+                chunk = hex_ids[start : start + 500]
+                rows = self._conn.execute(
+                    f"""
+                    SELECT hex_id, address FROM addresses
+                    WHERE backend = ? AND hex_id IN ({",".join("?" * len(chunk))})
+                    """,
+                    (backend, *chunk),
+                ).fetchall()
+                found.update((hex_id, json.loads(address)) for hex_id, address in rows)
+            self._conn.commit()
+        self.hits += len(found)
+        self.misses += len(hex_ids) - len(found)
+        return found
+
+    def store(self, backend, addresses):
+        """
+        Store a dict {hex_id: address}.
+        """
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO addresses VALUES (?, ?, ?)",
+                (
+                    (backend, hex_id, json.dumps(address))
+                    for hex_id, address in addresses.items()
+                ),
+            )
+            self._conn.commit()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def close(self):
+        self._conn.close()
+
+
+class Geocoder:
+    """
+    Reverse geocoding of H3 cells (at their center), with a persistent cache and
+    an optional fallback backend.
+
+    Parameters
+    ----------
+    backend : NominatimBackend or OfflineMunicipalityBackend
+        Backend used for the cells not in the cache. Any object with a `name` and a
+        `reverse_many(coords)` method returning Nominatim-like address dicts (None
+        for the failed coordinates) works.
+    cache : GeocodingCache, optional
+        Cache of previous results. Default is None.
+    fallback : optional
+        Backend used for the cells where `backend` fails (e.g. the network is down).
+        Its results are not cached. Default is None.
+    """
+
+    def __init__(self, backend, cache=None, fallback=None):
+        self.backend = backend
+        self.cache = cache
+        self.fallback = fallback
+
+    def reverse_h3(self, hex_ids):
+        """
+        Addresses of a list of H3 cells, in the same order. Cells without address
+        get an empty dict. The addresses found by the backend are cached even when
+        it fails for other cells, and only those go to the fallback.
+        """
+        hex_ids = list(hex_ids)
+        unique_ids = list(dict.fromkeys(hex_ids))
+
+        found = {}
+        if self.cache is not None:
+            found = self.cache.lookup(self.backend.name, unique_ids)
+
+        missing = [hex_id for hex_id in unique_ids if hex_id not in found]
+        if missing:
+            coords = [h3.h3_to_geo(hex_id) for hex_id in missing]
+            try:
+                results = self.backend.reverse_many(coords)
+            except requests.RequestException as e:
+                # Backends failing as a whole
+                print("Geocoding failed:", e)
+                results = [None] * len(missing)
+            addresses = {
+                hex_id: address
+                for hex_id, address in zip(missing, results)
+                if address is not None
+            }
+            if self.cache is not None and addresses:
+                self.cache.store(self.backend.name, addresses)
+            found.update(addresses)
+
+            failed = [pos for pos, address in enumerate(results) if address is None]
+            if failed:
+                if self.fallback is None:
+                    raise requests.RequestException(
+                        f"Geocoding failed for {len(failed)} of {len(missing)} cells"
+                    )
+                print(f"Using the fallback backend for {len(failed)} cells")
+                fallback_addresses = self.fallback.reverse_many([coords[pos] for pos in failed])
+                found.update(zip([missing[pos] for pos in failed], fallback_addresses))
+
+        return [found[hex_id] for hex_id in hex_ids]
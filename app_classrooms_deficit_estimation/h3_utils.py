@@ -0,0 +1,187 @@
+import itertools
+import numpy as np
+import h3
+import shapely
+
+# Bit layout of the 64-bit H3 cell index
+H3_RES_OFFSET = 52
+H3_RES_MASK = np.uint64(0xF << H3_RES_OFFSET)
+H3_MAX_RES = 15
+H3_DIGIT_BITS = 3
+
+
+# h3_to_int and int_to_h3 are the ones of app_hotspot_analysis/hex_store.py, copied here since the app is deployed from this folder only (see the Dockerfile)
+def h3_to_int(hex_ids):
+    """
+    Convert H3 hexagon ids from their hexadecimal string form to uint64.
+    """
+    return np.fromiter(
+        (int(hex_id, 16) for hex_id in hex_ids), dtype=np.uint64, count=len(hex_ids)
+    )
+
+
+def int_to_h3(hex_ids):
+    """
+    Convert uint64 H3 hexagon ids to their hexadecimal string form.
+    """
+    return [format(hex_id, "x") for hex_id in np.asarray(hex_ids).tolist()]
+
+
+def h3_to_parent_int(hex_ids, res):
+    """
+    Vectorized `h3.h3_to_parent` for uint64 H3 ids.
+
+    The parent of a cell is obtained by setting the resolution bits to `res` and the
+    index digits finer than `res` to 7 (unused), so it is computed with bit
+    operations over the whole array instead of one h3 call per hexagon.
+
+    Parameters
+    ----------
+    hex_ids : numpy.ndarray
+        uint64 H3 ids, all with a resolution greater or equal than `res`
+    res : int
+        Resolution of the parents
+
+    Returns
+    -------
+    numpy.ndarray
+        uint64 H3 ids of the parents
+    """
+    hex_ids = np.asarray(hex_ids, dtype=np.uint64)
+    unused_digits = np.uint64((1 << ((H3_MAX_RES - res) * H3_DIGIT_BITS)) - 1)
+    return (
+        (hex_ids & ~H3_RES_MASK)
+        | np.uint64(res << H3_RES_OFFSET)
+        | unused_digits
+    )
+
+
+def get_h3_boundaries(hex_ids):
+    """
+    Get the boundary vertices of a list of H3 hexagons in a single pass.
+
+    Parameters
+    ----------
+    hex_ids : list-like
+        H3 hexagon ids
+
+    Returns
+    -------
+    boundaries : list
+        Closed (lng, lat) rings of each hexagon, as returned by h3 (GeoJSON order)
+    coords : numpy.ndarray
+        (M, 2) array with the vertices of all the rings, concatenated
+    counts : numpy.ndarray
+        Number of vertices of each ring (7 for hexagons, more for pentagons and
+        cells crossing icosahedron edges)
+    """
+    boundaries = [h3.h3_to_geo_boundary(hex_id, geo_json=True) for hex_id in hex_ids]
+    counts = np.fromiter(map(len, boundaries), dtype=np.int64, count=len(boundaries))
+    coords = np.array(
+        list(itertools.chain.from_iterable(boundaries)), dtype=np.float64
+    ).reshape(-1, 2)
+    return boundaries, coords, counts
+
+
+def get_h3_polygons(hex_ids):
+    """
+    Create the shapely polygons of a list of H3 hexagons with the vectorized
+    shapely 2 constructors.
+
+    Parameters
+    ----------
+    hex_ids : list-like
+        H3 hexagon ids
+
+    Returns
+    -------
+    numpy.ndarray
+        Array of shapely Polygons
+    """
+    _, coords, counts = get_h3_boundaries(hex_ids)
+    rings = shapely.linearrings(coords, indices=np.repeat(np.arange(len(counts)), counts))
+    return shapely.polygons(rings)
+
+
+def get_h3_geojson(hex_ids, ids):
+    """
+    Create a GeoJSON FeatureCollection with the polygons of a list of H3 hexagons,
+    without creating shapely geometries.
+
+    Parameters
+    ----------
+    hex_ids : list-like
+        H3 hexagon ids
+    ids : list-like
+        Feature id of each hexagon (e.g. the DataFrame index used as `locations` in
+        plotly). Ids are converted to str, like GeoSeries.__geo_interface__ does.
+
+    Returns
+    -------
+    geojson : dict
+        FeatureCollection with one Polygon feature per hexagon
+    center : dict
+        Mean "lat" and "lon" of the hexagons centers, None if there are no hexagons
+    """
+    boundaries, coords, counts = get_h3_boundaries(hex_ids)
+
+    geojson = {
+        "type": "FeatureCollection",
+        "features": [
+            {
+                "type": "Feature",
+                "id": str(feature_id),
+                "properties": {},
+                "geometry": {"type": "Polygon", "coordinates": [boundary]},
+            }
+            for feature_id, boundary in zip(ids, boundaries)
+        ],
+    }
+
+    if len(counts) == 0:
+        return geojson, None
+
+    # Center of each hexagon as the mean of its vertices (without the closing one)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    sums = np.add.reduceat(coords, starts, axis=0) - coords[starts]
+    centers = sums / (counts - 1)[:, np.newaxis]
+    center = {"lat": centers[:, 1].mean(), "lon": centers[:, 0].mean()}
+
+    return geojson, center
+
+
+if __name__ == "__main__":
+    # Benchmark: previous generator of shapely Polygons + GeoSeries.__geo_interface__
+    # against the batch builders, for 100k hexagons around Belém
+    import time
+    import geopandas as gpd
+    from shapely.geometry import Polygon
+
+    def get_h3_geometry(hex_ids):
+        for hex_id in hex_ids:
+            yield Polygon(h3.h3_to_geo_boundary(hex_id, geo_json=True))
+
+    center_hex = h3.geo_to_h3(-1.4558, -48.4902, 8)
+    hex_ids = list(h3.k_ring(center_hex, 182))
+    n = len(hex_ids)
+    ids = range(n)
+
+    start = time.time()
+    h3_geom = gpd.GeoSeries(data=get_h3_geometry(hex_ids), index=ids, crs="EPSG:4326")
+    geo_interface = h3_geom.__geo_interface__
+    map_center = (h3_geom.centroid.y.mean(), h3_geom.centroid.x.mean())
+    elapsed = time.time() - start
+    print(f"Before (generator + __geo_interface__): {elapsed * 1e5 / n:.2f} s per 100k hexagons")
+
+    start = time.time()
+    geojson, center = get_h3_geojson(hex_ids, ids)
+    elapsed = time.time() - start
+    print(f"After (get_h3_geojson): {elapsed * 1e5 / n:.2f} s per 100k hexagons")
+
+    start = time.time()
+    polygons = get_h3_polygons(hex_ids)
+    elapsed = time.time() - start
+    print(f"After (get_h3_polygons): {elapsed * 1e5 / n:.2f} s per 100k hexagons")
+
+    assert len(geojson["features"]) == len(geo_interface["features"]) == len(polygons)
+    assert np.allclose((center["lat"], center["lon"]), map_center, atol=1e-4)
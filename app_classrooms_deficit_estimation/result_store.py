@@ -0,0 +1,171 @@
+import hashlib
+import io
+import os
+import re
+import secrets
+
+import pandas as pd
+
+from cache import LRUCache
+
+# Tokens of ResultStore, hexadecimal
+TOKEN_PATTERN = re.compile(r"[0-9a-f]+")
+
+
+def to_parquet_bytes(df):
+    buffer = io.BytesIO()
+    df.to_parquet(buffer)
+    return buffer.getvalue()
+
+
+def from_parquet_bytes(data):
+    return pd.read_parquet(io.BytesIO(data))
+
+
+class MemoryBackend:
+    """
+    Keep the results in this process, in a memory-bounded LRU cache. The stored
+    DataFrames are not copied, so they must not be modified in place.
+    """
+
+    def __init__(self, max_bytes=256 * 1024**2):
+        self.cache = LRUCache(max_bytes, name="result_store")
+
+    def get(self, token):
+        return self.cache.get(token)
+
+    def put(self, token, df):
+        self.cache.put(token, df)
+
+    def touch(self, token):
+        return self.cache.get(token) is not None
+
+
+class DiskBackend:
+    """
+    Store the results as parquet files in a local directory, shared by the worker
+    processes of the app. Only the `max_entries` most recent files are kept.
+    """
+
+    def __init__(self, directory, max_entries=1000):
+        self.directory = directory
+        self.max_entries = max_entries
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, token):
+        # Tokens come from the browser, only the ones of ResultStore can name a file
+        if not TOKEN_PATTERN.fullmatch(token):
+            raise ValueError(f"Invalid result token: {token!r}")
+        return os.path.join(self.directory, f"{token}.parquet")
+
+    def get(self, token):
+        if not TOKEN_PATTERN.fullmatch(token):
+            return None
+        try:
+            return pd.read_parquet(self._path(token))
+        except FileNotFoundError:
+            return None
+
+    def put(self, token, df):
+        # Write to a temporary file first, so readers never see a partial file
+        path = self._path(token)
+        df.to_parquet(path + ".tmp")
+        os.replace(path + ".tmp", path)
+
+        files = [entry for entry in os.scandir(self.directory) if entry.name.endswith(".parquet")]
+        if len(files) > self.max_entries:
+            files.sort(key=lambda entry: entry.stat().st_mtime)
+            for entry in files[: len(files) - self.max_entries]:
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+
+    def touch(self, token):
+        # The modification time orders the files to remove
+        try:
+            os.utime(self._path(token))
+        except FileNotFoundError:
+            return False
+        return True
+
+
+class RedisBackend:
+    """
+    Store the results as parquet bytes in Redis (or any client with the redis-py
+    `get` and `set(name, value, ex=...)` methods), expiring after `ttl` seconds.
+    """
+
+    def __init__(self, client, ttl=3600, prefix="result:"):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, token):
+        data = self.client.get(self.prefix + token)
+        return None if data is None else from_parquet_bytes(data)
+
+    def put(self, token, df):
+        self.client.set(self.prefix + token, to_parquet_bytes(df), ex=self.ttl)
+
+    def touch(self, token):
+        # Restarts the expiration, False if the key does not exist
+        return bool(self.client.expire(self.prefix + token, self.ttl))
+
+
+class ResultStore:
+    """
+    Server-side store of the computed hexagon tables, so the browser only keeps a
+    short token (e.g. in a dcc.Store) instead of the whole table in the figure state.
+
+    Parameters
+    ----------
+    backend : MemoryBackend, DiskBackend or RedisBackend
+        Where the tables are stored. `touch(token)` marks a table as recently used
+        and returns whether it is stored.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def put(self, df, key=None):
+        """
+        Store a DataFrame and return its token. When a (hashable, repr-stable) `key`
+        of the result is given, the token is derived from it, so storing the same
+        result again reuses its entry without writing the table again.
+        """
+        if key is None:
+            token = secrets.token_hex(9)
+        else:
+            token = hashlib.blake2b(repr(key).encode(), digest_size=9).hexdigest()
+            if self.backend.touch(token):
+                return token
+        self.backend.put(token, df)
+        return token
+
+    def get(self, token):
+        """
+        DataFrame stored with `token`, None if it is unknown or was evicted.
+        """
+        if not token:
+            return None
+        return self.backend.get(token)
+
+
+def make_result_store(url="memory"):
+    """
+    Create a ResultStore from a url:
+
+    - "memory": in-process LRU cache (default, for a single worker)
+    - "disk:<directory>": parquet files in a local directory
+    - "redis://host:port/db": Redis server (requires the redis package)
+    """
+    if url == "memory":
+        return ResultStore(MemoryBackend())
+    if url.startswith("disk:"):
+        return ResultStore(DiskBackend(url[len("disk:"):]))
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        import redis
+
+        return ResultStore(RedisBackend(redis.Redis.from_url(url)))
+    raise ValueError(f"Unknown result store url: {url}")
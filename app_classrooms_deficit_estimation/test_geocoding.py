@@ -0,0 +1,61 @@
+import h3
+import pytest
+import requests
+
+from geocoding import Geocoder, GeocodingCache, NominatimBackend
+
+HEX_IDS = sorted(h3.k_ring(h3.geo_to_h3(-1.4558, -48.4902, 8), 1))
+
+
+class FlakySession:
+    """
+    requests.Session stand-in answering every point except the `failing` ones.
+    """
+
+    def __init__(self, failing):
+        self.failing = {h3.h3_to_geo(hex_id) for hex_id in failing}
+
+    def get(self, url, params, timeout):
+        if (params["lat"], params["lon"]) in self.failing:
+            raise requests.ConnectionError("connection reset")
+        response = requests.Response()
+        response.status_code = 200
+        response._content = b'{"address": {"road": "Rua %.4f"}}' % params["lat"]
+        return response
+
+
+class FallbackBackend:
+    name = "fallback"
+
+    def __init__(self):
+        self.calls = []
+
+    def reverse_many(self, coords):
+        self.calls.append(list(coords))
+        return [{"city": "Belém"} for _ in coords]
+
+
+@pytest.fixture
+def backend():
+    backend = NominatimBackend("test@example.com", requests_per_second=0)
+    backend.session = FlakySession(HEX_IDS[:2])
+    return backend
+
+
+def test_partial_failure_caches_successes(tmp_path, backend):
+    cache = GeocodingCache(str(tmp_path / "geocoding.sqlite"))
+    fallback = FallbackBackend()
+    addresses = Geocoder(backend, cache=cache, fallback=fallback).reverse_h3(HEX_IDS)
+
+    assert addresses[:2] == [{"city": "Belém"}] * 2
+    assert all("road" in address for address in addresses[2:])
+    # Only the failed cells go to the fallback, and only the others are cached
+    assert fallback.calls == [[h3.h3_to_geo(hex_id) for hex_id in HEX_IDS[:2]]]
+    assert set(cache.lookup(backend.name, HEX_IDS)) == set(HEX_IDS[2:])
+
+
+def test_partial_failure_without_fallback_raises(tmp_path, backend):
+    cache = GeocodingCache(str(tmp_path / "geocoding.sqlite"))
+    with pytest.raises(requests.RequestException, match="2 of 7"):
+        Geocoder(backend, cache=cache).reverse_h3(HEX_IDS)
+    assert set(cache.lookup(backend.name, HEX_IDS)) == set(HEX_IDS[2:])
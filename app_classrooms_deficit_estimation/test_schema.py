@@ -0,0 +1,124 @@
+import importlib
+import os
+
+import h3
+import numpy as np
+import pandas as pd
+import pytest
+
+from data import (
+    add_parent_columns,
+    check_totals,
+    enforce_schema,
+    required_columns,
+    schema,
+    validate_schema,
+    write_by_municipality,
+)
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+LEVELS = ["INF_CRE", "INF_PRE", "FUND_AI", "FUND_AF", "MED"]
+
+
+def synthetic_hexagons(seed=0):
+    """
+    float64 table of hexagons with the columns of the dashboard parquet: 2 rings of
+    municipalities around Belém, fractional populations, counts with some missing
+    values and proportions that sum to 1 in each hexagon.
+    """
+    rng = np.random.default_rng(seed)
+    center = h3.geo_to_h3(-1.4558, -48.4902, 8)
+    hexs = sorted(h3.k_ring(center, 12))
+    n = len(hexs)
+    inner = set(h3.k_ring(center, 7))
+
+    df = pd.DataFrame(
+        {
+            "name_muni": ["Belém" if hex_id in inner else "Ananindeua" for hex_id in hexs],
+            "hex": hexs,
+        }
+    )
+    for column in required_columns:
+        if column.startswith("pop_"):
+            df[column] = rng.gamma(2.0, 60.0, n)
+        elif column.endswith("_PROP"):
+            continue
+        elif column not in df.columns:
+            counts = rng.poisson(40, n).astype(np.float64)
+            counts[rng.random(n) < 0.1] = np.nan
+            df[column] = counts
+    proportions = rng.dirichlet(np.ones(len(LEVELS)), n)
+    for level, proportion in zip(LEVELS, proportions.T):
+        df[f"QT_MAT_{level}_PROP"] = proportion
+    df["QT_SALAS_UTILIZADAS"] = rng.gamma(2.0, 2.5, n)
+    return df[required_columns]
+
+
+@pytest.fixture(scope="module")
+def app_env(tmp_path_factory):
+    """
+    The app (and check_schema) loaded from a compact table written from the
+    synthetic one, as data.py does with the real data.
+    """
+    reference_df = synthetic_hexagons()
+    directory = tmp_path_factory.mktemp("app")
+    os.makedirs(directory / "data")
+    os.symlink(
+        os.path.join(APP_DIR, "data", "para_muni.geojson"),
+        directory / "data" / "para_muni.geojson",
+    )
+    write_by_municipality(
+        enforce_schema(add_parent_columns(reference_df.copy())),
+        directory / "data" / "25022025_dashboard_hexs_light.parquet",
+    )
+
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        app = importlib.import_module("app")
+        check_schema = importlib.import_module("check_schema")
+    finally:
+        os.chdir(cwd)
+    yield app, check_schema, reference_df
+    check_schema.use_hexagons(app.hex_gdf)
+
+
+def test_enforce_schema_dtypes():
+    hex_df = enforce_schema(add_parent_columns(synthetic_hexagons()))
+    validate_schema(hex_df)
+    assert all(hex_df[column].dtype == dtype for column, dtype in schema.items())
+
+
+def test_check_totals():
+    reference_df = synthetic_hexagons()
+    hex_df = enforce_schema(add_parent_columns(reference_df.copy()))
+    totals = check_totals(reference_df, hex_df, rtol=1e-5)
+    assert totals["QT_SALAS_UTILIZADAS"] == pytest.approx(
+        reference_df["QT_SALAS_UTILIZADAS"].sum(), rel=1e-6
+    )
+
+    hex_df["QT_MAT_MED"] *= np.float32(1.001)
+    with pytest.raises(AssertionError, match="QT_MAT_MED"):
+        check_totals(reference_df, hex_df, rtol=1e-5)
+
+
+def test_app_outputs_match_float64(app_env):
+    app, check_schema, reference_df = app_env
+    compact_df = app.hex_gdf
+    summary = check_schema.check_outputs(
+        check_schema.prepare_reference(reference_df), compact_df, rtol=1e-5
+    )
+    assert list(summary.index) == ["Ananindeua", "Belém", "Total"]
+    assert (summary["hexagons"] > 0).all()
+    assert (summary["max_rel_diff"] < 1e-5).all()
+
+
+def test_app_outputs_detect_differences(app_env):
+    app, check_schema, reference_df = app_env
+    # Every other hexagon, a uniform scale would cancel in the proportions
+    compact_df = app.hex_gdf.copy()
+    compact_df.loc[compact_df.index[::2], "QT_MAT_FUND_AI"] *= np.float32(1.001)
+    with pytest.raises(AssertionError, match="QT_SALAS_NECESARIAS_TOTAL_FUND_AI"):
+        check_schema.check_outputs(
+            check_schema.prepare_reference(reference_df), compact_df, rtol=1e-5
+        )
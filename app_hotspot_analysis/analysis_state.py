@@ -0,0 +1,104 @@
+import os
+import re
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+
+
+class AnalysisStateStore:
+    """
+    Results of the analyses of each session (user) and microregion: the index,
+    Gi, p-value and cluster columns of the hexagons of the microregion, indexed by
+    hexagon id. The hexagons table of the app is never modified.
+
+    The results are kept in memory (least recently used first out) or, with a
+    `directory`, as parquet files shared by all the worker processes of the app.
+
+    Parameters
+    ----------
+    max_entries : int, optional
+        Number of (session, microregion) results kept. Default is 256.
+    directory : str, optional
+        Directory of the parquet files. Default is None (in memory).
+    """
+
+    def __init__(self, max_entries=256, directory=None):
+        self.max_entries = max_entries
+        self.directory = directory
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def _path(self, session_id, code):
+        # Session ids come from the browser, keep only safe characters
+        name = re.sub(r"[^A-Za-z0-9_-]", "", f"{session_id}_{code}")
+        return os.path.join(self.directory, f"{name}.parquet")
+
+    def get(self, session_id, code):
+        """
+        Results of a session and microregion, None if there are none yet.
+        """
+        if self.directory is not None:
+            try:
+                return pd.read_parquet(self._path(session_id, code))
+            except FileNotFoundError:
+                return None
+
+        with self._lock:
+            results = self._entries.get((session_id, code))
+            if results is not None:
+                self._entries.move_to_end((session_id, code))
+            return results
+
+    def update(self, session_id, code, **columns):
+        """
+        Add (or replace) result columns of a session and microregion.
+
+        Parameters
+        ----------
+        session_id : str
+            Session id
+        code : str or int
+            Microregion code
+        **columns : pd.Series
+            Result columns, indexed by hexagon id
+
+        Returns
+        -------
+        pd.DataFrame
+            All the results of the session and microregion
+        """
+        results = self.get(session_id, code)
+        if results is None:
+            results = pd.DataFrame(columns)
+        else:
+            results = results.assign(**columns)
+
+        if self.directory is not None:
+            # Write to a temporary file first, so readers never see a partial file
+            path = self._path(session_id, code)
+            results.to_parquet(path + ".tmp")
+            os.replace(path + ".tmp", path)
+            self._remove_old_files()
+            return results
+
+        with self._lock:
+            self._entries[(session_id, code)] = results
+            self._entries.move_to_end((session_id, code))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return results
+
+    def _remove_old_files(self):
+        files = [
+            entry for entry in os.scandir(self.directory) if entry.name.endswith(".parquet")
+        ]
+        if len(files) > self.max_entries:
+            files.sort(key=lambda entry: entry.stat().st_mtime)
+            for entry in files[: len(files) - self.max_entries]:
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
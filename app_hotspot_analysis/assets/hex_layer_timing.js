@@ -0,0 +1,22 @@
+// Report the bytes transferred and the load time of the hexagon layer data (see
+// layer_transport.py) to the server, from the browser resource timings
+if (window.PerformanceObserver && navigator.sendBeacon) {
+    new PerformanceObserver((list) => {
+        list.getEntries().forEach((entry) => {
+            const path = new URL(entry.name).pathname;
+            if (!path.startsWith("/hex-layer/") || path.startsWith("/hex-layer/timing")) {
+                return;
+            }
+            navigator.sendBeacon(
+                "/hex-layer/timing",
+                JSON.stringify({
+                    url: path,
+                    transfer_size: entry.transferSize,
+                    encoded_size: entry.encodedBodySize,
+                    decoded_size: entry.decodedBodySize,
+                    duration: entry.duration,
+                })
+            );
+        });
+    }).observe({ type: "resource", buffered: true });
+}
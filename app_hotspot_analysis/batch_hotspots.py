@@ -0,0 +1,216 @@
+"""
+Precompute the access and capacity hotspot analyses of every microregion (or
+municipality), in parallel worker processes, so the dashboard can serve the
+results without running them.
+
+Usage:
+    python batch_hotspots.py \
+        --hexagons ../outputs/20240129_para_hexs_with_accessibility_capacity_vars_hex_store.parquet \
+        --regions ../outputs/para_micro_regions.parquets --region-col code_micro \
+        --output ../outputs/para_micro_regions_hotspots.parquet
+
+Writes the results of all the regions to one Parquet file (one row per region and
+hexagon, a hexagon near a border can belong to several regions) and the time spent
+on each region to `<output>_timing.parquet`.
+"""
+
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import geopandas as gpd
+import pandas as pd
+from tqdm import tqdm
+
+from hex_store import HEX_ID, h3_polygons, int_to_h3, read_hex_store
+import hotspot_analysis as ha
+from region_index import RegionIndex
+
+
+# Same selection of hexagons as the dashboard: the bounding box of the region plus
+# a buffer, so the hexagons on the border have their neighbors
+REGION_BUFFER = 0.005
+
+# Columns of the hexagons used by the analyses
+FEATURES = list(dict.fromkeys(ha.ACCESS_FEATURES + ha.CAPACITY_FEATURES))
+
+
+def analyze_region(region, hexs, significance=0.05, kring=3, permutations=999, seed=0):
+    """
+    Access and capacity hotspot analyses and clusters of the hexagons of a region.
+
+    Parameters
+    ----------
+    region : str or int
+        Region code, added as the `region` column
+    hexs : pd.DataFrame
+        Hexagons of the region with the `hex` column and the features, prepared with
+        `hotspot_analysis.prepare_hexagons`
+    significance : float, optional
+        Significance level of the clusters. Default is 0.05.
+    kring : int, optional
+        Number of rings of the spatial weights. Default is 3.
+    permutations : int, optional
+        Number of permutations of the pseudo p-values. Default is 999.
+    seed : int, optional
+        Seed of the permutations. Default is 0.
+
+    Returns
+    -------
+    results : pd.DataFrame
+        Scores, Gi, p_sim and clusters of each hexagon
+    timing : dict
+        Seconds spent on each step
+    """
+    timing = {"region": region, "hexagons": len(hexs)}
+    results = pd.DataFrame({"region": region, "hex": hexs["hex"].to_numpy()})
+    scores = {}
+
+    for name, features, weights in [
+        ("access", ha.ACCESS_FEATURES, ha.ACCESS_WEIGHTS),
+        ("capacity", ha.CAPACITY_FEATURES, ha.CAPACITY_WEIGHTS),
+    ]:
+        start = time.time()
+        # One thread per process, the regions are already run in parallel
+        score, gi, psim = ha.h3_hotspot_analysis(
+            hexs,
+            features,
+            weights,
+            kring=kring,
+            permutations=permutations,
+            seed=seed,
+            n_jobs=1,
+        )
+        results[f"{name}_index"] = score.to_numpy()
+        results[f"{name}_gi"] = gi
+        results[f"{name}_psim"] = psim
+        scores[name] = {"score": score, "gi": gi, "psim": psim}
+        timing[f"{name}_s"] = time.time() - start
+
+    start = time.time()
+    clusters = ha.h3_scores_clusters(
+        scores["access"], scores["capacity"], hexs, significance
+    )
+    results["clusters"] = clusters.to_numpy()
+    timing["clusters_s"] = time.time() - start
+    timing["total_s"] = timing["access_s"] + timing["capacity_s"] + timing["clusters_s"]
+
+    return results, timing
+
+
+def batch_hotspot_analysis(
+    hexs,
+    regions,
+    region_col,
+    max_workers=None,
+    significance=0.05,
+    kring=3,
+    permutations=999,
+    seed=0,
+):
+    """
+    Run `analyze_region` for every region in a pool of worker processes.
+
+    Parameters
+    ----------
+    hexs : pd.DataFrame
+        Hexagons with the features, in the hex store format (see hex_store.py)
+    regions : gpd.GeoDataFrame
+        GeoDataFrame with the regions, in EPSG:4326
+    region_col : str
+        Column of `regions` with the region codes
+    max_workers : int, optional
+        Number of worker processes. Default is None (the number of cores).
+    significance, kring, permutations, seed : optional
+        See `analyze_region`
+
+    Returns
+    -------
+    results : pd.DataFrame
+        Results of all the regions
+    timing : pd.DataFrame
+        Seconds spent on each region, slowest first
+    """
+    start = time.time()
+    # The polygons of the hexagons are only derived from their ids to build the index
+    region_index = RegionIndex(
+        gpd.GeoSeries(h3_polygons(hexs[HEX_ID]), crs="EPSG:4326"),
+        regions,
+        region_col,
+        bbox_buffer=REGION_BUFFER,
+    )
+    # Send only the columns of the analyses to the workers
+    features = ha.prepare_hexagons(hexs[FEATURES])
+    features.insert(0, "hex", int_to_h3(hexs[HEX_ID]))
+    print(f"Regions prepared in {time.time() - start:.2f} seconds")
+
+    results, timing = [], []
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(
+                analyze_region,
+                region,
+                region_index.select(features, region).reset_index(drop=True),
+                significance,
+                kring,
+                permutations,
+                seed,
+            )
+            for region, size in region_index.sizes().items()
+            if size
+        ]
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            region_results, region_timing = future.result()
+            results.append(region_results)
+            timing.append(region_timing)
+
+    results = pd.concat(results, ignore_index=True).sort_values(["region", "hex"])
+    timing = pd.DataFrame(timing).sort_values("total_s", ascending=False)
+    return results.reset_index(drop=True), timing.reset_index(drop=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--hexagons",
+        default="../outputs/20240129_para_hexs_with_accessibility_capacity_vars_hex_store.parquet",
+    )
+    parser.add_argument("--regions", default="../outputs/para_micro_regions.parquets")
+    parser.add_argument("--region-col", default="code_micro")
+    parser.add_argument(
+        "--output", default="../outputs/para_micro_regions_hotspots.parquet"
+    )
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--significance", type=float, default=0.05)
+    parser.add_argument("--kring", type=int, default=3)
+    parser.add_argument("--permutations", type=int, default=999)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    start = time.time()
+    hexs = read_hex_store(args.hexagons, columns=FEATURES)
+    regions = gpd.read_parquet(args.regions).to_crs("EPSG:4326")
+    print(f"Data loaded in {time.time() - start:.2f} seconds")
+
+    start = time.time()
+    results, timing = batch_hotspot_analysis(
+        hexs,
+        regions,
+        args.region_col,
+        max_workers=args.workers,
+        significance=args.significance,
+        kring=args.kring,
+        permutations=args.permutations,
+        seed=args.seed,
+    )
+    elapsed = time.time() - start
+
+    results.to_parquet(args.output, index=False)
+    timing_path = os.path.splitext(args.output)[0] + "_timing.parquet"
+    timing.to_parquet(timing_path, index=False)
+
+    print(f"{len(timing)} regions analyzed in {elapsed:.2f} seconds")
+    print(f"Sum of the time of the regions: {timing['total_s'].sum():.2f} seconds")
+    print(timing.head(10).to_string(index=False))
+    print(f"Results saved to {args.output} and {timing_path}")
@@ -1,8 +1,10 @@
 # Import libraries
 import os
+import json
 import io
 import base64
 import time
+import uuid
 import pandas as pd
 import numpy as np
 import geopandas as gpd
@@ -16,12 +18,22 @@ import dash_deck
 import plotly.graph_objs as go
 from pandas.api.types import is_numeric_dtype
 from matplotlib import colormaps as mcm
-from shapely.geometry import box
-from dash import Dash, html, dcc, Output, Input, State, ctx, ALL
+from dash import Dash, html, dcc, Output, Input, State, ctx, ALL, Patch, no_update
 
 # Custom modules
+from hex_store import HEX_ID, h3_polygons, int_to_h3
 import hotspot_analysis as ha
-from helper_colormaps import cmaps_options
+from analysis_state import AnalysisStateStore
+from datasets import open_dataset
+from helper_colormaps import (
+    cmaps_options,
+    encode_categorical,
+    encode_continuous,
+    to_rgba_uint8,
+)
+from layer_transport import HexLayerStore, register_routes
+from region_index import RegionIndex
+from spatial_index import SpatialIndex
 from options import (
     capacity_var_labels,
     access_var_labels,
@@ -161,28 +173,68 @@ app = Dash(
 
 mapbox_api_token = os.getenv("MAPBOX_API_TOKEN")
 
-# Read hexagons and school data with geopandas
+# Data of the hexagon layers, fetched by the map from a URL instead of embedded in
+# the deck JSON (see layer_transport.py). Set HEX_LAYER_DIR to share them between
+# the worker processes (e.g. with gunicorn), any worker can then serve the layer data
+hex_layer_store = HexLayerStore(directory=os.environ.get("HEX_LAYER_DIR"))
+register_routes(app.server, hex_layer_store)
+
+# Read the data from memory-mapped Feather files (converted from the Parquet files
+# on the first run, see datasets.py), shared by all the worker processes
 start_time = time.time()
-microregions = gpd.read_parquet("../outputs/para_micro_regions.parquets")
+microregions = open_dataset("../outputs/para_micro_regions.parquets").read_geodataframe()
 print(f"Read micro regions in {time.time() - start_time} seconds")
 
 start_time = time.time()
-hexagons = gpd.read_parquet(
-    "../outputs/20240129_para_hexs_with_accessibility_capacity_vars.parquet"
+# Only opened, the columns of the hexagons are read when a callback needs them. The
+# hexagons are stored without geometries, see hex_store.py
+hexagons = open_dataset(
+    "../outputs/20240129_para_hexs_with_accessibility_capacity_vars_hex_store.parquet"
 )
 print(hexagons.columns)
-print(f"Read hexagons in {time.time() - start_time} seconds")
+print(f"Opened hexagons in {time.time() - start_time} seconds")
 
 start_time = time.time()
-schools = gpd.read_parquet("../outputs/20240129_para_schools_final.parquet")
+schools = open_dataset(
+    "../outputs/20240129_para_schools_final.parquet"
+).read_geodataframe()
 print(f"Read schools in {time.time() - start_time} seconds")
 
+# Hexagons of each microregion: intersecting it (for the map) and in its buffered
+# bounding box (for the hotspot analysis, so the border hexagons have neighbors).
+# The polygons of the hexagons are only derived from their ids to build the indexes
+hexagons_geometry = gpd.GeoSeries(
+    h3_polygons(hexagons.read([HEX_ID])[HEX_ID]), crs="EPSG:4326"
+)
+microregion_hexs_index = RegionIndex(hexagons_geometry, microregions, "code_micro")
+microregion_bbox_hexs_index = RegionIndex(
+    hexagons_geometry, microregions, "code_micro", bbox_buffer=0.005
+)
+del hexagons_geometry
+
+start_time = time.time()
+municipalities = gpd.read_file("../outputs/para_muni.geojson").to_crs(microregions.crs)
+print(f"Read municipalities in {time.time() - start_time} seconds")
+
+# Spatial indexes built once, to select the schools of a microregion and resolve
+# the clicked coordinates without scanning the whole GeoDataFrames
+spatial_indexes = {
+    "schools": SpatialIndex(schools),
+    "microregions": SpatialIndex(microregions, "code_micro"),
+    "municipalities": SpatialIndex(municipalities, "code_muni"),
+}
+
 data = {
     "microregions": microregions,
     "hex": hexagons,
     "schools": schools,
 }
 
+# Results of the analyses (indexes, Gi, p-values and clusters) of each session and
+# microregion, only for the hexagons of the microregion. Set ANALYSIS_STATE_DIR to
+# share them between the worker processes (e.g. with gunicorn)
+analysis_state = AnalysisStateStore(directory=os.environ.get("ANALYSIS_STATE_DIR"))
+
 # Components
 welcome_modal = html.Div(
     [
@@ -508,30 +560,37 @@ initial_map = html.Div(
 )
 
 # Layout
-app.layout = dbc.Container(
-    [
-        welcome_modal,
-        dbc.Row(
-            [
-                dbc.Col(
-                    sidebar,
-                    # Vertically stacked for mobile, sidebar for desktop
-                    width=12,
-                    sm=3,
-                    # Allow verticall scrolling if the content is too long
-                    className="vh-100 overflow-auto",
-                ),
-                dbc.Col(
-                    initial_map,
-                    width=12,
-                    sm=9,
-                    className="p-0 overflow-hidden",
-                ),
-            ]
-        ),
-    ],
-    fluid=True,
-)
+def serve_layout():
+    # Called on each page load, so every session gets its own id
+    return dbc.Container(
+        [
+            dcc.Store(id="session-id", data=str(uuid.uuid4())),
+            dcc.Store(id="selected-microregion"),
+            welcome_modal,
+            dbc.Row(
+                [
+                    dbc.Col(
+                        sidebar,
+                        # Vertically stacked for mobile, sidebar for desktop
+                        width=12,
+                        sm=3,
+                        # Allow verticall scrolling if the content is too long
+                        className="vh-100 overflow-auto",
+                    ),
+                    dbc.Col(
+                        initial_map,
+                        width=12,
+                        sm=9,
+                        className="p-0 overflow-hidden",
+                    ),
+                ]
+            ),
+        ],
+        fluid=True,
+    )
+
+
+app.layout = serve_layout
 
 
 # Callbacks
@@ -547,31 +606,47 @@ def modal_switch(nc1, opened):
 
 @app.callback(
     Output("map", "children"),
+    Output("selected-microregion", "data"),
     # Output("colorscale-legend", "src", allow_duplicate=True),
     Input("deck-gl", "clickInfo"),
+    State("session-id", "data"),
     # prevent_initial_call="initial_duplicate",  # True
 )
-def select_microregion(click):
+def select_microregion(click, session_id):
     print("Selecting microregion ...")
     if click is not None:
-        # Get the clicked microregion
-        selected_code_micro = click["object"]["code_micro"]
-        selected_microregion = data["microregions"][
-            microregions["code_micro"] == selected_code_micro
-        ]
-        data["selected_microregion"] = selected_microregion
-        hexagons_clipped = data["hex"].clip(selected_microregion)
+        # Get the clicked microregion from the coordinates, the clicked object may
+        # be a hexagon or a school instead of the microregion
+        lng, lat = click["coordinate"][:2]
+        position = spatial_indexes["microregions"].locate([lng], [lat])[0]
+        if position < 0:
+            return no_update, no_update
+        selected_microregion = data["microregions"].iloc[[position]]
+        # As a native python value, to be stored in the browser
+        selected_code_micro = selected_microregion["code_micro"].tolist()[0]
+        code_muni = spatial_indexes["municipalities"].id_at(lng, lat)
+        print("Clicked municipality", code_muni)
+        hexagons_clipped = read_microregion_hexagons(
+            selected_code_micro, ["pop_6_14_years_adj"]
+        )
 
         # Create the color column for the plot
         cmap = mcm.get_cmap("viridis")
-        rgba_list = cmap(hexagons_clipped["pop_6_14_years_adj"])
-        hexagons_clipped["color"] = [[int(c * 255) for c in rgba] for rgba in rgba_list]
+        hex_layer_url = hex_layer_store.put(
+            hexagons_clipped["hex"],
+            encode_continuous(hexagons_clipped["pop_6_14_years_adj"], "viridis"),
+            hexagons_clipped["pop_6_14_years_adj"],
+            label=selected_code_micro,
+            session_id=session_id,
+        )
 
         color_variable_picker.children.children[-1].children = [
             generate_colorbar_legend(cmap, hexagons_clipped["pop_6_14_years_adj"])
         ]
 
-        schools_clipped = data["schools"].clip(selected_microregion)
+        schools_clipped = spatial_indexes["schools"].select(
+            data["schools"], selected_microregion.iloc[0].geometry
+        )
 
         # Update the map view to center on the selected microregion
         view_state = pdk.data_utils.compute_view(
@@ -595,11 +670,12 @@ def select_microregion(click):
 
         map_layer = pdk.Layer(
             "H3HexagonLayer",
-            data=hexagons_clipped,
-            get_hexagon="hex",
-            get_fill_color="color",
+            # Hexagon ids (h), colors (c) and elevations (e) only
+            data=hex_layer_url,
+            get_hexagon="h",
+            get_fill_color="c",
             get_line_color=[0, 0, 0],
-            get_elevation="pop_6_14_years_adj",
+            get_elevation="e",
             elevation_scale=20,
             elevation_range=[0, 1000],
             extruded=True,
@@ -626,7 +702,8 @@ def select_microregion(click):
         )
 
         map = dash_deck.DeckGL(
-            r.to_json(),
+            # As a dict (not a JSON string) so update_hex_layer_color can patch it
+            json.loads(r.to_json()),
             id="deck-gl",
             enableEvents=["click"],  # , 'hover', 'dragStart', 'dragEnd']
             # enableEvents=True,
@@ -639,10 +716,43 @@ def select_microregion(click):
             },
         )
         # Return the updated layers
-        return [map, map_controls]
+        return [map, map_controls], selected_code_micro
 
     # Return the original layers if no microregion is selected
-    return initial_map
+    return initial_map, None
+
+
+# Position of the hexagon layer in the map layers (adm_layer, map_layer, scatter_layer)
+HEX_LAYER = 1
+
+
+def read_microregion_hexagons(code_micro, columns=(), index=microregion_hexs_index):
+    """
+    Some columns of the hexagons of a microregion, read from the memory-mapped
+    hexagons, with the missing values filled and the H3 ids as strings (`hex`).
+    """
+    hexs = ha.fill_missing_values(
+        hexagons.read([HEX_ID, *columns], rows=index.positions_of(code_micro))
+    )
+    hexs.insert(0, "hex", int_to_h3(hexs[HEX_ID]))
+    return hexs
+
+
+def get_hexagons_column(hexagons_clipped, column, session_id, code_micro):
+    """
+    Column of the hexagons of a microregion: a variable of the hexagons, or a
+    result of the analyses of the session (NaN for the hexagons without result).
+    """
+    if column in hexagons_clipped.columns:
+        return hexagons_clipped[column]
+    results = analysis_state.get(session_id, code_micro)
+    if results is None or column not in results.columns:
+        return pd.Series(np.nan, index=hexagons_clipped.index, name=column)
+    return pd.Series(
+        results[column].reindex(hexagons_clipped["hex"]).to_numpy(),
+        index=hexagons_clipped.index,
+        name=column,
+    )
 
 
 @app.callback(
@@ -652,33 +762,53 @@ def select_microregion(click):
     Input("color-palette-dropdown", "value"),
     Input("height-variable-dropdown", "value"),
     Input("height-scale-slider", "value"),
+    State("selected-microregion", "data"),
+    State("session-id", "data"),
     prevent_initial_call=True,
 )
 def update_hex_layer_color(
-    color_variable, color_palette, height_variable, height_scale
+    color_variable, color_palette, height_variable, height_scale, code_micro, session_id
 ):
     # Update the map layers based on the user's selections
     print("Updating color layer", color_variable, color_palette)
-    print("Data selected microregion", data["selected_microregion"]["name_micro"])
-    print("Data hex", data["hex"].columns)
-    if color_variable and color_palette and data["selected_microregion"] is not None:
-        selected_microregion = data["selected_microregion"]
-        hexagons_clipped = data["hex"].clip(selected_microregion.iloc[0].geometry)
+    print("Selected microregion", code_micro)
+    if color_variable and color_palette and code_micro is not None:
+        # The map of the microregion is already in the browser, only its hexagon
+        # layer is patched
+        patched_deck = Patch()
+        patched_deck["layers"][HEX_LAYER]["elevationScale"] = height_scale
+        if ctx.triggered_id == "height-scale-slider":
+            return patched_deck, no_update
+
+        # Only the color and height columns, the results come from the session
+        hexagons_clipped = read_microregion_hexagons(
+            code_micro,
+            [
+                column
+                for column in [color_variable, height_variable]
+                if column in hexagons.columns
+            ],
+        )
+        color_values = get_hexagons_column(
+            hexagons_clipped, color_variable, session_id, code_micro
+        )
+        height_values = get_hexagons_column(
+            hexagons_clipped, height_variable, session_id, code_micro
+        )
+        if color_values.isna().all():
+            # No result of the session for this microregion (e.g. another one was
+            # selected after running the analysis)
+            return patched_deck, no_update
         print("Hexagons clipped", hexagons_clipped.shape)
-        print("Hexagons clipped columns", hexagons_clipped.columns)
 
         print("Creating colorscale ...")
 
         # Check if the color variable is numerical:
-        if is_numeric_dtype(hexagons_clipped[color_variable]):
+        if is_numeric_dtype(color_values):
             cmap = mcm.get_cmap(color_palette)
-            rgba_list = cmap(hexagons_clipped[color_variable])
-            print("RGBA list", rgba_list)
-            hexagons_clipped["color"] = [
-                [int(c * 255) for c in rgba] for rgba in rgba_list
-            ]
+            colors = encode_continuous(color_values, color_palette)
             print("Color column created.")
-            legend = generate_colorbar_legend(cmap, hexagons_clipped[color_variable])
+            legend = generate_colorbar_legend(cmap, color_values)
             print("Colorscale created.")
         else:
             # Create a discrete colormap
@@ -691,21 +821,13 @@ def update_hex_layer_color(
                 color_palette = "Dark2"
 
             if color_palette == "clusters_cmap":
-                cmap = mcm.get_cmap(color_palette)
-                print("Categorical colormap", cmap.colors)
-                color_mapping = {
-                    # Value: RGB colors in a list
-                    "HH": [154, 205, 50],  # yellowgreen
-                    "HL": [255, 215, 0],  # gold
-                    "LH": [255, 165, 0],  # orange
-                    "LL": [255, 69, 0],  # red
-                    "N": [211, 211, 211],  # lightgray
-                }
-                hexagons_clipped["color"] = hexagons_clipped[color_variable].map(
-                    color_mapping
+                colors, _, palette = encode_categorical(
+                    color_values,
+                    ["yellowgreen", "gold", "orange", "orangered", "lightgray"],
+                    categories=["HH", "HL", "LH", "LL", "N"],
                 )
                 legend = generate_legend(
-                    list(color_mapping.values()),
+                    palette.tolist(),
                     [
                         "High Capacity + High Access",
                         "High Capacity + Low Access",
@@ -715,99 +837,34 @@ def update_hex_layer_color(
                     ],
                 )
             else:
-
-                N = len(hexagons_clipped[color_variable].unique())
-                cmap = mcm.get_cmap(color_palette).resampled(N)
-                categories = hexagons_clipped[color_variable].unique()
-                # Check if there are nan values:
-                if hexagons_clipped[color_variable].isna().sum() > 0:
-                    cmap = mcm.get_cmap(color_palette).resampled(N - 1)
-                    categories = hexagons_clipped[color_variable].dropna().unique()
-
-                    # Add a color for the nan values
-                    cmap = mcolors.ListedColormap(
-                        list(cmap.colors) + ["lightgray"],
-                    )
-                    categories = np.append(categories, np.nan)
-
-                rgba_list = cmap(range(N))
-                rgba_list = [[int(c * 255) for c in rgba] for rgba in rgba_list]
-
-                print("RGBA list", rgba_list)
-                rgba_mapping = dict(zip(categories, rgba_list))
-                print("RGBA mapping", rgba_mapping)
-                hexagons_clipped["color"] = (
-                    hexagons_clipped[color_variable].astype(object).map(rgba_mapping)
+                # One color per category (sorted), and lightgray for the nan values
+                colors, categories, palette = encode_categorical(
+                    color_values, color_palette
                 )
-                print('hexagons_clipped["color"]', hexagons_clipped["color"].head())
 
-                if hexagons_clipped[color_variable].isna().sum() > 0:
+                legend_colors, legend_labels = palette.tolist(), list(categories)
+                if color_values.isna().any():
                     # Create categorical legend with labels (nan = Missing)
-                    categories = hexagons_clipped[color_variable].dropna().unique()
-                    categories = categories.sort_values()
-                    categories = np.append(categories, "Missing")
-
-                legend = generate_legend(rgba_list, categories)
-
-        schools_clipped = data["schools"].clip(selected_microregion)
-
-        # Update the map view to center on the selected microregion
-        view_state = pdk.data_utils.compute_view(
-            list(zip(schools_clipped.geometry.x, schools_clipped.geometry.y)),
-            view_proportion=0.9,
-        )
-        # Change pitch and bearing to get a better view
-        view_state.pitch = 45
-        view_state.bearing = 0
-
-        # Create the map with pydeck and dash_deck
-        adm_layer = pdk.Layer(
-            "GeoJsonLayer",
-            data=selected_microregion,
-            get_line_color=[255, 0, 0],
-            get_line_width=500,
-            pickable=False,
-            stroked=True,
-            filled=False,
-        )
-
-        map_layer = pdk.Layer(
-            "H3HexagonLayer",
-            data=hexagons_clipped,
-            get_hexagon="hex",
-            get_fill_color="color",
-            get_line_color=[0, 0, 0],
-            get_elevation=height_variable,
-            elevation_scale=height_scale,
-            elevation_range=[0, 500],
-            extruded=True,
-            pickable=True,
-            auto_highlight=True,
-            coverage=1,
-        )
-
-        scatter_layer = pdk.Layer(
-            "ScatterplotLayer",
-            data=schools_clipped,
-            get_position="geometry.coordinates",
-            get_color=[255, 0, 0],
-            get_radius=100,
-            pickable=True,
-            auto_highlight=True,
-        )
-
-        r = pdk.Deck(
-            layers=[adm_layer, map_layer, scatter_layer],
-            initial_view_state=view_state,
-            map_provider="mapbox",
-            map_style=pdk.map_styles.SATELLITE,
+                    legend_colors.append(to_rgba_uint8(["lightgray"])[0].tolist())
+                    legend_labels.append("Missing")
+
+                legend = generate_legend(legend_colors, legend_labels)
+
+        # Point the hexagon layer to its new colors and elevations, the other layers
+        # and the view of the map are kept
+        patched_deck["layers"][HEX_LAYER]["data"] = hex_layer_store.put(
+            hexagons_clipped["hex"],
+            colors,
+            height_values,
+            label=code_micro,
+            session_id=session_id,
         )
+        patched_deck["layers"][HEX_LAYER]["elevationRange"] = [0, 500]
 
-        # Return the updated layers
-        return r.to_json(), legend
+        return patched_deck, legend
 
 
-def calculate_index(hexs, var_labels, switches, sliders):
+def calculate_index(hexs, var_labels, switches, sliders, method="analytical"):
     weights = pd.DataFrame(
         {
             "column_name": list(var_labels.keys()),
@@ -819,7 +876,16 @@ def calculate_index(hexs, var_labels, switches, sliders):
     # Normalize the weights to sum to 1
     weights["weights_norm"] = weights["weights"] / weights["weights"].sum()
 
-    return ha.h3_hotspot_analysis(hexs, weights["column_name"], weights["weights_norm"])
+    # The index buttons preview the Gi* with normal approximation p-values, the
+    # permutations only run for the clusters. Only the significance at 5% is shown,
+    # so the clearly resolved hexagons can stop permuting early
+    return ha.h3_hotspot_analysis(
+        hexs,
+        weights["column_name"],
+        weights["weights_norm"],
+        early_stopping=True,
+        method=method,
+    )
 
 
 @app.callback(
@@ -838,6 +904,8 @@ def calculate_index(hexs, var_labels, switches, sliders):
     State("color-variable-dropdown", "value"),
     State("color-palette-dropdown", "data"),
     State("color-palette-dropdown", "value"),
+    State("selected-microregion", "data"),
+    State("session-id", "data"),
     prevent_initial_call=True,
 )
 def calculate_index_callback(
@@ -852,23 +920,29 @@ def calculate_index_callback(
     color_variable_value,
     color_palette_state,
     color_palette_value,
+    code_micro,
+    session_id,
 ):
     button_clicked = ctx.triggered_id
 
-    if button_clicked:
-        # Prepare data
-        hexs = data["hex"]
-        # Fill na values with 0 in numerical columns
-        hexs[hexs.select_dtypes(include="number").columns] = hexs.select_dtypes(
-            include="number"
-        ).fillna(0)
-        # Fill na values with "N" in categorical columns
-        hexs[hexs.select_dtypes(include="object").columns] = hexs.select_dtypes(
-            include="object"
-        ).fillna("N")
-
-        microregion = data["selected_microregion"].iloc[0]
-        microregion_hexs = hexs.clip(box(*microregion.geometry.bounds).buffer(0.005))
+    # Variables of each index (an index needs at least one of them switched on)
+    switches_needed = {
+        "create-capacity-index-button": [capacity_switches],
+        "create-access-index-button": [access_switches],
+        "run-hotspot-analysis-button": [capacity_switches, access_switches],
+    }.get(button_clicked, [])
+    if not all(any(switches) for switches in switches_needed):
+        return no_update, no_update, no_update, no_update
+
+    if button_clicked and code_micro is not None:
+        # Features of the hexagons of the microregion, the results are kept in the
+        # analysis state of the session
+        microregion_hexs = read_microregion_hexagons(
+            code_micro,
+            list(capacity_var_labels) + list(access_var_labels),
+            index=microregion_bbox_hexs_index,
+        )
+        hex_ids = pd.Index(microregion_hexs["hex"], name="hex")
 
         if button_clicked == "create-capacity-index-button":
             print("Calculating capacity index ...")
@@ -879,19 +953,15 @@ def calculate_index_callback(
                 capacity_sliders,
             )
 
-            # Create empty columns for the capacity index and the two scores
-            hexs = hexs.assign(
-                capacity_index=np.nan, capacity_gi=np.nan, capacity_psim=np.nan
+            # Save the capacity index and the two scores of the microregion
+            analysis_state.update(
+                session_id,
+                code_micro,
+                capacity_index=pd.Series(np.asarray(capacity_index), index=hex_ids),
+                capacity_gi=pd.Series(np.asarray(capacity_gi), index=hex_ids),
+                capacity_psim=pd.Series(np.asarray(capacity_psim), index=hex_ids),
             )
 
-            # Add the capacity index to the hexagons dataframe
-            hexs.loc[microregion_hexs.index, "capacity_index"] = capacity_index
-            hexs.loc[microregion_hexs.index, "capacity_gi"] = capacity_gi
-            hexs.loc[microregion_hexs.index, "capacity_psim"] = capacity_psim
-
-            # Update the data dictionary
-            data["hex"] = hexs
-
             # Add the capacity index to the color variable options
             color_options_state = [
                 opt for opt in color_options_state if opt["value"] != "capacity_index"
@@ -903,7 +973,6 @@ def calculate_index_callback(
                     "group": "Schools Capacity",
                 }
             )
-            column_labels["capacity_index"] = "Capacity Index"
 
             return (
                 color_options_state,
@@ -918,22 +987,16 @@ def calculate_index_callback(
                 microregion_hexs, access_var_labels, access_switches, access_sliders
             )
 
-            # Create empty columns for the capacity index and the two scoresç
-            hexs = hexs.assign(
-                accessibility_index=np.nan,
-                accessibility_gi=np.nan,
-                accessibility_psim=np.nan,
+            # Save the accessibility index and the two scores of the microregion
+            analysis_state.update(
+                session_id,
+                code_micro,
+                accessibility_index=pd.Series(np.asarray(access_index), index=hex_ids),
+                accessibility_gi=pd.Series(np.asarray(access_gi), index=hex_ids),
+                accessibility_psim=pd.Series(np.asarray(access_psim), index=hex_ids),
             )
 
-            # Add the capacity index to the hexagons dataframe
-            hexs.loc[microregion_hexs.index, "accessibility_index"] = access_index
-            hexs.loc[microregion_hexs.index, "accessibility_gi"] = access_gi
-            hexs.loc[microregion_hexs.index, "accessibility_psim"] = access_psim
-
-            # Update the data dictionary
-            data["hex"] = hexs
-
-            # Add the capacity index to the color variable options
+            # Add the accessibility index to the color variable options
             color_options_state = [
                 opt
                 for opt in color_options_state
@@ -946,7 +1009,6 @@ def calculate_index_callback(
                     "group": "Schools Accessibility",
                 }
             )
-            column_labels["accessibility_index"] = "Accessibility Index"
 
             return (
                 color_options_state,
@@ -956,52 +1018,64 @@ def calculate_index_callback(
             )
 
         if button_clicked == "run-hotspot-analysis-button":
+            results = analysis_state.get(session_id, code_micro)
             # Check if the capacity and accessibility indexes are available
-            if ("capacity_index" in hexs.columns) and (
-                "accessibility_index" in hexs.columns
+            if (
+                results is not None
+                and "capacity_index" in results.columns
+                and "accessibility_index" in results.columns
             ):
                 # Run the crossed analysis
                 print("Running hotspot analysis ...")
+                start = time.time()
+                # Recompute the indexes with permutation p-values. The indexes, Gi
+                # and p-values all come from the current switches and sliders, which
+                # may differ from the ones of the previews
+                capacity_index, capacity_gi, capacity_psim = calculate_index(
+                    microregion_hexs,
+                    capacity_var_labels,
+                    capacity_switches,
+                    capacity_sliders,
+                    method="permutation",
+                )
+                access_index, access_gi, access_psim = calculate_index(
+                    microregion_hexs,
+                    access_var_labels,
+                    access_switches,
+                    access_sliders,
+                    method="permutation",
+                )
+                print(f"Permutations run in {time.time() - start:.2f} seconds")
+
                 # Create clusters
                 pvalue = 0.05
                 start = time.time()
                 clusters = ha.h3_scores_clusters(
-                    {
-                        "gi": microregion_hexs["capacity_gi"],
-                        "psim": microregion_hexs["capacity_psim"],
-                    },
-                    {
-                        "gi": microregion_hexs["accessibility_gi"],
-                        "psim": microregion_hexs["accessibility_psim"],
-                    },
+                    {"gi": np.asarray(capacity_gi), "psim": np.asarray(capacity_psim)},
+                    {"gi": np.asarray(access_gi), "psim": np.asarray(access_psim)},
                     microregion_hexs,
                     significance=pvalue,  # 95% confidence level
                 )
-                microregion_hexs["clusters"] = clusters.replace(
-                    {"HH": 0, "HL": 1, "LH": 2, "LL": 3, "N": 4}
-                )
 
                 print(f"Clusters created in {time.time() - start:.2f} seconds")
 
-                cluster_labels = ["HH", "HL", "LH", "LL", "N"]
-                ["yellowgreen", "gold", "orange", "red", "lightgray"],
-                [0, 1, 2, 3, 4]
-
-                # Plot clusters in the first element of the third row
-                cluster_counts = microregion_hexs["clusters"].value_counts()
-                cluster_counts = (
-                    cluster_counts.reindex(cluster_labels).fillna(0).astype(int)
+                # Save the clusters and the indexes they come from
+                analysis_state.update(
+                    session_id,
+                    code_micro,
+                    clusters=pd.Series(clusters.to_numpy(), index=hex_ids),
+                    capacity_index=pd.Series(np.asarray(capacity_index), index=hex_ids),
+                    capacity_gi=pd.Series(np.asarray(capacity_gi), index=hex_ids),
+                    capacity_psim=pd.Series(np.asarray(capacity_psim), index=hex_ids),
+                    accessibility_index=pd.Series(
+                        np.asarray(access_index), index=hex_ids
+                    ),
+                    accessibility_gi=pd.Series(np.asarray(access_gi), index=hex_ids),
+                    accessibility_psim=pd.Series(
+                        np.asarray(access_psim), index=hex_ids
+                    ),
                 )
 
-                # Create empty columns for the capacity index and the two scoresç
-                hexs = hexs.assign(clusters=np.nan)
-
-                # Add the capacity index to the hexagons dataframe
-                hexs.loc[microregion_hexs.index, "clusters"] = clusters
-
-                # Update the data dictionary
-                data["hex"] = hexs
-
                 # Add clusters to the color variable options
                 color_options_state = [
                     opt for opt in color_options_state if opt["value"] != "clusters"
@@ -1013,8 +1087,12 @@ def calculate_index_callback(
                         "group": "Analysis Results",
                     }
                 )
-                column_labels["clusters"] = "Cluster Hot-Cold Spots"
 
+                color_palette_state = [
+                    opt
+                    for opt in color_palette_state
+                    if opt["value"] != "clusters_cmap"
+                ]
                 color_palette_state.append(
                     {
                         "value": "clusters_cmap",
@@ -1030,6 +1108,8 @@ def calculate_index_callback(
                     "clusters_cmap",
                 )
 
+    return no_update, no_update, no_update, no_update
+
 
 if __name__ == "__main__":
     app.run(debug=True, port=8888, dev_tools_hot_reload=True)
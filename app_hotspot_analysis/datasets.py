@@ -0,0 +1,177 @@
+import json
+import os
+import time
+
+import geopandas as gpd
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pyproj import CRS
+
+
+class ArrowDataset:
+    """
+    Table stored in an uncompressed Feather (Arrow IPC) file, memory-mapped and read
+    column by column.
+
+    Opening the dataset only reads the schema: the columns are read when they are
+    requested, straight from the mapped file (without decompressing or parsing),
+    and the geometries (WKB, as in GeoParquet) are only decoded by `geometry` and
+    `read_geodataframe`, for the requested rows. The pages of the file are shared
+    by all the processes that map it (e.g. the gunicorn workers of the app) through
+    the OS page cache.
+
+    Parameters
+    ----------
+    path : str
+        Path of the Feather file, see `convert_to_feather`
+    """
+
+    def __init__(self, path):
+        start = time.time()
+        self.path = path
+        # Zero-copy: the buffers of the table point to the mapped file
+        self.table = pa.ipc.open_file(pa.memory_map(path, "r")).read_all()
+
+        geo = json.loads((self.table.schema.metadata or {}).get(b"geo", b"{}"))
+        self.geometry_column = geo.get("primary_column")
+        self.crs = None
+        if self.geometry_column:
+            # PROJJSON, without it GeoParquet geometries are in longitude/latitude
+            crs = geo["columns"][self.geometry_column].get("crs", "OGC:CRS84")
+            self.crs = CRS.from_json_dict(crs) if isinstance(crs, dict) else CRS(crs)
+        self.columns = [
+            name for name in self.table.column_names if name != self.geometry_column
+        ]
+        print(
+            f"Dataset {os.path.basename(path)} ({len(self)} rows, "
+            f"{len(self.columns)} columns) opened in {time.time() - start:.2f} seconds"
+        )
+
+    def __len__(self):
+        return self.table.num_rows
+
+    def _select(self, columns, rows):
+        table = self.table.select(list(columns))
+        if rows is not None:
+            table = table.take(pa.array(np.asarray(rows, dtype=np.int64)))
+        return table
+
+    def read(self, columns=None, rows=None):
+        """
+        Columns of the dataset, without the geometries.
+
+        Parameters
+        ----------
+        columns : list of str, optional
+            Columns to read. Default is None (all of them).
+        rows : array-like, optional
+            Positions of the rows to read. Default is None (all of them).
+
+        Returns
+        -------
+        pd.DataFrame
+            Columns of the rows, indexed by their positions in the dataset
+        """
+        columns = self.columns if columns is None else list(dict.fromkeys(columns))
+        # split_blocks avoids copying the columns into a single block
+        df = self._select(columns, rows).to_pandas(split_blocks=True)
+        df.index = np.arange(len(self)) if rows is None else np.asarray(rows)
+        return df
+
+    def geometry(self, rows=None):
+        """
+        Geometries of the dataset (or of some rows), decoded from WKB.
+        """
+        wkb = self._select([self.geometry_column], rows).column(0).to_numpy()
+        return gpd.GeoSeries.from_wkb(
+            wkb,
+            index=np.arange(len(self)) if rows is None else np.asarray(rows),
+            crs=self.crs,
+        )
+
+    def read_geodataframe(self, columns=None, rows=None):
+        """
+        Columns of the dataset with the geometries, see `read`.
+        """
+        return gpd.GeoDataFrame(
+            self.read(columns, rows), geometry=self.geometry(rows), crs=self.crs
+        )
+
+
+def convert_to_feather(parquet_path, feather_path, batch_size=1_000_000):
+    """
+    Convert a (Geo)Parquet file to an uncompressed Feather file, keeping the
+    schema metadata (the GeoParquet geometry column and CRS). The row groups are
+    converted one batch at a time, so the whole table is never in memory.
+    """
+    start = time.time()
+    parquet_file = pq.ParquetFile(parquet_path)
+    # Written to a temporary file first, so the processes converting the same file
+    # at the same time never map a partial file
+    tmp_path = f"{feather_path}.{os.getpid()}.tmp"
+    with pa.ipc.new_file(
+        tmp_path,
+        parquet_file.schema_arrow,
+        options=pa.ipc.IpcWriteOptions(compression=None),
+    ) as writer:
+        for batch in parquet_file.iter_batches(batch_size=batch_size):
+            writer.write_batch(batch)
+    os.replace(tmp_path, feather_path)
+    print(
+        f"{os.path.basename(parquet_path)} converted to Feather in "
+        f"{time.time() - start:.2f} seconds"
+    )
+
+
+def open_dataset(parquet_path):
+    """
+    Open a (Geo)Parquet file as an ArrowDataset, converting it to a Feather file
+    next to it (same name, .feather extension) the first time, or when the Parquet
+    file is newer than the Feather file.
+    """
+    feather_path = os.path.splitext(parquet_path)[0] + ".feather"
+    if not os.path.exists(feather_path) or (
+        os.path.getmtime(feather_path) < os.path.getmtime(parquet_path)
+    ):
+        convert_to_feather(parquet_path, feather_path)
+    return ArrowDataset(feather_path)
+
+
+if __name__ == "__main__":
+    # Startup and per-callback reads: the eager GeoParquet read (as before) against
+    # the memory-mapped dataset
+    import resource
+    import sys
+
+    path = (
+        sys.argv[1]
+        if len(sys.argv) > 1
+        else "../outputs/20240129_para_hexs_with_accessibility_capacity_vars.parquet"
+    )
+
+    start = time.time()
+    dataset = open_dataset(path)
+    print(f"Dataset ready in {time.time() - start:.2f} seconds")
+
+    rows = np.sort(np.random.default_rng(0).choice(len(dataset), 5000, replace=False))
+    start = time.time()
+    dataset.read(dataset.columns[:2], rows)
+    print(f"2 columns of {len(rows)} rows read in {time.time() - start:.4f} seconds")
+
+    start = time.time()
+    dataset.read([dataset.columns[0]])
+    print(f"1 full column read in {time.time() - start:.4f} seconds")
+
+    start = time.time()
+    dataset.geometry(rows)
+    print(f"{len(rows)} geometries decoded in {time.time() - start:.4f} seconds")
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"Peak memory with the dataset: {rss:.0f} MB")
+
+    start = time.time()
+    gpd.read_parquet(path)
+    print(f"Eager GeoParquet read in {time.time() - start:.2f} seconds")
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"Peak memory after the eager read: {rss:.0f} MB")
@@ -0,0 +1,358 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+import h3
+import libpysal
+import numpy as np
+import scipy.sparse as sp
+
+
+# Maximum size of the dense local IJ grid, as a multiple of the number of hexagons
+DENSE_GRID_MAX_RATIO = 64
+# Upper bound of the distance between the centers of two adjacent cells, in edge
+# lengths (about sqrt(3) on average, the cells vary in size over the globe)
+CELL_SPACING_MAX_EDGES = 4
+
+
+def h3_to_int(hids):
+    """
+    Convert H3 hexagon ids from their hexadecimal string form to uint64.
+    """
+    return np.fromiter((int(hid, 16) for hid in hids), dtype=np.uint64, count=len(hids))
+
+
+def kring_offsets(kring):
+    """
+    Local IJ offsets of the cells of a k-ring (including the center cell).
+
+    In local IJ coordinates the grid distance between two cells is
+    max(|di|, |dj|, |di - dj|).
+
+    Parameters
+    ----------
+    kring : int
+        Number of rings
+
+    Returns
+    -------
+    numpy.ndarray
+        (3 * kring * (kring + 1) + 1, 2) array of (di, dj) offsets
+    """
+    di, dj = np.meshgrid(
+        np.arange(-kring, kring + 1), np.arange(-kring, kring + 1), indexing="ij"
+    )
+    di, dj = di.ravel(), dj.ravel()
+    inside = np.maximum(np.maximum(np.abs(di), np.abs(dj)), np.abs(di - dj)) <= kring
+    return np.column_stack([di[inside], dj[inside]])
+
+
+def local_ij(hids, anchor):
+    """
+    Local IJ coordinates of a list of hexagons relative to an anchor hexagon.
+
+    Local IJ coordinates are only defined near the anchor (about one icosahedron
+    face away), so some hexagons may fail. Across a pentagon they do not fail but
+    are distorted, see `near_pentagon`.
+
+    Returns
+    -------
+    ij : numpy.ndarray
+        (N, 2) int64 coordinates, 0 for the failed hexagons
+    ok : numpy.ndarray
+        Boolean mask of the hexagons with coordinates
+    """
+    ij = np.zeros((len(hids), 2), dtype=np.int64)
+    ok = np.ones(len(hids), dtype=bool)
+    for pos, hid in enumerate(hids):
+        try:
+            ij[pos] = h3.experimental_h3_to_local_ij(anchor, hid)
+        except Exception:
+            ok[pos] = False
+    return ij, ok
+
+
+def near_pentagon(anchor, radius, kring):
+    """
+    Whether a pentagon is within `radius` + `kring` rings of the anchor hexagon
+    (estimated from the distance between their centers, with a margin), where the
+    local IJ coordinates may be distorted.
+    """
+    res = h3.h3_get_resolution(anchor)
+    max_km = (radius + kring + 1) * CELL_SPACING_MAX_EDGES * h3.edge_length(res, "km")
+    center = h3.h3_to_geo(anchor)
+    return any(
+        h3.point_dist(center, h3.h3_to_geo(pentagon), "km") <= max_km
+        for pentagon in h3.get_pentagon_indexes(res)
+    )
+
+
+def h3_kring_adjacency(hids, kring=1):
+    """
+    Binary adjacency matrix of a list of hexagons, where two hexagons are
+    neighbors if they are within `kring` rings of each other (each hexagon is its
+    own neighbor, like in `h3.k_ring`).
+
+    The hexagons are mapped to local IJ coordinates relative to a hexagon near
+    their center, and the neighbors of all of them are found with one sorted
+    lookup per k-ring offset, instead of one `h3.k_ring` call per hexagon. The
+    hexagons without local IJ coordinates (too far from the anchor) fall back to
+    `h3.k_ring`, and so do all of them when a pentagon is near, since the local IJ
+    coordinates past a pentagon are distorted.
+
+    Parameters
+    ----------
+    hids : list-like
+        H3 hexagon ids, all at the same resolution and without duplicates
+    kring : int, optional
+        Number of rings to be considered. Default is 1.
+
+    Returns
+    -------
+    scipy.sparse.csr_matrix
+        (N, N) adjacency matrix in the order of `hids`
+    """
+    hids = list(hids)
+    n = len(hids)
+    if n == 0:
+        return sp.csr_matrix((0, 0))
+
+    # Anchor at the hexagon containing the mean center of a sample of hexagons
+    sample = hids[:: max(1, n // 1000)]
+    lat, lng = np.mean([h3.h3_to_geo(hid) for hid in sample], axis=0)
+    anchor = h3.geo_to_h3(lat, lng, h3.h3_get_resolution(hids[0]))
+
+    ij, ok = local_ij(hids, anchor)
+    if ok.any():
+        di, dj = (ij[ok] - h3.experimental_h3_to_local_ij(anchor, anchor)).T
+        radius = np.maximum(np.maximum(np.abs(di), np.abs(dj)), np.abs(di - dj)).max()
+        if near_pentagon(anchor, radius, kring):
+            ok[:] = False
+    ok_pos = np.flatnonzero(ok)
+    rows, cols = [], []
+
+    if len(ok_pos):
+        # Encode the coordinates (shifted by kring so offsets never wrap) as int64 keys
+        ij = ij[ok_pos]
+        ij_min = ij.min(axis=0) - kring
+        width = ij[:, 1].max() - ij_min[1] + kring + 1
+        keys = (ij[:, 0] - ij_min[0]) * width + (ij[:, 1] - ij_min[1])
+        grid_size = (ij[:, 0].max() - ij_min[0] + kring + 1) * width
+        offsets = kring_offsets(kring) @ np.array([width, 1])
+
+        if grid_size <= DENSE_GRID_MAX_RATIO * len(keys):
+            # Dense grid with the position of the hexagon at each key (-1 if empty)
+            grid = np.full(grid_size, -1, dtype=np.int64)
+            grid[keys] = ok_pos
+            for offset in offsets:
+                neighbors = grid[keys + offset]
+                match = neighbors >= 0
+                rows.append(ok_pos[match])
+                cols.append(neighbors[match])
+        else:
+            # Sparse set of hexagons (e.g. far apart regions), sorted lookup
+            order = np.argsort(keys)
+            sorted_keys = keys[order]
+            sorted_pos = ok_pos[order]
+            for offset in offsets:
+                # The candidates are sorted too, which keeps searchsorted cache friendly
+                candidates = sorted_keys + offset
+                idx = np.searchsorted(sorted_keys, candidates)
+                idx[idx == len(sorted_keys)] = 0
+                match = sorted_keys[idx] == candidates
+                rows.append(sorted_pos[match])
+                cols.append(sorted_pos[idx[match]])
+
+    fallback = np.flatnonzero(~ok)
+    if len(fallback):
+        positions = {hid: pos for pos, hid in enumerate(hids)}
+        for pos in fallback:
+            neighbors = [positions[hid] for hid in h3.k_ring(hids[pos], kring) if hid in positions]
+            # Both directions, the other hexagon may have IJ coordinates
+            rows.append(np.array([pos] * len(neighbors) + neighbors, dtype=np.int64))
+            cols.append(np.array(neighbors + [pos] * len(neighbors), dtype=np.int64))
+
+    rows = np.concatenate(rows)
+    cols = np.concatenate(cols)
+    adjacency = sp.csr_matrix(
+        (np.ones(len(rows), dtype=np.float64), (rows, cols)), shape=(n, n)
+    )
+    # Pairs found twice (fallback hexagons) are summed, keep them binary
+    adjacency.data[:] = 1.0
+    return adjacency
+
+
+def wsp_from_hids(hids, kring=1):
+    """
+    Create a sparse spatial weights object from a list of hexagons and a k-ring,
+    see `h3_kring_adjacency`. Use `libpysal.weights.W.from_WSP` to get a full
+    `W` (e.g. for esda).
+
+    Parameters
+    ----------
+    hids : list-like
+        List of hexagons ids
+    kring : int, optional
+        Number of rings to be considered. Default is 1.
+
+    Returns
+    -------
+    libpysal.weights.WSP
+        Sparse spatial weights with the hexagons ids as id_order
+    """
+    hids = list(hids)
+    return libpysal.weights.WSP(h3_kring_adjacency(hids, kring), id_order=hids)
+
+
+class WeightsCache:
+    """
+    Memory-bounded LRU cache of k-ring spatial weights.
+
+    Entries are keyed by a hash of the (sorted) set of hexagon ids and the k-ring,
+    so the same hexagons in a different order reuse the entry: the adjacency is
+    kept sorted by id and permuted to the requested order.
+
+    Parameters
+    ----------
+    max_bytes : int, optional
+        Approximate maximum memory of the cached weights. Default is 1 GB.
+    """
+
+    def __init__(self, max_bytes=1024**3):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.nbytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _sizeof(adjacency):
+        # CSR arrays plus the neighbors and weights dicts of the libpysal W
+        csr_bytes = adjacency.data.nbytes + adjacency.indices.nbytes + adjacency.indptr.nbytes
+        return csr_bytes + adjacency.nnz * 80
+
+    def get(self, hids, kring=1):
+        """
+        Spatial weights of a list of hexagons, in the order of `hids`.
+
+        Parameters
+        ----------
+        hids : list-like
+            List of hexagons ids
+        kring : int, optional
+            Number of rings to be considered. Default is 1.
+
+        Returns
+        -------
+        libpysal.weights.W
+            Spatial weights with the hexagons ids as id_order. It is shared with
+            later calls in the same order, so it must not be modified (setting the
+            transform, as esda does, is fine).
+        """
+        hids = list(hids)
+        ids = h3_to_int(hids)
+        order = np.argsort(ids, kind="stable")
+        key = (hashlib.blake2b(ids[order].tobytes(), digest_size=16).hexdigest(), kring)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        if entry is None:
+            adjacency = h3_kring_adjacency(hids, kring)
+            w = libpysal.weights.W.from_WSP(libpysal.weights.WSP(adjacency, id_order=hids))
+            entry = {"adjacency": adjacency[order][:, order], "ids": ids, "w": w}
+            self._put(key, entry)
+            return w
+
+        if not np.array_equal(entry["ids"], ids):
+            # Same hexagons in another order, permute the sorted adjacency. The new
+            # weights are not stored, the entry is shared with the other threads
+            rank = np.empty(len(order), dtype=np.int64)
+            rank[order] = np.arange(len(order))
+            adjacency = entry["adjacency"][rank][:, rank]
+            return libpysal.weights.W.from_WSP(libpysal.weights.WSP(adjacency, id_order=hids))
+        return entry["w"]
+
+    def _put(self, key, entry):
+        size = self._sizeof(entry["adjacency"])
+        with self._lock:
+            if size > self.max_bytes:
+                return
+            self._entries[key] = entry
+            entry["nbytes"] = size
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.nbytes -= evicted["nbytes"]
+                self.evictions += 1
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": len(self._entries),
+            "nbytes": self.nbytes,
+        }
+
+
+# Weights cache shared by the hotspot analyses of this process
+weights_cache = WeightsCache()
+
+
+if __name__ == "__main__":
+    # Benchmark: one h3.k_ring per hexagon (w_from_hids) against the local IJ builder,
+    # on hexagons around Belém (100k) and a state-wide sized set (1M)
+    import time
+    import pandas as pd
+
+    def kring_adjacency(hids, kring):
+        shids = set(hids)
+        positions = {hid: pos for pos, hid in enumerate(hids)}
+        rows, cols = [], []
+        for hid in hids:
+            neighbors = h3.k_ring(hid, kring).intersection(shids)
+            rows += [positions[hid]] * len(neighbors)
+            cols += [positions[nei] for nei in neighbors]
+        return sp.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(len(hids), len(hids)))
+
+    rng = np.random.default_rng(0)
+    center_hex = h3.geo_to_h3(-1.4558, -48.4902, 8)
+    results = []
+    for size, radius in [(100_000, 182), (1_000_000, 577)]:
+        hids = list(h3.k_ring(center_hex, radius))
+        # Drop 30% of the hexagons (e.g. rivers and hexagons without population)
+        hids = [hids[i] for i in np.sort(rng.choice(len(hids), int(size * 0.7), replace=False))]
+        for kring in range(1, 6):
+            start = time.time()
+            adjacency = h3_kring_adjacency(hids, kring)
+            elapsed_ij = time.time() - start
+
+            elapsed_kring = np.nan
+            if size <= 100_000:
+                start = time.time()
+                expected = kring_adjacency(hids, kring)
+                elapsed_kring = time.time() - start
+                assert (adjacency != expected).nnz == 0
+
+            results.append(
+                {
+                    "hexagons": len(hids),
+                    "kring": kring,
+                    "neighbors": adjacency.nnz,
+                    "k_ring per hexagon (s)": elapsed_kring,
+                    "local IJ (s)": elapsed_ij,
+                }
+            )
+            print(results[-1])
+
+    print(pd.DataFrame(results).to_string(index=False))
@@ -1,3 +1,5 @@
+import numpy as np
+import pandas as pd
 import matplotlib.pyplot as plt
 import matplotlib.colors as mcolors
 from matplotlib import colormaps as mcmaps
@@ -109,3 +111,125 @@ cmaps_options = [
         ],
     ),
 ]
+
+
+# Number of colors of the lookup tables of the continuous colormaps
+LUT_SIZE = 256
+
+# Lookup tables by colormap name, see colormap_lut
+colormap_luts = {}
+
+
+def to_rgba_uint8(colors):
+    """
+    Convert matplotlib colors (names, hex strings or float RGBA) to a (N, 4) uint8
+    array.
+    """
+    return np.round(mcolors.to_rgba_array(colors) * 255).astype(np.uint8)
+
+
+def colormap_lut(cmap):
+    """
+    Lookup table of a colormap: a (LUT_SIZE + 1, 4) uint8 array with the colors of
+    LUT_SIZE evenly spaced values between 0 and 1, plus the "bad" color (for NaN)
+    in the last row. The tables of the registered colormaps are computed once.
+
+    Parameters
+    ----------
+    cmap : str or matplotlib.colors.Colormap
+        Colormap or name of a registered colormap
+    """
+    if not isinstance(cmap, str):
+        # Not cached, e.g. resampled colormaps keep the name of the original one
+        return np.vstack(
+            [
+                to_rgba_uint8(cmap(np.linspace(0, 1, LUT_SIZE))),
+                to_rgba_uint8([cmap.get_bad()]),
+            ]
+        )
+    if cmap not in colormap_luts:
+        colormap_luts[cmap] = colormap_lut(mcmaps[cmap])
+    return colormap_luts[cmap]
+
+
+def encode_continuous(values, cmap, vmin=None, vmax=None):
+    """
+    RGBA colors of numerical values, normalized between `vmin` and `vmax` (by
+    default the minimum and maximum of the values) and looked up in the colormap
+    table. NaN values get the "bad" color of the colormap.
+
+    Parameters
+    ----------
+    values : array-like
+        (N,) values
+    cmap : str or matplotlib.colors.Colormap
+        Colormap or name of a registered colormap
+    vmin, vmax : float, optional
+        Values mapped to the first and last colors. Default is None.
+
+    Returns
+    -------
+    numpy.ndarray
+        (N, 4) uint8 colors
+    """
+    values = np.asarray(values, dtype=np.float64)
+    lut = colormap_lut(cmap)
+    vmin = np.nanmin(values) if vmin is None else vmin
+    vmax = np.nanmax(values) if vmax is None else vmax
+
+    scale = LUT_SIZE / (vmax - vmin) if vmax > vmin else 0.0
+    with np.errstate(invalid="ignore"):
+        idx = np.clip((values - vmin) * scale, 0, LUT_SIZE - 1)
+    # NaN values point to the "bad" color in the last row
+    idx = np.where(np.isnan(values), LUT_SIZE, idx).astype(np.intp)
+    return lut[idx]
+
+
+def encode_categorical(values, palette, categories=None, missing_color="lightgray"):
+    """
+    RGBA colors of categorical values, through their integer codes: the color of
+    a value is the row of its category in the palette.
+
+    Parameters
+    ----------
+    values : array-like
+        (N,) values
+    palette : str, matplotlib.colors.Colormap or list
+        Colormap (resampled to the number of categories) or list of colors, one
+        per category
+    categories : list, optional
+        Categories in the order of the palette. Default is None (the sorted unique
+        values).
+    missing_color : color, optional
+        Color of the missing values and of the values not in `categories`. Default
+        is "lightgray".
+
+    Returns
+    -------
+    colors : numpy.ndarray
+        (N, 4) uint8 colors
+    categories : pandas.Index
+        Categories, in the order of the palette
+    palette : numpy.ndarray
+        (len(categories), 4) uint8 colors of the categories
+    """
+    values = pd.Categorical(values, categories=categories)
+    categories = values.categories
+    if isinstance(palette, (str, mcolors.Colormap)):
+        cmap = mcmaps[palette] if isinstance(palette, str) else palette
+        palette = cmap.resampled(max(len(categories), 1))(range(len(categories)))
+    palette = to_rgba_uint8(palette)
+
+    # Missing values have code -1, the last row of the table
+    table = np.vstack([palette, to_rgba_uint8([missing_color])])
+    return table[values.codes], categories, palette
+
+
+def rgba_column(colors):
+    """
+    Per-row color lists for a pydeck layer column, dropping the alpha channel
+    when all the colors are opaque (deck.gl defaults it to 255).
+    """
+    if (colors[:, 3] == 255).all():
+        colors = colors[:, :3]
+    return colors.tolist()
@@ -0,0 +1,267 @@
+"""
+Canonical format of the H3 hexagon tables shared by the notebooks and the apps:
+Parquet files without geometries, with the H3 ids as uint64 (`hex_id`) and typed
+attribute columns, sorted by id so the nearby hexagons are stored together.
+
+The H3 id already encodes the hexagon, so the geometries (boundaries, polygons,
+centroids or bounding boxes) are derived from the ids on demand, only for the
+hexagons being rendered or clipped.
+
+The notebooks import it from the root of the repository as
+`app_hotspot_analysis.hex_store`.
+
+Usage (convert a GeoParquet file with a `hex` column of H3 ids):
+    python app_hotspot_analysis/hex_store.py \
+        outputs/20240129_para_hexs_with_accessibility_capacity_vars.parquet \
+        outputs/20240129_para_hexs_with_accessibility_capacity_vars_hex_store.parquet
+"""
+
+import itertools
+import json
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import shapely
+from h3.api import basic_int as h3_int
+
+HEX_ID = "hex_id"
+FORMAT_VERSION = 1
+# Key of the format metadata in the Parquet schema
+METADATA_KEY = b"hex_store"
+
+# Bit layout of the 64-bit H3 cell index
+H3_RES_OFFSET = 52
+
+
+def h3_to_int(hex_ids):
+    """
+    Convert H3 hexagon ids from their hexadecimal string form to uint64.
+    """
+    return np.fromiter(
+        (int(hex_id, 16) for hex_id in hex_ids), dtype=np.uint64, count=len(hex_ids)
+    )
+
+
+def int_to_h3(hex_ids):
+    """
+    Convert uint64 H3 hexagon ids to their hexadecimal string form.
+    """
+    return [format(hex_id, "x") for hex_id in np.asarray(hex_ids).tolist()]
+
+
+def h3_resolution(hex_ids):
+    """
+    Resolution of uint64 H3 ids, read from their resolution bits.
+    """
+    return (np.asarray(hex_ids, dtype=np.uint64) >> np.uint64(H3_RES_OFFSET)) & np.uint64(
+        0xF
+    )
+
+
+def to_hex_store(df, hex_col="hex"):
+    """
+    Table of hexagons in the hex store format: the geometry column dropped, the H3
+    ids of `hex_col` as the first column `hex_id` (uint64) and the rows sorted by id.
+
+    Parameters
+    ----------
+    df : pd.DataFrame or gpd.GeoDataFrame
+        Hexagons with their H3 ids (hexadecimal strings or integers)
+    hex_col : str, optional
+        Column with the H3 ids. Default is "hex".
+
+    Returns
+    -------
+    pd.DataFrame
+        New DataFrame without geometries
+    """
+    if isinstance(df, gpd.GeoDataFrame):
+        df = pd.DataFrame(df.drop(columns=df.geometry.name))
+    hex_ids = df[hex_col]
+    if pd.api.types.is_integer_dtype(hex_ids):
+        hex_ids = hex_ids.to_numpy(dtype=np.uint64)
+    else:
+        hex_ids = h3_to_int(hex_ids)
+    if len(np.unique(h3_resolution(hex_ids))) > 1:
+        raise ValueError("All the hexagons must have the same H3 resolution")
+
+    df = df.drop(columns=hex_col)
+    df.insert(0, HEX_ID, hex_ids)
+    return df.sort_values(HEX_ID, kind="stable").reset_index(drop=True)
+
+
+def write_hex_store(df, path, hex_col="hex"):
+    """
+    Write a table of hexagons in the hex store format, see `to_hex_store`.
+    """
+    df = to_hex_store(df, hex_col)
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    metadata = {
+        "version": FORMAT_VERSION,
+        "hex_column": HEX_ID,
+        "resolution": int(h3_resolution(df[HEX_ID].to_numpy()[:1])[0]) if len(df) else None,
+    }
+    table = table.replace_schema_metadata(
+        {**(table.schema.metadata or {}), METADATA_KEY: json.dumps(metadata).encode()}
+    )
+    pq.write_table(table, path)
+
+
+def read_hex_store_metadata(path):
+    """
+    Format metadata of a hex store file (version, hex column and resolution).
+    """
+    metadata = pq.read_schema(path).metadata or {}
+    if METADATA_KEY not in metadata:
+        raise ValueError(f"{path} is not a hex store file, see write_hex_store")
+    return json.loads(metadata[METADATA_KEY])
+
+
+def read_hex_store(path, columns=None, filters=None):
+    """
+    Read a hex store file (only the requested columns and rows), with the
+    `hex_id` column.
+
+    Parameters
+    ----------
+    path : str
+        Path of the file
+    columns : list of str, optional
+        Columns to read, besides `hex_id`. Default is None (all of them).
+    filters : list, optional
+        Row filters, see `pandas.read_parquet`. Default is None.
+
+    Returns
+    -------
+    pd.DataFrame
+        Hexagons, without geometries
+    """
+    read_hex_store_metadata(path)
+    if columns is not None:
+        columns = [HEX_ID] + [column for column in columns if column != HEX_ID]
+    return pd.read_parquet(path, columns=columns, filters=filters)
+
+
+def h3_boundaries(hex_ids):
+    """
+    Boundary vertices of uint64 H3 ids, in a single pass.
+
+    Returns
+    -------
+    coords : numpy.ndarray
+        (M, 2) array with the (lng, lat) vertices of the closed rings of all the
+        hexagons, concatenated
+    counts : numpy.ndarray
+        Number of vertices of each ring (7 for hexagons, more for pentagons and
+        cells crossing icosahedron edges)
+    """
+    boundaries = [
+        h3_int.h3_to_geo_boundary(hex_id, geo_json=True)
+        for hex_id in np.asarray(hex_ids, dtype=np.uint64).tolist()
+    ]
+    counts = np.fromiter(map(len, boundaries), dtype=np.int64, count=len(boundaries))
+    coords = np.array(
+        list(itertools.chain.from_iterable(boundaries)), dtype=np.float64
+    ).reshape(-1, 2)
+    return coords, counts
+
+
+def h3_polygons(hex_ids):
+    """
+    Shapely polygons of uint64 H3 ids, as an array.
+    """
+    coords, counts = h3_boundaries(hex_ids)
+    rings = shapely.linearrings(coords, indices=np.repeat(np.arange(len(counts)), counts))
+    return shapely.polygons(rings)
+
+
+def h3_centroids(hex_ids):
+    """
+    Centers of uint64 H3 ids, as a (N, 2) array of (lng, lat).
+    """
+    centers = [
+        h3_int.h3_to_geo(hex_id) for hex_id in np.asarray(hex_ids, dtype=np.uint64).tolist()
+    ]
+    return np.array(centers, dtype=np.float64).reshape(-1, 2)[:, ::-1]
+
+
+def h3_bboxes(hex_ids):
+    """
+    Bounding boxes of uint64 H3 ids, as a (N, 4) array of (minx, miny, maxx, maxy).
+    """
+    coords, counts = h3_boundaries(hex_ids)
+    if len(counts) == 0:
+        return np.empty((0, 4))
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    return np.hstack(
+        [
+            np.minimum.reduceat(coords, starts, axis=0),
+            np.maximum.reduceat(coords, starts, axis=0),
+        ]
+    )
+
+
+def to_geodataframe(df, geometry="polygon"):
+    """
+    GeoDataFrame of some hexagons of a hex store table, with their polygons (or
+    centroids) derived from `hex_id`.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Hexagons with the `hex_id` column, e.g. the ones to render or clip
+    geometry : str, optional
+        "polygon" or "centroid". Default is "polygon".
+
+    Returns
+    -------
+    gpd.GeoDataFrame
+        New GeoDataFrame in EPSG:4326
+    """
+    if geometry == "polygon":
+        geometries = h3_polygons(df[HEX_ID])
+    elif geometry == "centroid":
+        centroids = h3_centroids(df[HEX_ID])
+        geometries = shapely.points(centroids[:, 0], centroids[:, 1])
+    else:
+        raise ValueError(f"Unknown geometry: {geometry}")
+    return gpd.GeoDataFrame(df, geometry=geometries, crs="EPSG:4326")
+
+
+if __name__ == "__main__":
+    import argparse
+    import os
+    import time
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("input", help="GeoParquet file with a column of H3 ids")
+    parser.add_argument("output", help="Hex store file")
+    parser.add_argument("--hex-col", default="hex")
+    args = parser.parse_args()
+
+    start = time.time()
+    hexs = gpd.read_parquet(args.input)
+    print(f"Read {len(hexs)} hexagons in {time.time() - start:.2f} seconds")
+    print(f"Memory with geometries: {hexs.memory_usage(deep=True).sum() / 1e6:.1f} MB")
+
+    start = time.time()
+    write_hex_store(hexs, args.output, args.hex_col)
+    print(f"Hex store written in {time.time() - start:.2f} seconds")
+    print(
+        f"File size: {os.path.getsize(args.input) / 1e6:.1f} MB (GeoParquet), "
+        f"{os.path.getsize(args.output) / 1e6:.1f} MB (hex store)"
+    )
+
+    start = time.time()
+    hex_df = read_hex_store(args.output)
+    print(f"Hex store read in {time.time() - start:.2f} seconds")
+    print(f"Memory without geometries: {hex_df.memory_usage(deep=True).sum() / 1e6:.1f} MB")
+
+    # Geometries of a render-sized subset only
+    sample = hex_df.sample(min(len(hex_df), 10_000), random_state=0)
+    start = time.time()
+    to_geodataframe(sample)
+    print(f"Polygons of {len(sample)} hexagons in {time.time() - start:.3f} seconds")
@@ -9,48 +9,100 @@ import urbanpy as up
 import h3
 import libpysal
 import contextily as ctx
-from esda.getisord import G_Local
+
+from gistar import g_local_star, g_local_star_normal
+from h3_weights import weights_cache
+
+# Features and weights of the two scores
+ACCESS_FEATURES = [
+    "population_2020",  # Higher better
+    "pop_6_14_years_adj",  # Higher better
+    "income_pc",  # Higher better
+    "ensino_fundamental",  # Higher better
+    "duration_to_school_min_by_foot",  # Lower better
+    "schools_within_15min_travel_time_car",  # Higher better
+]
+ACCESS_WEIGHTS = [0.2, 0.2, 0.2, 0.2, 0.1, 0.1]
+
+CAPACITY_FEATURES = [
+    "students_per_professor_FUND",
+    "students_per_class_FUND",
+    "IED_NIV_4_FUND",
+    "IED_NIV_5_FUND",
+    "IED_NIV_6_FUND",
+]
+CAPACITY_WEIGHTS = [0.2, 0.2, 0.2, 0.2, 0.2]
+
+# Features where lower values are better, inverted so high scores are always good:
+# a lower duration to school is positive, and a high number of students per
+# professor or class and a higher percentage of professors in effort levels 4, 5
+# and 6 are negative for the capacity of the schools
+INVERTED_FEATURES = ["duration_to_school_min_by_foot"] + CAPACITY_FEATURES
+
+
+def fill_missing_values(hexs: gpd.GeoDataFrame):
+    """
+    Fill the missing values with 0 in numerical columns and "N" in categorical
+    ones, in a new GeoDataFrame.
+    """
+    numeric = hexs.select_dtypes(include="number").columns
+    categorical = hexs.select_dtypes(include="object").columns
+    return hexs.assign(
+        **hexs[numeric].fillna(0),
+        **hexs[categorical].fillna("N"),
+    )
 
 
-def minmax_scaler(col, a=0, b=1):
+def prepare_hexagons(hexs: gpd.GeoDataFrame):
     """
-    Min-max scaler
+    Fill the missing values (see `fill_missing_values`) and invert the features
+    in `INVERTED_FEATURES`.
 
     Parameters
     ----------
-    col : pandas.Series
-        Series to be scaled
-    a : float, optional
-        Min value of the scaled Series. Default is 0.
-    b : float, optional
-        Max value of the scaled Series. Default is 1.
+    hexs : gpd.GeoDataFrame
+        GeoDataFrame with hexagons and features
 
     Returns
     -------
-    pandas.Series
-        Scaled Series
+    gpd.GeoDataFrame
+        New GeoDataFrame ready for `h3_hotspot_analysis`
     """
-
-    return (col - col.min()) * (b - a) / (col.max() - col.min()) + a
+    hexs = fill_missing_values(hexs)
+    inverted = [col for col in INVERTED_FEATURES if col in hexs.columns]
+    return hexs.assign(**hexs[inverted] * -1)
 
 
-def linear_combination(x, w):
+def minmax_scale_block(X, a=0, b=1, dtype=np.float64):
     """
-    Linear combination of features
+    Min-max scale each column of a 2-D array at once.
+
+    Constant columns are scaled to `a` instead of dividing by zero.
 
     Parameters
     ----------
-    row : pandas.Series
-        Series with features to be combined
-    weights : list
-        List of weights for each feature
+    X : array-like
+        (n_samples, n_features) array
+    a : float, optional
+        Min value of the scaled columns. Default is 0.
+    b : float, optional
+        Max value of the scaled columns. Default is 1.
+    dtype : numpy.dtype, optional
+        Dtype of the result, e.g. numpy.float32 to halve the memory. Default is
+        numpy.float64.
 
     Returns
     -------
-    float
-        Linear combination of features
+    numpy.ndarray
+        Scaled array
     """
-    return np.dot(x, w)
+    X = np.asarray(X, dtype=dtype)
+    col_min = X.min(axis=0)
+    col_range = X.max(axis=0) - col_min
+    scale = np.divide(
+        b - a, col_range, out=np.zeros_like(col_range), where=col_range != 0
+    )
+    return (X - col_min) * scale + a
 
 
 def w_from_hids(hids, kring=1):
@@ -79,10 +131,29 @@ def w_from_hids(hids, kring=1):
     return w
 
 
+def check_features(hex_gdf, features_names, features_weights):
+    """
+    Check the weights of each index sum to 1.0 and there are no NA values in the
+    features.
+    """
+    weights_sums = np.atleast_2d(features_weights).sum(axis=1)
+    try:
+        assert np.isclose(weights_sums, 1.0).all()
+    except AssertionError as e:
+        e.args += ("Features weights must sum to 1.0",)
+        raise e
+
+    if hex_gdf[features_names].isna().sum().sum() > 0:
+        raise ValueError(
+            "There are NA values in the features. Please remove/impute NA values."
+        )
+
+
 def composite_spatial_index(
     hex_gdf: gpd.GeoDataFrame,
     features_names: list,
     features_weights: list,
+    dtype=np.float64,
 ):
     """
     Calculate a composite spatial index for a set of features
@@ -95,38 +166,59 @@ def composite_spatial_index(
         List of features names
     features_weights : list
         List of weights for each feature
+    dtype : numpy.dtype, optional
+        Dtype used for the computation. Default is numpy.float64.
 
     Returns
     -------
-    gpd.GeoDataFrame
-        GeoDataFrame with the composite index
+    pandas.Series
+        Composite index of each hexagon
     """
+    check_features(hex_gdf, features_names, features_weights)
 
-    # Check if features weights sum to 1.0
-    try:
-        assert np.array(features_weights).sum() == 1.0
-    except AssertionError as e:
-        e.args += ("Features weights must sum to 1.0",)
-        raise e
+    # Weighted sum of the min-max scaled features, as a matrix-vector product
+    scaled = minmax_scale_block(hex_gdf[features_names], dtype=dtype)
+    composite_score = scaled @ np.asarray(features_weights, dtype=dtype)
 
-    # Check there are no na values in the features
-    if hex_gdf[features_names].isna().sum().sum() > 0:
-        raise ValueError(
-            "There are NA values in the features. Please remove/impute NA values."
-        )
+    return pd.Series(composite_score, index=hex_gdf.index)
 
-    # Create a new column with the weighted sum of mix-max scaled features
-    composite_score = (
-        hex_gdf[features_names]
-        .apply(minmax_scaler, axis=0)  # Make columns values between 0 and 1
-        .apply(
-            linear_combination,
-            w=features_weights,
-            axis=1,  # Row-wise linear combination
-        )
-    )
 
-    return composite_score
+def composite_spatial_indices(
+    hex_gdf: gpd.GeoDataFrame,
+    features_names: list,
+    weights_matrix,
+    dtype=np.float64,
+):
+    """
+    Calculate the composite spatial index of a set of features for many weight
+    vectors at once (e.g. for a sensitivity analysis of the weights), as a single
+    matrix product.
+
+    Parameters
+    ----------
+    hex_gdf : gpd.GeoDataFrame
+        GeoDataFrame with hexagons and features
+    features_names : list
+        List of features names
+    weights_matrix : array-like or pandas.DataFrame
+        (n_indices, n_features) weights, each row summing to 1.0. The index of a
+        DataFrame is used as the names of the indices.
+    dtype : numpy.dtype, optional
+        Dtype used for the computation. Default is numpy.float64.
+
+    Returns
+    -------
+    pandas.DataFrame
+        Composite index of each hexagon (rows) for each weight vector (columns)
+    """
+    columns = getattr(weights_matrix, "index", None)
+    weights_matrix = np.atleast_2d(np.asarray(weights_matrix, dtype=dtype))
+    check_features(hex_gdf, features_names, weights_matrix)
+
+    scaled = minmax_scale_block(hex_gdf[features_names], dtype=dtype)
+    composite_scores = scaled @ weights_matrix.T
+
+    return pd.DataFrame(composite_scores, index=hex_gdf.index, columns=columns)
 
 
 # Create a function to streamline the process
@@ -136,6 +228,11 @@ def h3_hotspot_analysis(
     features_weights: list,
     spatial_weights: libpysal.weights.W = None,
     kring: int = 3,
+    permutations: int = 999,
+    seed: int = None,
+    n_jobs: int = -1,
+    early_stopping: bool = False,
+    method: str = "permutation",
 ):
     """
     Perform a hotspot analysis for a set of features
@@ -150,24 +247,58 @@ def h3_hotspot_analysis(
         List of features names
     features_weights : list
         List of weights for each feature
+    spatial_weights : libpysal.weights.W or libpysal.weights.WSP, optional
+        Spatial weights of the hexagons, in the same order. Default is None (k-ring
+        weights from the weights cache).
     kring : int, optional
-        Number of rings to be considered. Default is 1.
+        Number of rings to be considered. Default is 3.
+    permutations : int, optional
+        Number of permutations of the pseudo p-values. Default is 999.
+    seed : int, optional
+        Seed of the permutations. Default is None.
+    n_jobs : int, optional
+        Number of threads of the permutations, -1 for all the cores. Default is -1.
+    early_stopping : bool, optional
+        Stop permuting the hexagons whose p-value is clearly resolved, see
+        `gistar.g_local_star`. Default is False.
+    method : str, optional
+        "permutation" for pseudo p-values from conditional permutations, or
+        "analytical" for normal approximation p-values in closed form (for quick
+        previews, the permutation parameters are ignored). Default is
+        "permutation".
 
     Returns
     -------
     gpd.GeoDataFrame
         GeoDataFrame with the composite index
     """
+    if method not in ("permutation", "analytical"):
+        raise ValueError(f"Unknown method: {method}")
 
     # Create a composite spatial index
     composite_score = composite_spatial_index(hex_gdf, features_names, features_weights)
 
-    spatial_weights = w_from_hids(hex_gdf["hex"], kring=kring)
-
-    # Perform a spatial hotspot analysis
-    hotspot = G_Local(composite_score, spatial_weights, star=True)
+    # k-ring weights of the hexagons, reused across analyses (see h3_weights.py)
+    if spatial_weights is None:
+        spatial_weights = weights_cache.get(hex_gdf["hex"], kring=kring)
+    elif isinstance(spatial_weights, libpysal.weights.WSP):
+        spatial_weights = libpysal.weights.W.from_WSP(spatial_weights)
+
+    # Perform a spatial hotspot analysis (Getis-Ord Gi*, see gistar.py)
+    if method == "analytical":
+        Zs, p_norm = g_local_star_normal(composite_score, spatial_weights)
+        return composite_score, Zs, p_norm
+
+    Zs, p_sim = g_local_star(
+        composite_score,
+        spatial_weights,
+        permutations=permutations,
+        seed=seed,
+        n_jobs=n_jobs,
+        early_stopping=early_stopping,
+    )
 
-    return composite_score, hotspot.Zs, hotspot.p_sim
+    return composite_score, Zs, p_sim
 
 
 def h3_scores_clusters(
@@ -220,56 +351,38 @@ if __name__ == "__main__":
     import matplotlib.colors as mcolors
     from tqdm import tqdm
 
-    # Load data
+    from hex_store import h3_centroids, int_to_h3, read_hex_store, to_geodataframe
+
+    # Load data (without geometries)
     start = time.time()
-    hexs = gpd.read_parquet(
-        "outputs/20240129_para_hexs_with_accessibility_capacity_vars.parquet"
+    hexs = read_hex_store(
+        "outputs/20240129_para_hexs_with_accessibility_capacity_vars_hex_store.parquet"
     )
+    hexs["hex"] = int_to_h3(hexs["hex_id"])
+    centroids = h3_centroids(hexs["hex_id"])
     print(f"Data loaded in {time.time() - start:.2f} seconds")
 
-    # Fill na values with 0 in numerical columns
-    hexs[hexs.select_dtypes(include="number").columns] = hexs.select_dtypes(
-        include="number"
-    ).fillna(0)
-    # Fill na values with "N" in categorical columns
-    hexs[hexs.select_dtypes(include="object").columns] = hexs.select_dtypes(
-        include="object"
-    ).fillna("N")
-
-    # Define features and weights for the two scores
-    access_features = [
-        "population_2020",  # Higher better
-        "pop_6_14_years_adj",  # Higher better
-        "income_pc",  # Higher better
-        "ensino_fundamental",  # Higher better
-        "duration_to_school_min_by_foot",  # Lower better
-        "schools_within_15min_travel_time_car",  # Higher better
-    ]
-    # A lower duration to school is considered positive, we need to invert the values of this feature
-    hexs["duration_to_school_min_by_foot"] = hexs["duration_to_school_min_by_foot"] * -1
-    access_weights = [0.2, 0.2, 0.2, 0.2, 0.1, 0.1]
-
-    capacity_features = [
-        "students_per_professor_FUND",
-        "students_per_class_FUND",
-        "IED_NIV_4_FUND",
-        "IED_NIV_5_FUND",
-        "IED_NIV_6_FUND",
-    ]
-    capacity_weights = [0.2, 0.2, 0.2, 0.2, 0.2]
-
-    # High number of students per professor or class and higher percentage of professors in effort levels 4, 5 and 6 are considered negative
-    # Since to consider the capacity of the schools, we want to consider the opposite of the values of these features
-    # To do this we will multiply these features by -1, this will make high values of the final score to be considered as good capacity and low values as bad capacity
+    # Fill na values and invert the features where lower is better
     start = time.time()
-    hexs[capacity_features] = hexs[capacity_features] * -1
-    print(f"Capacity features inverted in {time.time() - start:.2f} seconds")
+    hexs = prepare_hexagons(hexs)
+    print(f"Hexagons prepared in {time.time() - start:.2f} seconds")
+
+    access_features, access_weights = ACCESS_FEATURES, ACCESS_WEIGHTS
+    capacity_features, capacity_weights = CAPACITY_FEATURES, CAPACITY_WEIGHTS
 
     microregions = gpd.read_parquet("outputs/para_micro_regions.parquets")
     microregions_sample = microregions.sample(5)
 
     for index, microregion in tqdm(microregions_sample.iterrows()):
-        microregion_hexs = hexs.clip(box(*microregion.geometry.bounds).buffer(0.005))
+        # Hexagons centered in the buffered bounding box, with their polygons
+        minx, miny, maxx, maxy = box(*microregion.geometry.bounds).buffer(0.005).bounds
+        inside = (
+            (centroids[:, 0] >= minx)
+            & (centroids[:, 0] <= maxx)
+            & (centroids[:, 1] >= miny)
+            & (centroids[:, 1] <= maxy)
+        )
+        microregion_hexs = to_geodataframe(hexs[inside])
 
         # Perform hotspot analysis
         start = time.time()
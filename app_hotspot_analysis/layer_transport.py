@@ -0,0 +1,403 @@
+import gzip
+import hashlib
+import io
+import json
+import os
+import re
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+import flask
+import numpy as np
+import pyarrow as pa
+
+from helper_colormaps import rgba_column
+
+
+class HexLayerStore:
+    """
+    Server-side store of the data of the H3 hexagon layers, served by URL (see
+    `register_routes`) instead of embedded in the deck JSON.
+
+    Each layer is stored as three columns: the hexagon ids, their colors and their
+    elevations, without the geometries or any other column. The layer data is sent
+    as compact JSON records {"h": hex, "c": [r, g, b], "e": elevation} (gzip
+    compressed when the browser accepts it), which deck.gl fetches and parses by
+    itself, or as an Arrow IPC stream with `?format=arrow`.
+
+    The layers are kept in memory or, with a `directory`, as files shared by all the
+    worker processes of the app, so any worker can serve the layer data and its
+    statistics. In both cases the layers beyond the last `max_session_entries` of
+    each session are dropped first, and the oldest of all only past `max_entries`,
+    so the other sessions do not drop the layer of an open map. The statistics of
+    the layers are kept in memory per process, or as files next to the layers.
+
+    Parameters
+    ----------
+    url_prefix : str, optional
+        Prefix of the routes. Default is "/hex-layer".
+    max_entries : int, optional
+        Number of layers kept, the oldest are dropped. Default is 256.
+    max_session_entries : int, optional
+        Number of layers kept of each session. Default is 4.
+    directory : str, optional
+        Directory of the layer files. Default is None (in memory).
+    """
+
+    def __init__(
+        self,
+        url_prefix="/hex-layer",
+        max_entries=256,
+        max_session_entries=4,
+        directory=None,
+    ):
+        self.url_prefix = url_prefix
+        self.max_entries = max_entries
+        self.max_session_entries = max_session_entries
+        self.directory = directory
+        self._layers = OrderedDict()
+        self._sessions = {}
+        self._stats = OrderedDict()
+        self._lock = threading.Lock()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def _path(self, token, extension):
+        return os.path.join(self.directory, f"{token}.{extension}")
+
+    def _write(self, token, extension, data):
+        # Write to a temporary file first, so the other workers never read a
+        # partial file
+        path = self._path(token, extension)
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+
+    @staticmethod
+    def _valid_token(token):
+        # Tokens come from the browser, only the ones put can name a file
+        return re.fullmatch(r"[0-9a-f]+\.[A-Za-z0-9_-]+", token) is not None
+
+    def put(self, hexs, colors, elevations, label=None, session_id=None):
+        """
+        Store the data of a layer and return its URL.
+
+        Parameters
+        ----------
+        hexs : array-like
+            (N,) hexagon ids
+        colors : numpy.ndarray
+            (N, 4) uint8 colors, see `helper_colormaps.encode_continuous`
+        elevations : array-like
+            (N,) elevations
+        label : str, optional
+            Label of the layer in the statistics (e.g. the microregion). Default is
+            None.
+        session_id : str, optional
+            Session of the layer, see `max_session_entries`. Default is None.
+
+        Returns
+        -------
+        str
+            URL of the layer data
+        """
+        start = time.time()
+        hexs = np.asarray(hexs, dtype=object)
+        elevations = np.asarray(elevations, dtype=np.float32)
+
+        # Elevations are only drawn: 3 decimals are enough, and missing ones are flat
+        records = [
+            {"h": h, "c": c, "e": e}
+            for h, c, e in zip(
+                hexs.tolist(),
+                rgba_column(colors),
+                np.round(np.nan_to_num(elevations.astype(np.float64)), 3).tolist(),
+            )
+        ]
+        body = json.dumps(records, separators=(",", ":"), allow_nan=False)
+        layer = {
+            "hexs": hexs,
+            "colors": colors,
+            "elevations": elevations,
+            "json": body.encode(),
+            "gzip": gzip.compress(body.encode(), compresslevel=6),
+        }
+        stats = {
+            "label": None if label is None else str(label),
+            "rows": len(hexs),
+            "json_bytes": len(layer["json"]),
+            "gzip_bytes": len(layer["gzip"]),
+            "build_s": time.time() - start,
+        }
+
+        token = secrets.token_urlsafe(9)
+        if self.directory is not None:
+            # The files of a session share the prefix of their tokens (a hash of the
+            # session id), see _remove_old_files
+            session_prefix = hashlib.blake2b(
+                str(session_id).encode(), digest_size=6
+            ).hexdigest()
+            token = f"{session_prefix}.{token}"
+            self._write(token, "arrow", self.arrow_bytes(layer))
+            self._write(
+                token, "stats.json", json.dumps({"created": time.time(), **stats}).encode()
+            )
+            # Last, the layer is complete when its JSON exists
+            self._write(token, "json.gz", layer["gzip"])
+            self._remove_old_files()
+            print(f"Hexagon layer {token} ({label}): {stats}")
+            return f"{self.url_prefix}/{token}"
+
+        with self._lock:
+            self._layers[token] = layer
+            session_tokens = self._sessions.setdefault(session_id, [])
+            session_tokens.append(token)
+            # Drop the oldest layers of the session, then the oldest of all
+            while len(session_tokens) > self.max_session_entries:
+                self._layers.pop(session_tokens.pop(0), None)
+            while len(self._layers) > self.max_entries:
+                self._layers.popitem(last=False)
+            self._sessions = {
+                session: [t for t in tokens if t in self._layers]
+                for session, tokens in self._sessions.items()
+                if any(t in self._layers for t in tokens)
+            }
+            self._stats[token] = stats
+            while len(self._stats) > 10 * self.max_entries:
+                self._stats.popitem(last=False)
+        print(f"Hexagon layer {token} ({label}): {stats}")
+        return f"{self.url_prefix}/{token}"
+
+    def get(self, token):
+        """
+        Layer of a token, None if it is unknown (or was dropped). From a directory,
+        only the gzip JSON and Arrow bytes of the layer.
+        """
+        if self.directory is None:
+            with self._lock:
+                return self._layers.get(token)
+
+        if not self._valid_token(token):
+            return None
+        try:
+            with open(self._path(token, "json.gz"), "rb") as f:
+                layer = {"gzip": f.read()}
+            with open(self._path(token, "arrow"), "rb") as f:
+                layer["arrow"] = f.read()
+        except FileNotFoundError:
+            return None
+        return layer
+
+    def json_bytes(self, layer):
+        """
+        Uncompressed JSON records of a layer.
+        """
+        if "json" in layer:
+            return layer["json"]
+        return gzip.decompress(layer["gzip"])
+
+    def arrow_bytes(self, layer):
+        """
+        Arrow IPC stream of a layer, with the columns h (string), c (RGBA as a
+        fixed size list of uint8) and e (float32).
+        """
+        if "arrow" in layer:
+            return layer["arrow"]
+        table = pa.table(
+            {
+                "h": pa.array(layer["hexs"], type=pa.string()),
+                "c": pa.FixedSizeListArray.from_arrays(
+                    pa.array(layer["colors"].ravel(), type=pa.uint8()), 4
+                ),
+                "e": pa.array(layer["elevations"], from_pandas=True),
+            }
+        )
+        sink = io.BytesIO()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return sink.getvalue()
+
+    def record_timing(self, token, timing):
+        """
+        Add the transfer size and load time measured in the browser to the
+        statistics of a layer.
+        """
+        if self.directory is None:
+            with self._lock:
+                if token in self._stats:
+                    self._stats[token].update(timing)
+            return
+
+        if not self._valid_token(token):
+            return
+        with self._lock:
+            try:
+                with open(self._path(token, "stats.json"), "rb") as f:
+                    stats = json.load(f)
+            except FileNotFoundError:
+                return
+            stats.update(timing)
+            self._write(token, "stats.json", json.dumps(stats).encode())
+
+    def stats(self):
+        """
+        Statistics of the layers: rows, JSON and gzip bytes, build time on the
+        server and, when the browser reported them, the bytes transferred and the
+        load time. From a directory, the ones of the stored layers, built by any
+        worker.
+        """
+        if self.directory is None:
+            with self._lock:
+                return [{"token": token, **stats} for token, stats in self._stats.items()]
+
+        stats = []
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(".stats.json"):
+                continue
+            try:
+                with open(entry.path, "rb") as f:
+                    stats.append({"token": entry.name[: -len(".stats.json")], **json.load(f)})
+            except FileNotFoundError:
+                pass
+        return sorted(stats, key=lambda layer: layer["created"])
+
+    def _remove_old_files(self):
+        layers = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".json.gz"):
+                try:
+                    layers.append((entry.stat().st_mtime, entry.name[: -len(".json.gz")]))
+                except FileNotFoundError:
+                    pass
+        layers.sort()
+
+        # The oldest layers of each session beyond max_session_entries, then the
+        # oldest of all beyond max_entries
+        sessions = {}
+        for _, token in layers:
+            sessions.setdefault(token.split(".", 1)[0], []).append(token)
+        removed = {
+            token
+            for tokens in sessions.values()
+            for token in tokens[: -self.max_session_entries]
+        }
+        kept = [token for _, token in layers if token not in removed]
+        removed.update(kept[: max(len(kept) - self.max_entries, 0)])
+
+        for token in removed:
+            for extension in ["json.gz", "arrow", "stats.json"]:
+                try:
+                    os.remove(self._path(token, extension))
+                except FileNotFoundError:
+                    pass
+
+
+def register_routes(server, store):
+    """
+    Add the routes of a HexLayerStore to the Flask server of the app:
+
+    - GET <prefix>/<token>: layer data (JSON, or Arrow IPC with ?format=arrow)
+    - POST <prefix>/timing: browser measurements (see assets/hex_layer_timing.js)
+    - GET <prefix>/stats: statistics of the layers, see `HexLayerStore.stats`
+    """
+    prefix = store.url_prefix
+
+    @server.route(f"{prefix}/stats")
+    def hex_layer_stats():
+        return flask.jsonify(store.stats())
+
+    @server.route(f"{prefix}/timing", methods=["POST"])
+    def hex_layer_timing():
+        # Sent with navigator.sendBeacon, as text
+        try:
+            timing = json.loads(flask.request.get_data(as_text=True) or "{}")
+        except ValueError:
+            flask.abort(400)
+        if not isinstance(timing, dict) or not isinstance(timing.get("url", ""), str):
+            flask.abort(400)
+        token = timing.pop("url", "").rstrip("/").rsplit("/", 1)[-1].split("?")[0]
+        store.record_timing(
+            token,
+            {
+                "transfer_bytes": timing.get("transfer_size"),
+                "load_ms": timing.get("duration"),
+            },
+        )
+        print(f"Hexagon layer {token} loaded in the browser: {timing}")
+        return "", 204
+
+    @server.route(f"{prefix}/<token>")
+    def hex_layer_data(token):
+        layer = store.get(token)
+        if layer is None:
+            flask.abort(404)
+
+        if flask.request.args.get("format") == "arrow":
+            response = flask.Response(
+                store.arrow_bytes(layer), mimetype="application/vnd.apache.arrow.stream"
+            )
+        elif "gzip" in flask.request.headers.get("Accept-Encoding", ""):
+            response = flask.Response(layer["gzip"], mimetype="application/json")
+            response.headers["Content-Encoding"] = "gzip"
+            response.headers["Vary"] = "Accept-Encoding"
+        else:
+            response = flask.Response(store.json_bytes(layer), mimetype="application/json")
+        # The data of a token never changes
+        response.headers["Cache-Control"] = "private, max-age=3600, immutable"
+        return response
+
+
+if __name__ == "__main__":
+    # Bytes of a microregion-sized hexagon layer: embedded GeoDataFrame in the
+    # deck JSON (as before) against the compact JSON, gzip and Arrow transports
+    import geopandas as gpd
+    import h3
+    import pandas as pd
+    import pydeck as pdk
+    from shapely.geometry import Polygon
+
+    from helper_colormaps import encode_continuous
+
+    rng = np.random.default_rng(0)
+    center_hex = h3.geo_to_h3(-1.4558, -48.4902, 8)
+    for radius in [30, 60]:
+        hids = list(h3.k_ring(center_hex, radius))
+        # A hexagon table with 40 numerical variables, like the state hexagons
+        hexagons = gpd.GeoDataFrame(
+            pd.DataFrame(rng.random((len(hids), 40)), columns=[f"var_{i}" for i in range(40)]),
+            geometry=[
+                Polygon([(lng, lat) for lat, lng in h3.h3_to_geo_boundary(hid)])
+                for hid in hids
+            ],
+            crs="EPSG:4326",
+        ).assign(hex=hids)
+        colors = encode_continuous(hexagons["var_0"], "viridis")
+
+        start = time.time()
+        embedded = pdk.Deck(
+            layers=[
+                pdk.Layer(
+                    "H3HexagonLayer",
+                    data=hexagons.assign(color=rgba_column(colors)),
+                    get_hexagon="hex",
+                    get_fill_color="color",
+                    get_elevation="var_1",
+                )
+            ]
+        ).to_json()
+        elapsed_embedded = time.time() - start
+
+        store = HexLayerStore()
+        start = time.time()
+        token = store.put(hexagons["hex"], colors, hexagons["var_1"]).rsplit("/", 1)[-1]
+        elapsed_compact = time.time() - start
+        layer = store.get(token)
+
+        print(
+            f"{len(hids)} hexagons: embedded deck JSON {len(embedded) / 1e6:.2f} MB "
+            f"({elapsed_embedded:.2f} s), compact JSON {len(layer['json']) / 1e6:.2f} MB, "
+            f"gzip {len(layer['gzip']) / 1e6:.2f} MB ({elapsed_compact:.2f} s), "
+            f"Arrow IPC {len(store.arrow_bytes(layer)) / 1e6:.2f} MB"
+        )
@@ -47,6 +47,10 @@ column_labels = {
     "IED_NIV_4_FUND": "(%) Teachers Effort indicator - Level 4",
     "IED_NIV_5_FUND": "(%) Teachers Effort indicator - Level 5",
     "IED_NIV_6_FUND": "(%) Teachers Effort indicator - Level 6",
+    # Results of the analyses
+    "capacity_index": "Capacity Index",
+    "accessibility_index": "Accessibility Index",
+    "clusters": "Cluster Hot-Cold Spots",
 }
 
 color_variable_options = [
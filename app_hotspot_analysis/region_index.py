@@ -0,0 +1,79 @@
+import time
+
+import geopandas as gpd
+import numpy as np
+from shapely.geometry import box
+
+
+class RegionIndex:
+    """
+    Precomputed membership of the hexagons in a set of regions (e.g. microregions
+    or municipalities), so selecting the hexagons of a region is an integer index
+    lookup instead of clipping all the hexagons.
+
+    The membership is computed once with a single spatial index query: a hexagon
+    belongs to a region if it intersects it (the hexagons `GeoDataFrame.clip`
+    keeps), or its buffered bounding box with `bbox_buffer`.
+
+    The positions refer to the rows of `hexs`, so they stay valid as long as the
+    hexagons keep their order (e.g. after adding columns with `assign`).
+
+    Parameters
+    ----------
+    hexs : gpd.GeoDataFrame
+        GeoDataFrame with the hexagons
+    regions : gpd.GeoDataFrame
+        GeoDataFrame with the regions, in the CRS of `hexs`
+    code_col : str
+        Column of `regions` with the region codes
+    bbox_buffer : float, optional
+        Use the bounding boxes of the regions with this buffer (in the units of the
+        CRS) instead of their polygons. Default is None.
+    """
+
+    def __init__(self, hexs, regions, code_col, bbox_buffer=None):
+        start = time.time()
+        geometries = regions.geometry
+        if bbox_buffer is not None:
+            geometries = gpd.GeoSeries(
+                [box(*bounds).buffer(bbox_buffer) for bounds in geometries.bounds.to_numpy()],
+                crs=regions.crs,
+            )
+        region_idx, hex_idx = hexs.sindex.query(geometries, predicate="intersects")
+
+        # CSR-like layout: the positions of region i are positions[indptr[i]:indptr[i + 1]],
+        # sorted so the selected hexagons keep the order of `hexs`
+        order = np.lexsort((hex_idx, region_idx))
+        self.positions = hex_idx[order]
+        self.indptr = np.searchsorted(region_idx[order], np.arange(len(regions) + 1))
+        self.codes = {code: i for i, code in enumerate(regions[code_col].tolist())}
+        print(
+            f"Region index of {len(regions)} regions and {len(hexs)} hexagons "
+            f"built in {time.time() - start:.2f} seconds"
+        )
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __contains__(self, code):
+        return code in self.codes
+
+    def positions_of(self, code):
+        """
+        Positions (iloc) of the hexagons of a region, in increasing order.
+        """
+        i = self.codes[code]
+        return self.positions[self.indptr[i] : self.indptr[i + 1]]
+
+    def select(self, hexs, code):
+        """
+        Hexagons of a region, as a new (Geo)DataFrame with the full hexagons.
+        """
+        return hexs.take(self.positions_of(code))
+
+    def sizes(self):
+        """
+        Number of hexagons of each region, as a dict {code: count}.
+        """
+        counts = np.diff(self.indptr)
+        return {code: int(counts[i]) for code, i in self.codes.items()}
@@ -0,0 +1,90 @@
+import time
+
+import numpy as np
+import shapely
+
+
+class SpatialIndex:
+    """
+    STRtree over the geometries of a GeoDataFrame (e.g. schools, microregions or
+    municipalities), built once and queried in bulk instead of scanning or
+    clipping the whole GeoDataFrame on each request.
+
+    The results are positions (iloc) in the GeoDataFrame, so they stay valid as
+    long as its rows keep their order.
+
+    Parameters
+    ----------
+    gdf : gpd.GeoDataFrame
+        GeoDataFrame to index
+    id_col : str, optional
+        Column with the ids returned by `id_at`. Default is None (the positions).
+    """
+
+    def __init__(self, gdf, id_col=None):
+        start = time.time()
+        self.geometries = gdf.geometry.to_numpy()
+        self.ids = gdf[id_col].to_numpy() if id_col else np.arange(len(gdf))
+        self.tree = shapely.STRtree(self.geometries)
+        print(
+            f"Spatial index of {len(gdf)} geometries built in "
+            f"{time.time() - start:.2f} seconds"
+        )
+
+    def __len__(self):
+        return len(self.geometries)
+
+    def query(self, geometry, predicate="intersects"):
+        """
+        Positions of the geometries related to `geometry` (by default the ones
+        intersecting it, which for points are the ones `GeoDataFrame.clip` keeps),
+        in increasing order.
+        """
+        return np.sort(self.tree.query(geometry, predicate=predicate))
+
+    def query_bbox(self, minx, miny, maxx, maxy):
+        """
+        Positions of the geometries intersecting a bounding box, in increasing order.
+        """
+        return self.query(shapely.box(minx, miny, maxx, maxy))
+
+    def select(self, gdf, geometry, predicate="intersects"):
+        """
+        Rows of the indexed `gdf` related to `geometry`, see `query`.
+        """
+        return gdf.take(self.query(geometry, predicate))
+
+    def locate(self, xs, ys):
+        """
+        Position of the geometry containing each point (on the border of two
+        polygons, the first one), -1 for the points outside all of them. One query
+        for all the points.
+
+        Parameters
+        ----------
+        xs, ys : array-like
+            Coordinates of the points (longitude and latitude in EPSG:4326)
+
+        Returns
+        -------
+        numpy.ndarray
+            (N,) int64 positions
+        """
+        points = shapely.points(
+            np.asarray(xs, dtype=np.float64), np.asarray(ys, dtype=np.float64)
+        )
+        point_idx, geom_idx = self.tree.query(points, predicate="intersects")
+        positions = np.full(len(points), -1, dtype=np.int64)
+        # Keep the first match (lowest position) of each point
+        order = np.lexsort((geom_idx, point_idx))
+        point_idx, geom_idx = point_idx[order], geom_idx[order]
+        _, first = np.unique(point_idx, return_index=True)
+        positions[point_idx[first]] = geom_idx[first]
+        return positions
+
+    def id_at(self, x, y):
+        """
+        Id of the geometry containing a point, None if it is outside all of them.
+        """
+        position = self.locate([x], [y])[0]
+        return None if position < 0 else self.ids[position]
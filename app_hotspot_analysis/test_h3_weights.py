@@ -0,0 +1,42 @@
+import h3
+import numpy as np
+import pytest
+
+from h3_weights import h3_kring_adjacency
+
+
+def kring_pairs(hids, kring):
+    positions = {hid: pos for pos, hid in enumerate(hids)}
+    return {
+        (positions[hid], positions[neighbor])
+        for hid in hids
+        for neighbor in h3.k_ring(hid, kring)
+        if neighbor in positions
+    }
+
+
+def adjacency_pairs(hids, kring):
+    adjacency = h3_kring_adjacency(hids, kring).tocoo()
+    assert np.all(adjacency.data == 1)
+    return set(zip(adjacency.row.tolist(), adjacency.col.tolist()))
+
+
+@pytest.mark.parametrize("res", [5, 8])
+@pytest.mark.parametrize("steps", [0, 6])
+@pytest.mark.parametrize("kring", [1, 2])
+def test_adjacency_near_pentagon(res, steps, kring):
+    # Hexagons around a pentagon (steps=0) or with a pentagon off-center
+    center = sorted(h3.get_pentagon_indexes(res))[0]
+    for _ in range(steps):
+        center = sorted(h3.hex_ring(center, 1))[0]
+    hids = sorted(h3.k_ring(center, 12))
+    assert any(h3.h3_is_pentagon(hid) for hid in hids)
+    assert adjacency_pairs(hids, kring) == kring_pairs(hids, kring)
+
+
+@pytest.mark.parametrize("kring", [1, 2])
+def test_adjacency_matches_k_ring(kring):
+    # Belém, with a gap so some hexagons lack neighbors
+    hids = sorted(h3.k_ring(h3.geo_to_h3(-1.4558, -48.4902, 8), 20))
+    hids = [hid for pos, hid in enumerate(hids) if pos % 7]
+    assert adjacency_pairs(hids, kring) == kring_pairs(hids, kring)
@@ -1,8 +1,13 @@
 import requests
+import numpy as np
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
 
+OSRM_HOST = "http://localhost:5000"
 
-def osrm_table(origins, destinations):
+
+def osrm_table(origins, destinations, host=OSRM_HOST, profile="profile", session=None):
     """
     This function returns the distance and duration between two points using the OSRM server.
     """
@@ -26,10 +31,10 @@ def osrm_table(origins, destinations):
             [str(i) for i in range(size_origins, size_origins + size_destinations)]
         ),
     }
-    url = f"http://localhost:5000/table/v1/profile/{coordinates_param}"
+    url = f"{host}/table/v1/{profile}/{coordinates_param}"
 
-    # Get the response
-    response = requests.get(url, params=params)
+    # Get the response (reuse the pooled connection if a session is given)
+    response = (session or requests).get(url, params=params)
 
     # Check if the response is valid
     if response.status_code == 200:
@@ -42,3 +47,223 @@ def osrm_table(origins, destinations):
         return distance, duration
     else:
         raise Exception("OSRM server error", response.status_code, response.text)
+
+
+def osrm_session(pool_size=8):
+    """
+    Create a requests session with a connection pool big enough for `pool_size`
+    concurrent requests to the OSRM server.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def osrm_table_blocks(size_origins, size_destinations, max_table_size=100):
+    """
+    Split an origins x destinations matrix in blocks that fit in one OSRM table request.
+
+    Parameters
+    ----------
+    size_origins : int
+        Number of origins (matrix rows)
+    size_destinations : int
+        Number of destinations (matrix columns)
+    max_table_size : int, optional
+        Maximum number of sources and of destinations per request. It must not exceed
+        the `--max-table-size` the osrm-routed server was started with. Default is 100.
+
+    Returns
+    -------
+    list
+        List of (rows slice, columns slice) tuples covering the whole matrix
+    """
+    return [
+        (
+            slice(i, min(i + max_table_size, size_origins)),
+            slice(j, min(j + max_table_size, size_destinations)),
+        )
+        for i in range(0, size_origins, max_table_size)
+        for j in range(0, size_destinations, max_table_size)
+    ]
+
+
+def osrm_table_matrix(
+    origins,
+    destinations,
+    max_table_size=100,
+    max_workers=8,
+    host=OSRM_HOST,
+    profile="profile",
+    cache=None,
+):
+    """
+    Compute the full origins x destinations distance and duration matrices with the
+    OSRM table service.
+
+    The matrix is tiled in blocks of at most `max_table_size` sources and destinations
+    (keeping the URL short and under the server limit), the blocks are requested
+    concurrently over a pooled session and the results are stitched together.
+
+    Parameters
+    ----------
+    origins : pandas.DataFrame
+        DataFrame with `lon` and `lat` columns for the origins (e.g. hexagon centroids)
+    destinations : pandas.DataFrame
+        DataFrame with `lon` and `lat` columns for the destinations (e.g. schools)
+    max_table_size : int, optional
+        Maximum number of sources and of destinations per request. Default is 100.
+    max_workers : int, optional
+        Number of concurrent requests. Default is 8.
+    host : str, optional
+        OSRM server url. Default is http://localhost:5000.
+    profile : str, optional
+        OSRM profile. Default is "profile" (osrm-routed serves a single profile).
+    cache : osrm_cache.OSRMCache, optional
+        Cache of previous results. Only the pairs missing from the cache are requested
+        to the server, and the new results are added to it. Default is None.
+
+    Returns
+    -------
+    tuple of numpy.ndarray
+        Distance (meters) and duration (seconds) float32 matrices with shape
+        (len(origins), len(destinations)). Unreachable pairs are NaN.
+    """
+    origins = origins[["lon", "lat"]].reset_index(drop=True)
+    destinations = destinations[["lon", "lat"]].reset_index(drop=True)
+
+    shape = (len(origins), len(destinations))
+    distance = np.full(shape, np.nan, dtype=np.float32)
+    duration = np.full(shape, np.nan, dtype=np.float32)
+
+    # Requests to send: (rows, cols) positions of the sub-matrix to ask the server for
+    requests_to_send = []
+    for rows, cols in osrm_table_blocks(*shape, max_table_size=max_table_size):
+        rows = np.arange(shape[0])[rows]
+        cols = np.arange(shape[1])[cols]
+        if cache is None:
+            requests_to_send.append((rows, cols))
+            continue
+
+        # Fill the block with the cached pairs and request only the missing ones
+        o = origins.iloc[np.repeat(rows, len(cols))]
+        d = destinations.iloc[np.tile(cols, len(rows))]
+        block_distance, block_duration, found = cache.lookup(
+            o["lon"], o["lat"], d["lon"], d["lat"]
+        )
+        block_shape = (len(rows), len(cols))
+        distance[np.ix_(rows, cols)] = block_distance.reshape(block_shape)
+        duration[np.ix_(rows, cols)] = block_duration.reshape(block_shape)
+        missing = ~found.reshape(block_shape)
+        if missing.any():
+            requests_to_send.append(
+                (rows[missing.any(axis=1)], cols[missing.any(axis=0)])
+            )
+
+    if not requests_to_send:
+        return distance, duration
+
+    with osrm_session(max_workers) as session:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(
+                    osrm_table,
+                    origins.iloc[rows],
+                    destinations.iloc[cols],
+                    host=host,
+                    profile=profile,
+                    session=session,
+                ): (rows, cols)
+                for rows, cols in requests_to_send
+            }
+            for future in as_completed(futures):
+                rows, cols = futures[future]
+                block_distance, block_duration = future.result()
+                # OSRM returns null for unreachable pairs, numpy casts them to NaN
+                block_distance = np.array(block_distance, dtype=np.float32)
+                block_duration = np.array(block_duration, dtype=np.float32)
+                distance[np.ix_(rows, cols)] = block_distance
+                duration[np.ix_(rows, cols)] = block_duration
+
+                if cache is not None:
+                    o = origins.iloc[np.repeat(rows, len(cols))]
+                    d = destinations.iloc[np.tile(cols, len(rows))]
+                    cache.store(
+                        o["lon"],
+                        o["lat"],
+                        d["lon"],
+                        d["lat"],
+                        block_distance.ravel(),
+                        block_duration.ravel(),
+                    )
+
+    return distance, duration
+
+
+def osrm_error_code(response):
+    """
+    Code of an OSRM error response (e.g. "NoRoute"), None if the body is not JSON
+    (e.g. the error page of a proxy in front of the server).
+    """
+    try:
+        return response.json().get("code")
+    except ValueError:
+        return None
+
+
+def osrm_route(origin, destination, host=OSRM_HOST, profile="profile", session=None, cache=None):
+    """
+    Get the distance and duration of the route between two points using the OSRM server.
+    Drop-in replacement of `urbanpy.routing.osrm_route` with an optional cache.
+
+    Parameters
+    ----------
+    origin : shapely.geometry.Point
+        Origin point (lon, lat)
+    destination : shapely.geometry.Point
+        Destination point (lon, lat)
+    host : str, optional
+        OSRM server url. Default is http://localhost:5000.
+    profile : str, optional
+        OSRM profile. Default is "profile".
+    session : requests.Session, optional
+        Session used to reuse connections between calls. Default is None.
+    cache : osrm_cache.OSRMCache, optional
+        Cache of previous results. Default is None.
+
+    Returns
+    -------
+    tuple of float
+        Distance (meters) and duration (seconds). NaN if there is no route.
+    """
+    if cache is not None:
+        distance, duration, found = cache.lookup(
+            [origin.x], [origin.y], [destination.x], [destination.y]
+        )
+        if found[0]:
+            return distance[0], duration[0]
+
+    url = f"{host}/route/v1/{profile}/{origin.x},{origin.y};{destination.x},{destination.y}"
+    response = (session or requests).get(url, params={"overview": "false"})
+
+    if response.status_code == 200:
+        data = response.json()
+        if data["code"] == "Ok" and data["routes"]:
+            distance = data["routes"][0]["distance"]
+            duration = data["routes"][0]["duration"]
+        else:
+            distance, duration = np.nan, np.nan
+    # OSRM answers 400 NoRoute when the points can not be connected
+    elif response.status_code == 400 and osrm_error_code(response) == "NoRoute":
+        distance, duration = np.nan, np.nan
+    else:
+        raise Exception("OSRM server error", response.status_code, response.text)
+
+    if cache is not None:
+        cache.store(
+            [origin.x], [origin.y], [destination.x], [destination.y], [distance], [duration]
+        )
+
+    return distance, duration
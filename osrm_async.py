@@ -0,0 +1,224 @@
+import asyncio
+import aiohttp
+import numpy as np
+from tqdm import tqdm
+
+from helpers import OSRM_HOST
+
+
+def as_lonlat(points):
+    """
+    Convert points to a (N, 2) float array of lon, lat.
+
+    Parameters
+    ----------
+    points : geopandas.GeoSeries, pandas.DataFrame or array-like
+        Point geometries, a DataFrame with `lon` and `lat` columns or a (N, 2) array
+
+    Returns
+    -------
+    numpy.ndarray
+        Array with the longitude and latitude of each point
+    """
+    if hasattr(points, "columns"):
+        if "lon" in points.columns:
+            return points[["lon", "lat"]].to_numpy(dtype=np.float64)
+        return np.column_stack([points.geometry.x, points.geometry.y])
+    if hasattr(points, "x"):
+        # GeoSeries of points
+        return np.column_stack([points.x, points.y])
+    return np.asarray(points, dtype=np.float64).reshape(-1, 2)
+
+
+async def _fetch_route(session, url, semaphore, retries, backoff):
+    async with semaphore:
+        for attempt in range(retries + 1):
+            try:
+                async with session.get(url, params={"overview": "false"}) as response:
+                    if response.status == 200:
+                        data = await response.json()
+                        if data["code"] == "Ok" and data["routes"]:
+                            route = data["routes"][0]
+                            return route["distance"], route["duration"]
+                        return np.nan, np.nan
+                    if response.status == 400:
+                        # Not retried. Only NoRoute is a result (the points can not
+                        # be connected), the other errors (e.g. InvalidQuery) are
+                        # raised so they are never cached as unreachable
+                        try:
+                            code = (await response.json(content_type=None)).get("code")
+                        except ValueError:
+                            code = None
+                        if code == "NoRoute":
+                            return np.nan, np.nan
+                        raise Exception(
+                            "OSRM server error", response.status, await response.text()
+                        )
+                    if response.status != 429 and response.status < 500:
+                        raise Exception(
+                            "OSRM server error", response.status, await response.text()
+                        )
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if attempt == retries:
+                    raise
+            if attempt < retries:
+                await asyncio.sleep(backoff * 2**attempt)
+
+        raise Exception("OSRM server error", "retries exhausted", url)
+
+
+async def osrm_route_many_async(
+    origins,
+    destinations,
+    host=OSRM_HOST,
+    profile="profile",
+    max_in_flight=32,
+    retries=3,
+    backoff=0.5,
+    timeout=30,
+    cache=None,
+    progress=True,
+):
+    """
+    Get the route distance and duration between each origin and its destination
+    (pair-wise, not a matrix) using the OSRM route service.
+
+    All requests share one HTTP connection pool and at most `max_in_flight` of them
+    are sent at the same time. Failed requests (connection errors, timeouts, 429 and
+    5xx answers) are retried with exponential backoff. Other errors (e.g. an
+    InvalidQuery answer) are raised, before storing anything in the cache.
+
+    Parameters
+    ----------
+    origins : geopandas.GeoSeries, pandas.DataFrame or array-like
+        Origin points, see `as_lonlat`
+    destinations : geopandas.GeoSeries, pandas.DataFrame or array-like
+        Destination points, same length as `origins`
+    host : str, optional
+        OSRM server url. Default is http://localhost:5000.
+    profile : str, optional
+        OSRM profile. Default is "profile".
+    max_in_flight : int, optional
+        Maximum number of concurrent requests. Default is 32.
+    retries : int, optional
+        Number of retries of a failed request. Default is 3.
+    backoff : float, optional
+        Seconds to wait before the first retry, doubled on each retry. Default is 0.5.
+    timeout : float, optional
+        Timeout of each request in seconds. Default is 30.
+    cache : osrm_cache.OSRMCache, optional
+        Cache of previous results. Only the missing pairs are requested. Default is None.
+    progress : bool, optional
+        Show a progress bar. Default is True.
+
+    Returns
+    -------
+    tuple of numpy.ndarray
+        Distance (meters) and duration (seconds) arrays. NaN if there is no route.
+    """
+    origins = as_lonlat(origins)
+    destinations = as_lonlat(destinations)
+    if len(origins) != len(destinations):
+        raise ValueError("origins and destinations must have the same length")
+
+    if cache is not None:
+        distance, duration, found = cache.lookup(
+            origins[:, 0], origins[:, 1], destinations[:, 0], destinations[:, 1]
+        )
+    else:
+        distance = np.full(len(origins), np.nan)
+        duration = np.full(len(origins), np.nan)
+        found = np.zeros(len(origins), dtype=bool)
+
+    missing = np.flatnonzero(~found)
+    if len(missing) == 0:
+        return distance, duration
+
+    semaphore = asyncio.Semaphore(max_in_flight)
+    connector = aiohttp.TCPConnector(limit=max_in_flight)
+    client_timeout = aiohttp.ClientTimeout(total=timeout)
+
+    async with aiohttp.ClientSession(
+        connector=connector, timeout=client_timeout
+    ) as session:
+
+        async def fetch(i):
+            (o_lon, o_lat), (d_lon, d_lat) = origins[i], destinations[i]
+            url = f"{host}/route/v1/{profile}/{o_lon},{o_lat};{d_lon},{d_lat}"
+            return i, await _fetch_route(session, url, semaphore, retries, backoff)
+
+        tasks = [asyncio.ensure_future(fetch(i)) for i in missing]
+        try:
+            with tqdm(total=len(tasks), disable=not progress) as pbar:
+                for task in asyncio.as_completed(tasks):
+                    i, (distance[i], duration[i]) = await task
+                    pbar.update(1)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    if cache is not None:
+        cache.store(
+            origins[missing, 0],
+            origins[missing, 1],
+            destinations[missing, 0],
+            destinations[missing, 1],
+            distance[missing],
+            duration[missing],
+        )
+
+    return distance, duration
+
+
+def osrm_route_many(origins, destinations, **kwargs):
+    """
+    Blocking version of `osrm_route_many_async`, for scripts.
+    Inside Jupyter (which already runs an event loop) use
+    `await osrm_route_many_async(...)` instead.
+    """
+    return asyncio.run(osrm_route_many_async(origins, destinations, **kwargs))
+
+
+if __name__ == "__main__":
+    # Benchmark against the per-row approach (one blocking request at a time)
+    # using a local stub server with a fixed latency per request
+    import time
+    from shapely.geometry import Point
+    from helpers import osrm_route
+    from osrm_stub import StubOSRMServer
+
+    n = 2000
+    rng = np.random.default_rng(0)
+    # Random points around Belém
+    origins = np.column_stack(
+        [rng.uniform(-48.6, -48.3, n), rng.uniform(-1.5, -1.2, n)]
+    )
+    destinations = np.column_stack(
+        [rng.uniform(-48.6, -48.3, n), rng.uniform(-1.5, -1.2, n)]
+    )
+
+    with StubOSRMServer(latency=0.005) as server:
+        start = time.time()
+        serial = [
+            osrm_route(Point(*o), Point(*d), host=server.host)
+            for o, d in zip(origins, destinations)
+        ]
+        elapsed = time.time() - start
+        print(f"Serial requests: {n / elapsed:.0f} requests/s ({elapsed:.2f} s)")
+
+        for max_in_flight in [8, 32, 64]:
+            start = time.time()
+            distance, duration = osrm_route_many(
+                origins,
+                destinations,
+                host=server.host,
+                max_in_flight=max_in_flight,
+                progress=False,
+            )
+            elapsed = time.time() - start
+            print(
+                f"Async client (max_in_flight={max_in_flight}): "
+                f"{n / elapsed:.0f} requests/s ({elapsed:.2f} s)"
+            )
+
+        assert np.allclose(distance, [d for d, _ in serial])
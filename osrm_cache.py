@@ -0,0 +1,198 @@
+import sqlite3
+import threading
+import numpy as np
+
+
+class OSRMCache:
+    """
+    Persistent SQLite cache for OSRM distances and durations.
+
+    Entries are keyed by the origin and destination coordinates snapped to a grid
+    of `precision` decimal degrees, the routing profile and the OSRM dataset version
+    (e.g. the date of the .osm.pbf extract). Changing the dataset version makes the
+    old entries invisible, and `evict` removes them from disk.
+
+    Parameters
+    ----------
+    path : str
+        Path of the SQLite database file
+    profile : str
+        Routing profile of the cached results (e.g. "foot", "car")
+    dataset_version : str
+        Version of the OSRM dataset used to compute the cached results
+    precision : int, optional
+        Number of decimals kept when snapping the coordinates. Default is 5 (~1 m).
+    """
+
+    def __init__(self, path, profile, dataset_version, precision=5):
+        self.path = path
+        self.profile = profile
+        self.dataset_version = dataset_version
+        self.precision = precision
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS routes (
+                profile TEXT NOT NULL,
+                dataset_version TEXT NOT NULL,
+                o_lon INTEGER NOT NULL,
+                o_lat INTEGER NOT NULL,
+                d_lon INTEGER NOT NULL,
+                d_lat INTEGER NOT NULL,
+                distance REAL,
+                duration REAL,
+                PRIMARY KEY (profile, dataset_version, o_lon, o_lat, d_lon, d_lat)
+            ) WITHOUT ROWID
+            """
+        )
+        self._conn.execute(
+            """
+            CREATE TEMP TABLE lookup (
+                pos INTEGER PRIMARY KEY,
+                o_lon INTEGER, o_lat INTEGER, d_lon INTEGER, d_lat INTEGER
+            )
+            """
+        )
+        self._conn.commit()
+
+    def snap(self, coords):
+        """
+        Snap coordinates (in degrees) to the integer grid used as cache key.
+        """
+        return np.rint(np.asarray(coords, dtype=np.float64) * 10**self.precision).astype(
+            np.int64
+        )
+
+    def _keys(self, o_lon, o_lat, d_lon, d_lat):
+        return zip(
+            *(self.snap(c).tolist() for c in (o_lon, o_lat, d_lon, d_lat))
+        )
+
+    def lookup(self, o_lon, o_lat, d_lon, d_lat):
+        """
+        Get the cached distance and duration for a set of origin-destination pairs.
+
+        Parameters
+        ----------
+        o_lon, o_lat, d_lon, d_lat : array-like
+            Coordinates of the origins and destinations of each pair
+
+        Returns
+        -------
+        tuple of numpy.ndarray
+            Distance, duration and a boolean mask with the pairs found in the cache.
+            Pairs not found have NaN distance and duration (cached unreachable pairs
+            are also NaN, but found).
+        """
+        size = len(o_lon)
+        distance = np.full(size, np.nan)
+        duration = np.full(size, np.nan)
+        found = np.zeros(size, dtype=bool)
+
+        with self._lock:
+            self._conn.execute("DELETE FROM lookup")
+            self._conn.executemany(
+                "INSERT INTO lookup VALUES (?, ?, ?, ?, ?)",
+                (
+                    (pos, *key)
+                    for pos, key in enumerate(self._keys(o_lon, o_lat, d_lon, d_lat))
+                ),
+            )
+            rows = self._conn.execute(
+                """
+                SELECT l.pos, r.distance, r.duration
+                FROM lookup l
+                JOIN routes r
+                  ON r.profile = ? AND r.dataset_version = ?
+                 AND r.o_lon = l.o_lon AND r.o_lat = l.o_lat
+                 AND r.d_lon = l.d_lon AND r.d_lat = l.d_lat
+                """,
+                (self.profile, self.dataset_version),
+            ).fetchall()
+            # Close the implicit transaction so other connections can write
+            self._conn.commit()
+            # A pair matches at most one entry (the primary key). The cache is
+            # shared by the threads of osrm_table_matrix, so count under the lock
+            self.hits += len(rows)
+            self.misses += size - len(rows)
+
+        if rows:
+            pos, dist, dur = zip(*rows)
+            pos = np.array(pos)
+            distance[pos] = np.array(dist, dtype=np.float64)
+            duration[pos] = np.array(dur, dtype=np.float64)
+            found[pos] = True
+
+        return distance, duration, found
+
+    def store(self, o_lon, o_lat, d_lon, d_lat, distance, duration):
+        """
+        Store the distance and duration of a set of origin-destination pairs.
+        NaN values (unreachable pairs) are stored as NULL.
+        """
+        distance = np.asarray(distance, dtype=np.float64)
+        duration = np.asarray(duration, dtype=np.float64)
+        values = (
+            (
+                self.profile,
+                self.dataset_version,
+                *key,
+                None if np.isnan(dist) else dist,
+                None if np.isnan(dur) else dur,
+            )
+            for key, dist, dur in zip(
+                self._keys(o_lon, o_lat, d_lon, d_lat),
+                distance.tolist(),
+                duration.tolist(),
+            )
+        )
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO routes VALUES (?, ?, ?, ?, ?, ?, ?, ?)", values
+            )
+            self._conn.commit()
+
+    def evict(self, keep_version=None):
+        """
+        Remove the entries of every dataset version except `keep_version`
+        (by default the current one). Returns the number of removed entries.
+        """
+        keep_version = self.dataset_version if keep_version is None else keep_version
+        with self._lock:
+            removed = self._conn.execute(
+                "DELETE FROM routes WHERE dataset_version != ?", (keep_version,)
+            ).rowcount
+            self._conn.commit()
+            self._conn.execute("VACUUM")
+        return removed
+
+    def stats(self):
+        """
+        Hit/miss counters of this session and number of cached entries for the
+        current profile and dataset version.
+        """
+        with self._lock:
+            (size,) = self._conn.execute(
+                "SELECT COUNT(*) FROM routes WHERE profile = ? AND dataset_version = ?",
+                (self.profile, self.dataset_version),
+            ).fetchone()
+            hits, misses = self.hits, self.misses
+        total = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / total if total else 0.0,
+            "entries": size,
+        }
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
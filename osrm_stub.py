@@ -0,0 +1,158 @@
+import json
+import math
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+
+def haversine(lon1, lat1, lon2, lat2):
+    """
+    Great circle distance in meters between two points.
+    """
+    lon1, lat1, lon2, lat2 = map(math.radians, (lon1, lat1, lon2, lat2))
+    a = (
+        math.sin((lat2 - lat1) / 2) ** 2
+        + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    )
+    return 2 * 6371000 * math.asin(math.sqrt(a))
+
+
+class StubOSRMServer:
+    """
+    Minimal local stand-in of osrm-routed for tests and benchmarks.
+
+    It answers the `route` and `table` services with the great circle distance
+    between the points and a duration at a constant speed, after an optional
+    artificial latency (to mimic the routing time of a real server). Like OSRM, it
+    answers 400 with the code "InvalidQuery" to coordinates that can not be parsed
+    or are out of range, and "NoRoute" to routes longer than `max_distance`.
+
+    Parameters
+    ----------
+    port : int, optional
+        Port to listen on. Default is 0 (a free port is chosen, see `host`).
+    latency : float, optional
+        Seconds to wait before answering each request. Default is 0.
+    speed : float, optional
+        Speed in meters per second used for the durations. Default is 1.4 (walking).
+    max_distance : float, optional
+        Longest route in meters, the longer ones have no route. Default is None (no
+        limit).
+
+    Examples
+    --------
+    >>> with StubOSRMServer(latency=0.005) as server:
+    ...     osrm_route(origin, destination, host=server.host)
+    """
+
+    def __init__(self, port=0, latency=0.0, speed=1.4, max_distance=None):
+        self.latency = latency
+        self.speed = speed
+        self.max_distance = max_distance
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def host(self):
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def send_json(self, status, body):
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                # The handlers run in parallel threads
+                with stub._lock:
+                    stub.requests += 1
+                if stub.latency:
+                    time.sleep(stub.latency)
+
+                url = urlsplit(self.path)
+                _, service, _, _, coordinates = url.path.split("/", 4)
+                try:
+                    coordinates = [
+                        tuple(map(float, c.split(","))) for c in coordinates.split(";")
+                    ]
+                    if any(
+                        len(c) != 2 or not (-180 <= c[0] <= 180 and -90 <= c[1] <= 90)
+                        for c in coordinates
+                    ):
+                        raise ValueError(coordinates)
+                except ValueError:
+                    self.send_json(
+                        400, {"code": "InvalidQuery", "message": "Query string malformed"}
+                    )
+                    return
+                query = parse_qs(url.query)
+
+                if service == "route":
+                    distance = haversine(*coordinates[0], *coordinates[1])
+                    if stub.max_distance is not None and distance > stub.max_distance:
+                        self.send_json(
+                            400, {"code": "NoRoute", "message": "Impossible route"}
+                        )
+                        return
+                    body = {
+                        "code": "Ok",
+                        "routes": [
+                            {"distance": distance, "duration": distance / stub.speed}
+                        ],
+                    }
+                elif service == "table":
+                    sources = query.get("sources", ["all"])[0]
+                    destinations = query.get("destinations", ["all"])[0]
+                    all_points = list(range(len(coordinates)))
+                    sources = all_points if sources == "all" else map(int, sources.split(";"))
+                    destinations = (
+                        all_points
+                        if destinations == "all"
+                        else [int(i) for i in destinations.split(";")]
+                    )
+                    distances = [
+                        [haversine(*coordinates[i], *coordinates[j]) for j in destinations]
+                        for i in sources
+                    ]
+                    body = {
+                        "code": "Ok",
+                        "distances": distances,
+                        "durations": [[d / stub.speed for d in row] for row in distances],
+                    }
+                else:
+                    self.send_error(400)
+                    return
+
+                self.send_json(200, body)
+
+        return Handler
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+from osrm_async import osrm_route_many
+from osrm_cache import OSRMCache
+from osrm_stub import StubOSRMServer
+
+# Points around Belém, the last destination is 2 km away from its origin
+ORIGINS = np.array([[-48.49, -1.45], [-48.48, -1.44], [-48.47, -1.43]])
+DESTINATIONS = np.array([[-48.48, -1.45], [-48.47, -1.44], [-48.47, -1.412]])
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return OSRMCache(str(tmp_path / "osrm.sqlite"), "foot", "test")
+
+
+def lookup(cache, origins, destinations):
+    return cache.lookup(origins[:, 0], origins[:, 1], destinations[:, 0], destinations[:, 1])
+
+
+def test_no_route_is_cached_as_nan(cache):
+    with StubOSRMServer(max_distance=1500) as server:
+        distance, duration = osrm_route_many(
+            ORIGINS, DESTINATIONS, host=server.host, cache=cache, progress=False
+        )
+    assert np.isfinite(distance[:2]).all() and np.isfinite(duration[:2]).all()
+    assert np.isnan(distance[2]) and np.isnan(duration[2])
+
+    cached_distance, _, found = lookup(cache, ORIGINS, DESTINATIONS)
+    assert found.all()
+    np.testing.assert_array_equal(cached_distance, distance)
+
+
+def test_invalid_query_raises_and_is_not_cached(cache):
+    # Latitude out of range
+    origins = np.vstack([ORIGINS, [[-48.49, 95.0]]])
+    destinations = np.vstack([DESTINATIONS, [[-48.48, -1.45]]])
+    with StubOSRMServer() as server:
+        with pytest.raises(Exception, match="OSRM server error"):
+            osrm_route_many(
+                origins, destinations, host=server.host, cache=cache, progress=False
+            )
+
+    _, _, found = lookup(cache, origins, destinations)
+    assert not found.any()